@@ -0,0 +1,259 @@
+"""Benchmark the full DAG offline, against in-process fakes of every service.
+
+Usage (from the repository root):
+
+    python -m benchmarks.bench_dag --sizes 24 240 2400 --latency 0.02
+
+For each tweet count the DAG is run end to end and the per-stage throughput and
+per-tweet latencies from twit2imgs.metrics are reported, as a table and
+optionally as json for regression gating.
+"""
+
+import argparse
+import json
+import os
+import tempfile
+from contextlib import ExitStack
+from typing import Any, Callable, Dict, Optional
+from unittest import mock
+
+import requests
+import yaml
+
+from benchmarks.fakes import (
+    FakeClientSession,
+    FakeServiceAdapter,
+    FakeStorageClient,
+    FakeTwitterClient,
+    synthetic_jpeg,
+)
+from twit2imgs import aio, utils
+from twit2imgs.cli import DAG
+from twit2imgs.google_photos_client import GooglePhotosClient
+from twit2imgs.metrics import metrics
+
+USER_ID = "782268722006425600"
+ALBUM = "bench-album"
+
+# per-tweet timings worth reporting, in pipeline order
+TWEET_TIMINGS = [
+    "scraper.fetch",
+    "tweet.decode",
+    "storer.encode",
+    "storer.upload",
+    "target.render",
+    "photos.upload",
+    "photos.batch_create",
+]
+
+
+def bench_config(
+    n_tweets: int,
+    streaming: bool,
+    workdir: str,
+    max_inflight_bytes: Optional[int] = None,
+) -> dict:
+    pipeline: Dict[str, Any] = dict(streaming=streaming)
+    if max_inflight_bytes is not None:
+        pipeline["max_inflight_bytes"] = max_inflight_bytes
+
+    return dict(
+        scraper=dict(
+            cls="twit2imgs.scraper.UserScraper",
+            params=dict(
+                TWITTER_API_BEARER_TOKEN="fake",
+                user_id=USER_ID,
+                tweet_fields=["attachments", "created_at"],
+                max_results=n_tweets,
+                concurrency=8,
+            ),
+        ),
+        storer=dict(
+            cls="twit2imgs.storer.GCPStore",
+            params=dict(bucket="bench", record_prefix="records", image_prefix="images"),
+        ),
+        targets=dict(
+            GooglePhotos=dict(
+                cls="twit2imgs.target.GooglePhotosTarget",
+                params=dict(
+                    album_name=ALBUM,
+                    client_params=dict(
+                        scopes=[],
+                        scoped_credentials_file=os.path.join(workdir, "creds.json"),
+                        client_params={},
+                    ),
+                ),
+            )
+        ),
+        pipeline=pipeline,
+    )
+
+
+def patch_services(
+    stack: ExitStack,
+    workdir: str,
+    adapter: FakeServiceAdapter,
+    twitter: Callable[..., FakeTwitterClient],
+    latency: float = 0.0,
+):
+    """Replace the clients of every service the DAG calls with in-process fakes.
+
+    Cloud Storage blobs are kept under `{workdir}/gcs`. With aiohttp installed,
+    the async engine's requests are sent through `adapter` too.
+    """
+    pooled_session = utils.pooled_session
+    adapter.storage = FakeStorageClient(os.path.join(workdir, "gcs"), latency=latency)
+
+    stack.enter_context(mock.patch("twit2imgs.scraper.tweepy.Client", twitter))
+    stack.enter_context(
+        mock.patch.object(
+            utils,
+            "pooled_session",
+            lambda *args, **kwargs: adapter.mount(pooled_session(*args, **kwargs)),
+        )
+    )
+    stack.enter_context(
+        mock.patch.object(
+            utils,
+            "storage_client",
+            lambda *args, **kwargs: FakeStorageClient(
+                os.path.join(workdir, "gcs"), latency=latency
+            ),
+        )
+    )
+    stack.enter_context(
+        mock.patch.object(
+            GooglePhotosClient,
+            "_get_authorized_session",
+            lambda self: requests.Session(),
+        )
+    )
+    if aio.aiohttp is not None:
+        stack.enter_context(
+            mock.patch.object(
+                aio.aiohttp,
+                "ClientSession",
+                lambda **kwargs: FakeClientSession(adapter, **kwargs),
+            )
+        )
+    stack.enter_context(
+        mock.patch.object(aio.google.auth, "default", lambda **kwargs: (None, None))
+    )
+
+
+def run_dag(workdir: str, cfg: dict, *args: str, name: str = "bench"):
+    """Run the DAG from `workdir` on `cfg`, with any further cli `args`."""
+    os.makedirs(os.path.join(workdir, "conf"), exist_ok=True)
+    with open(os.path.join(workdir, "conf", f"{name}.yaml"), "w") as f:
+        yaml.dump(cfg, f)
+
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        return DAG.main([name, *args], standalone_mode=False)
+    finally:
+        os.chdir(cwd)
+
+
+def run(
+    n_tweets: int,
+    image_bytes: bytes,
+    latency: float,
+    streaming: bool,
+    max_inflight_bytes: Optional[int] = None,
+) -> dict:
+    with tempfile.TemporaryDirectory() as workdir, ExitStack() as stack:
+        adapter = FakeServiceAdapter(image_bytes, latency=latency)
+        adapter.album(ALBUM)
+        patch_services(
+            stack,
+            workdir,
+            adapter,
+            lambda **kwargs: FakeTwitterClient(n_tweets, latency=latency),
+            latency,
+        )
+
+        run_dag(workdir, bench_config(n_tweets, streaming, workdir, max_inflight_bytes))
+
+        report = metrics.report()
+        report["n_tweets"] = n_tweets
+        report["album_items"] = sum(map(len, adapter.media_items.values()))
+
+        return report
+
+
+def summarise(report: dict) -> dict:
+    n = report["n_tweets"]
+    timings = report["timings"]
+
+    stages = {
+        name: dict(seconds=t["total"], tweets_per_s=round(n / t["total"], 2))
+        for name, t in timings.items()
+        if name.startswith("stage.") and t["total"] > 0
+    }
+    latencies = {
+        name: dict(mean_ms=round(1000 * t["mean"], 1), max_ms=round(1000 * t["max"], 1))
+        for name, t in ((k, timings[k]) for k in TWEET_TIMINGS if k in timings)
+    }
+
+    return dict(
+        n_tweets=n,
+        wall_time=report["wall_time"],
+        tweets_per_s=round(n / report["wall_time"], 2) if report["wall_time"] else None,
+        peak_rss_mb=round(report["peak_rss_bytes"] / 1024**2, 1),
+        high_water_mb=round(
+            report["counters"].get("memory.high_water_bytes", 0) / 1024**2, 1
+        ),
+        album_items=report["album_items"],
+        stages=stages,
+        latencies=latencies,
+    )
+
+
+def print_summary(summary: dict):
+    print(
+        f"\n{summary['n_tweets']} tweets: {summary['wall_time']}s wall, "
+        f"{summary['tweets_per_s']} tweets/s, peak RSS {summary['peak_rss_mb']} MB, "
+        f"{summary['album_items']} album items"
+    )
+    for name, stage in summary["stages"].items():
+        print(f"  {name:<28} {stage['seconds']:>9.2f}s {stage['tweets_per_s']:>9} /s")
+    for name, latency in summary["latencies"].items():
+        print(
+            f"  {name:<28} {latency['mean_ms']:>8.1f}ms mean "
+            f"{latency['max_ms']:>8.1f}ms max"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[24, 240, 2400])
+    parser.add_argument("--image-size", type=int, default=4096)
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds/call")
+    parser.add_argument("--sequential", action="store_true")
+    parser.add_argument("--max-inflight-mb", type=int, help="pipeline memory budget")
+    parser.add_argument("--output", help="write the summaries as json lines")
+    args = parser.parse_args()
+
+    image_bytes = synthetic_jpeg(args.image_size)
+
+    summaries = []
+    for n_tweets in args.sizes:
+        report = run(
+            n_tweets,
+            image_bytes,
+            args.latency,
+            not args.sequential,
+            args.max_inflight_mb * 1024**2 if args.max_inflight_mb else None,
+        )
+        summaries.append(summarise(report))
+        print_summary(summaries[-1])
+
+    if args.output:
+        with open(args.output, "w") as f:
+            for summary in summaries:
+                print(json.dumps(summary), file=f)
+
+
+if __name__ == "__main__":
+    main()
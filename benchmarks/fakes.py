@@ -0,0 +1,444 @@
+"""In-process stand-ins for Twitter, the image CDN, GCS and Google Photos.
+
+The HTTP services are faked with a requests transport adapter, so the real
+sessions, hooks and connection-pool code paths are all exercised; only the
+bytes on the wire are replaced. The async engine's aiohttp session is faked to
+send its requests through the same adapter. Every fake can add a fixed latency per call to
+approximate network round-trips.
+"""
+
+import asyncio
+import contextlib
+import io
+import json
+import os
+import random
+import threading
+import time
+from typing import Any, Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+import requests
+import tweepy
+from google.api_core.exceptions import NotFound, PreconditionFailed
+from PIL import Image
+
+IMAGE_HOST = "pbs.fake-twimg.com"
+PHOTOS_HOST = "photoslibrary.googleapis.com"
+GCS_HOST = "storage.googleapis.com"
+
+CAPTIONS = [
+    "Lake Natron, Tanzania (-2.4167, 36.0000) 14 Feb 2022",
+    "Betsiboka Estuary, Madagascar (-15.9000, 46.3000) 02 Mar 2022",
+    "Lena Delta, Russia (72.7500, 126.5000) 21 Jul 2022",
+]
+
+
+def synthetic_jpeg(size: int = 4096, quality: int = 90, seed: int = 0) -> bytes:
+    """A noisy, gradient image so that encoders have realistic work to do."""
+    gradient = Image.linear_gradient("L").resize((size, size))
+    noise = Image.effect_noise((size, size), 64 + seed % 32)
+    im = Image.merge("RGB", (gradient, noise, gradient.rotate(90)))
+
+    buf = io.BytesIO()
+    im.save(buf, format="JPEG", quality=quality)
+
+    return buf.getvalue()
+
+
+class FakeTwitterClient:
+    """Serve `n_tweets` synthetic image tweets per user through tweepy's types."""
+
+    def __init__(self, n_tweets: int, latency: float = 0.0, **kwargs):
+        self.n_tweets = n_tweets
+        self.latency = latency
+        self.session = requests.Session()
+
+    def _page(self, source: str, max_results: int, since_id, pagination_token):
+        time.sleep(self.latency)
+
+        # newest first, like the real timeline endpoints
+        ids = [int(source) * 10**6 + ii for ii in range(self.n_tweets, 0, -1)]
+        if since_id is not None:
+            ids = [ii for ii in ids if ii > int(since_id)]
+
+        start = int(pagination_token or 0)
+        page = ids[start : start + max_results]  # noqa
+
+        data = [
+            tweepy.Tweet(
+                dict(
+                    id=str(ii),
+                    text=CAPTIONS[ii % len(CAPTIONS)] + f" https://t.co/{ii}",
+                    attachments=dict(media_keys=[f"3_{ii}"]),
+                    edit_history_tweet_ids=[str(ii)],
+                )
+            )
+            for ii in page
+        ]
+        media = [
+            tweepy.Media(
+                dict(
+                    media_key=f"3_{ii}",
+                    type="photo",
+                    url=f"https://{IMAGE_HOST}/media/{ii}.jpg",
+                )
+            )
+            for ii in page
+        ]
+
+        meta: Dict[str, Any] = dict(result_count=len(page))
+        if start + max_results < len(ids):
+            meta["next_token"] = str(start + max_results)
+
+        return tweepy.Response(data, dict(media=media), [], meta)
+
+    def get_users_tweets(self, id, max_results=10, since_id=None, **kwargs):
+        return self._page(id, max_results, since_id, kwargs.get("pagination_token"))
+
+    def search_recent_tweets(self, query, max_results=10, since_id=None, **kwargs):
+        source = str(abs(hash(query)) % 1000)
+        return self._page(source, max_results, since_id, kwargs.get("next_token"))
+
+
+class FakeServiceAdapter(requests.adapters.BaseAdapter):
+    """A requests transport serving the image CDN and the Photos Library API.
+
+    With a `storage` client, it also serves the Cloud Storage JSON API uploads
+    made by the async engine, into that client's buckets.
+    """
+
+    # the granularity resumable upload chunks must be a multiple of
+    CHUNK_GRANULARITY = 256 * 1024
+
+    def __init__(
+        self, image_bytes: bytes, latency: float = 0.0, chunk_failure_rate: float = 0.0
+    ):
+        super().__init__()
+        self.image_bytes = image_bytes
+        self.latency = latency
+        # the fraction of resumable upload chunks dropped mid-request
+        self.chunk_failure_rate = chunk_failure_rate
+        self.lock = threading.Lock()
+        self.albums: Dict[str, dict] = {}
+        self.media_items: Dict[str, List[dict]] = {}
+        self.uploads: Dict[str, int] = {}
+        self.sessions: Dict[str, dict] = {}
+        self._random = random.Random(0)
+        self.storage: Optional["FakeStorageClient"] = None
+
+    def _response(self, request, status: int, content, content_type: str, headers=None):
+        if isinstance(content, (dict, list)):
+            content = json.dumps(content).encode()
+        elif isinstance(content, str):
+            content = content.encode()
+
+        resp = requests.Response()
+        resp.status_code = status
+        resp._content = content
+        resp.headers["Content-Type"] = content_type
+        resp.headers["Content-Length"] = str(len(content))
+        resp.headers.update(headers or {})
+        resp.url = request.url
+        resp.request = request
+        resp.encoding = "utf-8"
+
+        return resp
+
+    @staticmethod
+    def _body(request) -> dict:
+        body = request.body or b""
+        if isinstance(body, bytes):
+            body = body.decode(errors="ignore")
+        try:
+            return json.loads(body)
+        except ValueError:
+            return {k: v[-1] for k, v in parse_qs(body).items()}
+
+    def album(self, title: str) -> str:
+        with self.lock:
+            album_id = f"album-{len(self.albums)}"
+            self.albums[album_id] = dict(id=album_id, title=title)
+            self.media_items[album_id] = []
+        return album_id
+
+    def send(self, request, **kwargs):
+        time.sleep(self.latency)
+        url = urlparse(request.url)
+
+        if url.netloc == IMAGE_HOST:
+            return self._response(request, 200, self.image_bytes, "image/jpeg")
+
+        path = url.path
+        if url.netloc == GCS_HOST and path.startswith("/upload/storage/v1/b/"):
+            return self._store(request, path.split("/")[5], url.query)
+
+        if path == "/v1/albums" and request.method == "GET":
+            return self._response(
+                request, 200, dict(albums=list(self.albums.values())), "json"
+            )
+
+        if path.startswith("/v1/uploads/"):
+            return self._resumable(request, path.rsplit("/", 1)[-1])
+
+        if path == "/v1/uploads" and "X-Goog-Upload-Protocol" in request.headers:
+            if request.headers["X-Goog-Upload-Protocol"] == "resumable":
+                with self.lock:
+                    session_id = str(len(self.sessions))
+                    self.sessions[session_id] = dict(
+                        size=int(request.headers["X-Goog-Upload-Raw-Size"]),
+                        received=0,
+                        token=None,
+                    )
+                return self._response(
+                    request,
+                    200,
+                    b"",
+                    "text/plain",
+                    {
+                        "X-Goog-Upload-URL": f"{request.url}/{session_id}",
+                        "X-Goog-Upload-Chunk-Granularity": str(self.CHUNK_GRANULARITY),
+                    },
+                )
+
+        if path == "/v1/uploads":
+            with self.lock:
+                token = f"token-{len(self.uploads)}"
+                self.uploads[token] = len(request.body or b"")
+            return self._response(request, 200, token, "text/plain")
+
+        if path == "/v1/mediaItems:batchCreate":
+            body = self._body(request)
+            if len(body["newMediaItems"]) > 50:
+                return self._response(request, 400, dict(error="too many"), "json")
+
+            results = []
+            with self.lock:
+                for item in body["newMediaItems"]:
+                    media_item = dict(
+                        id=f"media-{sum(map(len, self.media_items.values()))}",
+                        description=item.get("description", ""),
+                    )
+                    self.media_items[body["albumId"]].append(media_item)
+                    results.append(
+                        dict(
+                            uploadToken=item["simpleMediaItem"]["uploadToken"],
+                            status=dict(message="Success"),
+                            mediaItem=media_item,
+                        )
+                    )
+            return self._response(
+                request, 200, dict(newMediaItemResults=results), "json"
+            )
+
+        if path == "/v1/mediaItems:search":
+            body = self._body(request)
+            start = int(body.get("pageToken", 0))
+            size = int(body.get("pageSize", 100))
+            items = self.media_items.get(body["albumId"], [])
+
+            page = dict(mediaItems=items[start : start + size])  # noqa
+            if start + size < len(items):
+                page["nextPageToken"] = str(start + size)
+            if not page["mediaItems"]:
+                page = {}
+            return self._response(request, 200, page, "json")
+
+        if path.endswith(":batchRemoveMediaItems"):
+            album_id = path.split("/")[-1].split(":")[0]
+            ids = self._body(request).get("mediaItemIds", [])
+            if not isinstance(ids, list) or len(ids) > 50:
+                return self._response(request, 400, dict(error="bad ids"), "json")
+
+            with self.lock:
+                self.media_items[album_id] = [
+                    item for item in self.media_items[album_id] if item["id"] not in ids
+                ]
+            return self._response(request, 200, {}, "json")
+
+        return self._response(request, 404, dict(error=request.url), "json")
+
+    def _store(self, request, bucket: str, query: str):
+        if self.storage is None:
+            return self._response(request, 404, dict(error="no storage"), "json")
+
+        name = parse_qs(query)["name"][0]
+        self.storage.bucket(bucket).blob(name).upload_from_string(
+            request.body or b"", content_type=request.headers.get("Content-Type")
+        )
+        return self._response(request, 200, dict(bucket=bucket, name=name), "json")
+
+    def _resumable(self, request, session_id: str):
+        session = self.sessions[session_id]
+        command = request.headers["X-Goog-Upload-Command"]
+
+        if command == "query":
+            status = "final" if session["token"] else "active"
+            return self._response(
+                request,
+                200,
+                session["token"] or b"",
+                "text/plain",
+                {
+                    "X-Goog-Upload-Status": status,
+                    "X-Goog-Upload-Size-Received": str(session["received"]),
+                },
+            )
+
+        offset = int(request.headers["X-Goog-Upload-Offset"])
+        if offset != session["received"]:
+            return self._response(request, 400, dict(error="bad offset"), "json")
+
+        with self.lock:
+            dropped = self._random.random() < self.chunk_failure_rate
+        if dropped:
+            # the server keeps some of the chunk before the connection drops
+            kept = len(request.body) // 2
+            session["received"] += (
+                kept // self.CHUNK_GRANULARITY * self.CHUNK_GRANULARITY
+            )
+            raise requests.ConnectionError("connection dropped mid-chunk")
+
+        session["received"] += len(request.body)
+        if "finalize" in command:
+            with self.lock:
+                session["token"] = f"token-{len(self.uploads)}"
+                self.uploads[session["token"]] = session["received"]
+
+        return self._response(request, 200, session["token"] or b"", "text/plain")
+
+    def mount(self, session: requests.Session) -> requests.Session:
+        # longer prefixes take precedence over the pooled https:// adapter
+        session.mount(f"https://{IMAGE_HOST}/", self)
+        session.mount(f"https://{PHOTOS_HOST}/", self)
+        return session
+
+    def close(self):
+        pass
+
+
+class FakeClientResponse:
+    def __init__(self, resp: requests.Response):
+        self.status = resp.status_code
+        self.headers = resp.headers
+        self._content = resp.content
+
+    async def read(self) -> bytes:
+        return self._content
+
+
+class FakeClientSession:
+    """An aiohttp.ClientSession stand-in, sending requests through an adapter."""
+
+    def __init__(self, adapter: FakeServiceAdapter, connector=None, **kwargs):
+        self.adapter = adapter
+        self.connector = connector
+
+    @contextlib.asynccontextmanager
+    async def request(
+        self, method: str, url: str, params=None, data=None, headers=None, **kwargs
+    ):
+        request = requests.Request(
+            method, url, params=params, data=data, headers=headers
+        ).prepare()
+        # the adapter sleeps to add latency, so keep it off the event loop
+        yield FakeClientResponse(await asyncio.to_thread(self.adapter.send, request))
+
+    async def close(self):
+        if self.connector is not None:
+            await self.connector.close()
+
+
+class FakeBlob:
+    # serialises the generation check and write of conditional uploads
+    lock = threading.Lock()
+
+    def __init__(self, bucket: "FakeBucket", name: str):
+        self.bucket = bucket
+        self.name = name
+        self.generation: Optional[int] = None
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.bucket.root, self.name)
+
+    def upload_from_file(self, buf, rewind=False, content_type=None, **kwargs):
+        if rewind:
+            buf.seek(0)
+        self.upload_from_string(buf.read(), content_type=content_type, **kwargs)
+
+    def _generation(self) -> int:
+        # like a real generation, the time the object was last written
+        return os.stat(self.path).st_mtime_ns if self.exists() else 0
+
+    def upload_from_string(
+        self, data, content_type=None, if_generation_match=None, **kwargs
+    ):
+        time.sleep(self.bucket.client.latency)
+        if isinstance(data, str):
+            data = data.encode()
+
+        with self.lock:
+            if if_generation_match is not None:
+                if if_generation_match != self._generation():
+                    raise PreconditionFailed(f"Generation mismatch: {self.name}")
+
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, "wb") as f:
+                f.write(data)
+            self.generation = self._generation()
+
+    def upload_from_filename(self, filename, **kwargs):
+        with open(filename, "rb") as f:
+            self.upload_from_file(f)
+
+    def download_as_bytes(self, **kwargs) -> bytes:
+        time.sleep(self.bucket.client.latency)
+        with self.lock:
+            if not self.exists():
+                raise NotFound(f"No such object: {self.bucket.name}/{self.name}")
+            with open(self.path, "rb") as f:
+                self.generation = self._generation()
+                return f.read()
+
+    def download_as_string(self, **kwargs) -> bytes:
+        return self.download_as_bytes()
+
+    def exists(self, **kwargs) -> bool:
+        return os.path.exists(self.path)
+
+
+class FakeBucket:
+    def __init__(self, client: "FakeStorageClient", name: str):
+        self.client = client
+        self.name = name
+        self.root = os.path.join(client.root, name)
+
+    def blob(self, name: str) -> FakeBlob:
+        return FakeBlob(self, name)
+
+
+class FakeStorageClient:
+    """A google.cloud.storage.Client stand-in backed by a local directory."""
+
+    def __init__(self, root: str, latency: float = 0.0):
+        self.root = root
+        self.latency = latency
+        self._http = requests.Session()
+
+    def bucket(self, name: str) -> FakeBucket:
+        return FakeBucket(self, name)
+
+    def get_bucket(self, name: str) -> FakeBucket:
+        time.sleep(self.latency)
+        return self.bucket(name)
+
+    def list_blobs(self, bucket, prefix: Optional[str] = None, **kwargs):
+        time.sleep(self.latency)
+        bucket = bucket if isinstance(bucket, FakeBucket) else self.bucket(bucket)
+
+        for dirpath, _, fnames in os.walk(bucket.root):
+            for fname in fnames:
+                name = os.path.relpath(os.path.join(dirpath, fname), bucket.root)
+                if prefix is None or name.startswith(prefix):
+                    yield FakeBlob(bucket, name)
@@ -0,0 +1,826 @@
+"""An asyncio execution engine for the DAG.
+
+Every network stage shares one aiohttp session on one event loop, limited by a
+global and a per-host semaphore, so a single process can keep hundreds of
+requests in flight without a thread per request. The async stages wrap their
+configured synchronous counterparts, sharing their settings, caches, journal
+and watermarks. Install with the `async` extra: `pip install twit2imgs[async]`.
+"""
+
+import asyncio
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor
+from typing import (
+    Any,
+    AsyncIterable,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+from urllib.parse import urlparse
+
+import google.auth
+from google.auth.transport.requests import Request
+from loguru import logger
+from urllib3.util.retry import Retry
+
+from twit2imgs import models
+from twit2imgs.google_photos_client import GooglePhotosClient
+from twit2imgs.journal import RunJournal
+from twit2imgs.metrics import metrics
+from twit2imgs.scraper import Scraper, TwitterScraper
+from twit2imgs.storer import GCPStore, Storer
+from twit2imgs.target import GooglePhotosTarget, Target, _render_job
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None  # type: ignore[assignment]
+
+# marks the end of a stream of tweets
+_DONE = object()
+
+
+async def _aiter(items: Union[Iterable, AsyncIterable]) -> AsyncIterator:
+    if hasattr(items, "__aiter__"):
+        async for item in items:
+            yield item
+    else:
+        for item in items:
+            yield item
+
+
+async def abounded_map(
+    fn: Callable[[Any], Awaitable],
+    items: Union[Iterable, AsyncIterable],
+    max_inflight: int,
+    ordered: bool = False,
+) -> AsyncIterator[Tuple[Any, asyncio.Future]]:
+    """The asyncio counterpart of `utils.bounded_map`.
+
+    Runs `fn` over `items` as tasks, at most `max_inflight` at a time, yielding
+    (item, task) as tasks finish, or in the order of `items` if `ordered`.
+    """
+    # insertion ordered, so the first task is the oldest
+    pending: Dict[asyncio.Future, Any] = {}
+
+    def _ready() -> List[asyncio.Future]:
+        if ordered:
+            return list(itertools.takewhile(lambda t: t.done(), pending))
+        return [t for t in pending if t.done()]
+
+    async def _wait():
+        await asyncio.wait(
+            [next(iter(pending))] if ordered else pending,
+            return_when=asyncio.FIRST_COMPLETED,
+        )
+
+    async for item in _aiter(items):
+        if len(pending) >= max_inflight:
+            await _wait()
+            for task in _ready():
+                yield pending.pop(task), task
+
+        pending[asyncio.ensure_future(fn(item))] = item
+
+        for task in _ready():
+            yield pending.pop(task), task
+
+    while pending:
+        await _wait()
+        for task in _ready():
+            yield pending.pop(task), task
+
+
+class AsyncHTTP:
+    """One aiohttp session for every stage, with global and per-host limits.
+
+    429s, 5xxs and failed connections are retried with jittered exponential
+    backoff, honouring Retry-After, as for `utils.pooled_session`. As there, a
+    5xx is only retried for idempotent methods, since a POST may have been
+    applied. Requests are recorded in the run metrics under the name given
+    with each request.
+    """
+
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(
+        self,
+        max_inflight: int = 256,
+        per_host: int = 64,
+        max_retries: int = 5,
+        backoff_factor: float = 0.5,
+        timeout: float = 300,
+    ):
+        if aiohttp is None:
+            raise ImportError(
+                "The async engine needs aiohttp: pip install twit2imgs[async]"
+            )
+
+        self.max_inflight = max_inflight
+        self.per_host = per_host
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+        self.session = None
+
+    async def __aenter__(self):
+        # semaphores are created on the running loop
+        self._limit = asyncio.Semaphore(self.max_inflight)
+        self._host_limits: Dict[str, asyncio.Semaphore] = {}
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=self.max_inflight, limit_per_host=self.per_host
+            ),
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+        )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    def _host_limit(self, host: str) -> asyncio.Semaphore:
+        if host not in self._host_limits:
+            self._host_limits[host] = asyncio.Semaphore(self.per_host)
+        return self._host_limits[host]
+
+    def _record(self, name: str, host: str, status: int, seconds: float, data, body):
+        metrics.incr(f"http.{name}.requests")
+        metrics.incr(f"http.{name}.status.{status}")
+        metrics.observe(f"http.{name}.latency", seconds)
+        metrics.observe(f"http.{name}.{host}.latency", seconds)
+        if isinstance(data, (bytes, str)):
+            metrics.incr(f"http.{name}.bytes_sent", len(data))
+        metrics.incr(f"http.{name}.bytes_received", len(body))
+
+    def _should_retry(self, method: str, status: int) -> bool:
+        if status == 429:
+            return True
+        return (
+            status in self.RETRY_STATUSES
+            and method.upper() in Retry.DEFAULT_ALLOWED_METHODS
+        )
+
+    def _backoff(self, attempt: int, headers) -> float:
+        retry_after = headers.get("Retry-After", "") if headers else ""
+        if retry_after.isdigit():
+            return float(retry_after)
+        return random.uniform(0, self.backoff_factor * 2**attempt)
+
+    async def request(
+        self, method: str, url: str, name: str, **kwargs
+    ) -> Tuple[int, dict, bytes]:
+        """Make a request, returning its status, headers and body."""
+        assert self.session is not None, "AsyncHTTP is used as a context manager"
+        host = urlparse(url).netloc
+
+        attempt = 0
+        while True:
+            status: Optional[int] = None
+            headers: dict = {}
+            async with self._limit, self._host_limit(host):
+                start = time.perf_counter()
+                try:
+                    async with self.session.request(method, url, **kwargs) as resp:
+                        body = await resp.read()
+                        status, headers = resp.status, dict(resp.headers)
+                except aiohttp.ClientConnectorError:
+                    # only failures to connect, as a request cut off later may
+                    # have been applied
+                    if attempt == self.max_retries:
+                        raise
+
+            if status is not None:
+                seconds = time.perf_counter() - start
+                self._record(name, host, status, seconds, kwargs.get("data"), body)
+                if (
+                    not self._should_retry(method, status)
+                    or attempt == self.max_retries
+                ):
+                    return status, headers, body
+
+            await asyncio.sleep(self._backoff(attempt, headers))
+            attempt += 1
+
+
+class AsyncCredentials:
+    """Bearer tokens from google-auth credentials, refreshed off the event loop."""
+
+    def __init__(self, credentials):
+        self.credentials = credentials
+        self._lock = None
+
+    async def headers(self) -> dict:
+        if self.credentials is None:
+            return {}
+
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if not self.credentials.valid:
+                await asyncio.to_thread(self.credentials.refresh, Request())
+
+        return {"Authorization": f"Bearer {self.credentials.token}"}
+
+
+class AsyncScraper(ABC):
+    journal: Optional[RunJournal] = None
+
+    @abstractmethod
+    def aiter_scrape(self) -> AsyncIterator[models.Tweet]:
+        pass
+
+    def commit(self):
+        pass
+
+
+class AsyncStorer(ABC):
+    journal: Optional[RunJournal] = None
+
+    @abstractmethod
+    def aiter_store(
+        self, tweets: AsyncIterator[models.Tweet]
+    ) -> AsyncIterator[models.Tweet]:
+        pass
+
+    def summary(self) -> dict:
+        return {}
+
+
+class AsyncTarget(ABC):
+    name: str = ""
+    journal: Optional[RunJournal] = None
+
+    @abstractmethod
+    async def preprocess(self):
+        pass
+
+    @abstractmethod
+    async def post_tweets(self, tweets: AsyncIterator[models.Tweet]):
+        pass
+
+    @abstractmethod
+    async def postprocess(self):
+        pass
+
+
+class AsyncTwitterScraper(AsyncScraper):
+    """Fetch a TwitterScraper's images on the event loop.
+
+    The few paginated API calls listing each source still run on the sync
+    scraper's threads, with its rate-limit scheduling and watermarks.
+    """
+
+    def __init__(self, scraper: TwitterScraper, http: AsyncHTTP):
+        self.scraper = scraper
+        self.http = http
+        self.journal = scraper.journal
+
+    async def _fetch(self, ttweet, img_urls) -> bytes:
+        url = models.Tweet.get_image_url(ttweet, img_urls)
+        cache = self.scraper.cache
+
+        # the cache and journal are on local disk, so keep them off the event loop
+        with metrics.timer("scraper.fetch"):
+            content = None
+            if cache is not None:
+                content = await asyncio.to_thread(cache.get, url)
+            if content is None:
+                status, _, content = await self.http.request("GET", url, "images")
+                if status != 200:
+                    raise RuntimeError(f"Could not fetch {url}: status {status}")
+                if cache is not None:
+                    await asyncio.to_thread(cache.put, url, content, tweet_id=ttweet.id)
+
+        if self.journal is not None:
+            await asyncio.to_thread(
+                self.journal.record, ttweet.id, "downloaded", n_bytes=len(content)
+            )
+
+        return content
+
+    async def aiter_scrape(self) -> AsyncIterator[models.Tweet]:
+        ttweets, img_urls, tweet_sources = await asyncio.to_thread(
+            self.scraper._scrape_sources
+        )
+
+        # tweets finished with by a previous run don't need their images
+        complete = {
+            t.id
+            for t in ttweets
+            if self.journal is not None and self.journal.complete(t.id)
+        }
+
+        async def _fetch(ttweet) -> Optional[bytes]:
+            if ttweet.id in complete:
+                return None
+            return await self._fetch(ttweet, img_urls)
+
+        async for ttweet, task in abounded_map(
+            _fetch, ttweets, self.http.max_inflight, ordered=True
+        ):
+            if ttweet.id in complete:
+                tweet = models.Tweet(ttweet, img_urls, fetch=False)
+            else:
+                tweet = models.Tweet(ttweet, img_urls, image_bytes=task.result())
+            self.scraper._mark(tweet, tweet_sources[tweet.id])
+            yield tweet
+
+        if self.scraper.cache is not None:
+            await asyncio.to_thread(self.scraper.cache.flush)
+
+    def commit(self):
+        self.scraper.commit()
+
+
+class AsyncGCPStore(AsyncStorer):
+    """Store a GCPStore's images and records with the storage JSON API."""
+
+    UPLOAD_URL = "https://storage.googleapis.com/upload/storage/v1/b/{bucket}/o"
+    SCOPES = ["https://www.googleapis.com/auth/devstorage.read_write"]
+
+    def __init__(self, store: GCPStore, http: AsyncHTTP):
+        self.store = store
+        self.http = http
+        self.journal = store.journal
+        self.credentials = AsyncCredentials(google.auth.default(scopes=self.SCOPES)[0])
+
+    async def _upload(self, data: bytes, name: str, content_type: Optional[str]):
+        headers = await self.credentials.headers()
+        headers["Content-Type"] = content_type or "application/octet-stream"
+
+        with metrics.timer("storer.upload"):
+            status, _, body = await self.http.request(
+                "POST",
+                self.UPLOAD_URL.format(bucket=self.store.bucket),
+                "gcs",
+                params=dict(uploadType="media", name=name),
+                data=data,
+                headers=headers,
+            )
+        if status != 200:
+            raise RuntimeError(
+                f"Could not upload gs://{self.store.bucket}/{name}: "
+                f"status {status} {body[:200]!r}"
+            )
+        metrics.incr("storer.bytes_uploaded", len(data))
+
+    async def _store_tweet(self, tweet, store_image, store_record) -> int:
+        # encoding is cpu-bound, so keep it off the event loop
+        blobs, n_bytes = await asyncio.to_thread(
+            self.store._blobs, tweet, store_image, store_record
+        )
+        for name, data, content_type in blobs:
+            await self._upload(data, name, content_type)
+
+        return n_bytes
+
+    async def aiter_store(
+        self, tweets: AsyncIterator[models.Tweet]
+    ) -> AsyncIterator[models.Tweet]:
+        # the stats are kept on the sync store, so its summary covers async runs
+        store = self.store
+        image_ids, record_ids = await asyncio.to_thread(store._begin)
+
+        async def _store_job(tweet):
+            store_image, store_record = store._to_store(tweet, image_ids, record_ids)
+            n_bytes = await self._store_tweet(tweet, store_image, store_record)
+            await asyncio.to_thread(store._journal_stored, tweet)
+
+            return n_bytes, store_image or store_record
+
+        try:
+            async for tweet, task in abounded_map(
+                _store_job, tweets, 2 * store.max_workers, ordered=True
+            ):
+                store._count(*task.result())
+                tweet.release("storer")
+                yield tweet
+        finally:
+            if store.records == "manifest":
+                await asyncio.to_thread(store._write_manifest)
+
+        store._log_stats()
+
+    def summary(self) -> dict:
+        return self.store.summary()
+
+
+class AsyncGooglePhotosClient:
+    """The upload, listing and removal calls of a GooglePhotosClient, on asyncio.
+
+    Shares the sync client's credentials, limits and listing cache. Photos are
+    uploaded in single requests, whatever the sync client's `chunk_size`.
+    """
+
+    API_URL = "https://photoslibrary.googleapis.com/v1"
+
+    def __init__(self, client: GooglePhotosClient, http: AsyncHTTP):
+        self.client = client
+        self.http = http
+        self.credentials = AsyncCredentials(
+            getattr(client.session, "credentials", None)
+        )
+
+    async def _post(self, path: str, data, timer: str, **headers):
+        # every request but uploads sends json
+        headers.setdefault("Content-type", "application/json")
+        headers.update(await self.credentials.headers())
+        with metrics.timer(timer):
+            status, _, body = await self.http.request(
+                "POST", f"{self.API_URL}/{path}", "photos", data=data, headers=headers
+            )
+        return status, body
+
+    async def _get_mediaitems(self, album_id: str) -> AsyncIterator[dict]:
+        params = {"pageSize": 100, "albumId": album_id}
+        while True:
+            status, body = await self._post(
+                "mediaItems:search", json.dumps(params), "photos.list"
+            )
+            resp = json.loads(body) if status == 200 else {}
+
+            items = resp.get("mediaItems", [])
+            for item in items:
+                yield item
+
+            if not items or "nextPageToken" not in resp:
+                return
+            params["pageToken"] = resp["nextPageToken"]
+
+    async def get_album_items(self, album_id: str) -> List[dict]:
+        cache = self.client.cache
+        key = f"items:{album_id}"
+        if cache is not None and cache.get(key) is not None:
+            return cache.get(key)
+
+        items = [
+            dict(id=item["id"], description=item.get("description", ""))
+            async for item in self._get_mediaitems(album_id)
+        ]
+        if cache is not None:
+            await asyncio.to_thread(cache.put, key, items)
+
+        return items
+
+    async def _remove_batch(self, album_id: str, media_item_ids: List[str]) -> int:
+        status, body = await self._post(
+            f"albums/{album_id}:batchRemoveMediaItems",
+            json.dumps({"mediaItemIds": media_item_ids}),
+            "photos.batch_remove",
+        )
+        if status == 200:
+            await asyncio.to_thread(
+                self.client._update_album_items, album_id, removed=media_item_ids
+            )
+        else:
+            logger.error(f"Could not remove {len(media_item_ids)} items: {body!r}")
+
+        return status
+
+    async def _remove_batches(
+        self, album_id: str, media_item_ids: Union[Iterable[str], AsyncIterable[str]]
+    ) -> List[dict]:
+        async def _chunks():
+            chunk = []
+            async for media_item_id in _aiter(media_item_ids):
+                chunk.append(media_item_id)
+                if len(chunk) == self.client.BATCH_REMOVE_LIMIT:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+
+        async def _batches():
+            ii = 0
+            async for chunk in _chunks():
+                yield ii, chunk
+                ii += 1
+
+        results = []
+        async for (ii, batch), task in abounded_map(
+            lambda job: self._remove_batch(album_id, job[1]),
+            _batches(),
+            self.http.per_host,
+        ):
+            results.append(dict(batch=ii, n_items=len(batch), status=task.result()))
+
+        return sorted(results, key=lambda result: result["batch"])
+
+    async def remove_mediaitems(self, album_id: str, media_item_ids: List[str]):
+        return await self._remove_batches(album_id, media_item_ids)
+
+    async def clear_album(self, album_id: str) -> List[dict]:
+        """As `GooglePhotosClient.clear_album`, removing batches as pages arrive."""
+        results = []
+        while True:
+            passed = await self._remove_batches(
+                album_id,
+                (item["id"] async for item in self._get_mediaitems(album_id)),
+            )
+            results += passed
+            if not any(r["status"] == 200 for r in passed):
+                break
+
+        await asyncio.to_thread(self.client._cleared, album_id, results, passed)
+
+        return results
+
+    async def _upload_bytes(self, photo_bytes: bytes, fname: str) -> Optional[str]:
+        status, body = await self._post(
+            "uploads",
+            photo_bytes,
+            "photos.upload",
+            **{
+                "Content-type": "application/octet-stream",
+                "X-Goog-Upload-Protocol": "raw",
+                "X-Goog-Upload-File-Name": fname,
+            },
+        )
+        if status == 200 and body:
+            return body.decode()
+
+        logger.error(f"Could not upload '{fname}': status {status}")
+        return None
+
+    async def _batch_create(self, album_id: str, items: List[dict]) -> List[dict]:
+        status, body = await self._post(
+            "mediaItems:batchCreate",
+            self.client._create_body(album_id, items),
+            "photos.batch_create",
+        )
+        resp = json.loads(body) if status == 200 else {"error": body}
+
+        return self.client._created_items(resp, items)
+
+    async def upload_photos(
+        self,
+        album_id: str,
+        photos: AsyncIterable[Tuple[bytes, str]],
+        upload_tokens: Iterable[Tuple[str, str]] = (),
+        on_upload: Optional[Callable[[str, str], None]] = None,
+        on_create: Optional[Callable[[dict], None]] = None,
+    ) -> List[dict]:
+        """As `GooglePhotosClient.upload_photos`, for an async stream of photos."""
+
+        async def _upload(job):
+            ii, (photo_bytes, _) = job
+            return await self._upload_bytes(photo_bytes, f"upload_photo_{ii}")
+
+        async def _numbered():
+            ii = 0
+            async for photo in photos:
+                yield ii, photo
+                ii += 1
+
+        items = self.client._uploaded_items(upload_tokens)
+        async for (ii, (_, description)), task in abounded_map(
+            _upload, _numbered(), self.http.per_host
+        ):
+            upload_token = task.result()
+            if upload_token is not None:
+                items.append(self.client._uploaded_item(ii, description, upload_token))
+                if on_upload is not None:
+                    await asyncio.to_thread(on_upload, description, upload_token)
+
+        created = []
+        for batch in self.client._create_batches(items):
+            batch = await self._batch_create(album_id, batch)
+            # the listing cache and journal are on local disk
+            await asyncio.to_thread(self.client._created, album_id, batch, on_create)
+            created += batch
+
+        return created
+
+
+class AsyncGooglePhotosTarget(AsyncTarget):
+    """Post a GooglePhotosTarget's tweets with the async Photos client.
+
+    Rendering still runs on a process pool, awaited from the event loop.
+    """
+
+    def __init__(self, target: GooglePhotosTarget, http: AsyncHTTP):
+        self.target = target
+        self.name = target.name
+        self.journal = target.journal
+        self.client = AsyncGooglePhotosClient(target.client, http)
+        self.http = http
+
+    async def preprocess(self):
+        target = self.target
+        if not target.sync:
+            if target._resuming():
+                logger.info("Resuming uploads, not clearing the album")
+            else:
+                await self.client.clear_album(target.album_id)
+            return
+
+        target._map_album(await self.client.get_album_items(target.album_id))
+
+    async def _render(self, tweets: AsyncIterator[models.Tweet]):
+        ctx = multiprocessing.get_context("spawn")
+        n_workers = self.target.render_workers or os.cpu_count() or 1
+        loop = asyncio.get_running_loop()
+
+        with ProcessPoolExecutor(n_workers, mp_context=ctx) as pool:
+
+            async def _render_one(tweet):
+                return await loop.run_in_executor(
+                    pool, _render_job, self.target._render_args(tweet)
+                )
+
+            async for tweet, task in abounded_map(
+                _render_one, tweets, 2 * n_workers, ordered=True
+            ):
+                tweet.release(self.name)
+                # journalled to local disk, so kept off the event loop
+                yield await asyncio.to_thread(
+                    self.target._rendered, tweet.id, *task.result()
+                )
+
+    async def post_tweets(self, tweets: AsyncIterator[models.Tweet]):
+        target = self.target
+        desired: set = set()
+        pending = target._pending_uploads()
+
+        created = await self.client.upload_photos(
+            target.album_id,
+            self._render(t async for t in tweets if target._admit(t, pending, desired)),
+            **target._upload_kwargs(pending),
+        )
+
+        if target.sync:
+            stale = target._sync_removals(created, desired)
+            if stale:
+                await self.client.remove_mediaitems(target.album_id, stale)
+
+    async def postprocess(self):
+        await asyncio.to_thread(self.target.postprocess)
+
+
+# the async stage wrapping each sync stage
+ASYNC_STAGES = {
+    TwitterScraper: AsyncTwitterScraper,
+    GCPStore: AsyncGCPStore,
+    GooglePhotosTarget: AsyncGooglePhotosTarget,
+}
+
+
+def as_async(stage: Union[Scraper, Storer, Target], http: AsyncHTTP):
+    for cls, async_cls in ASYNC_STAGES.items():
+        if isinstance(stage, cls):
+            return async_cls(stage, http)
+
+    raise TypeError(f"No async engine for {type(stage).__name__}")
+
+
+class AsyncPipeline:
+    """The asyncio counterpart of `pipeline.Pipeline`.
+
+    The scraper and storer are chained async generators, fanning out to a
+    bounded queue per target. A failing or timed-out target is dropped from the
+    fan-out without affecting the others, whereas a failure in the scraper or
+    storer cancels every target.
+    """
+
+    def __init__(
+        self,
+        scraper: AsyncScraper,
+        storer: Optional[AsyncStorer],
+        targets: Dict[str, AsyncTarget],
+        queue_size: int = 8,
+        timeouts: Optional[Dict[str, Optional[float]]] = None,
+    ):
+        self.scraper = scraper
+        self.storer = storer
+        self.targets = targets
+        self.queue_size = queue_size
+        self.timeouts = timeouts or {}
+
+        self.n_scraped = 0
+        self.n_new = 0
+        self.target_results: Dict[str, dict] = {}
+
+    @staticmethod
+    async def _timed(name: str, items: AsyncIterator) -> AsyncIterator:
+        start = time.perf_counter()
+        async for item in items:
+            yield item
+        metrics.observe(f"stage.{name}", time.perf_counter() - start)
+
+    @staticmethod
+    async def _iter_queue(q: asyncio.Queue) -> AsyncIterator[models.Tweet]:
+        while True:
+            item = await q.get()
+            if item is _DONE:
+                return
+            yield item
+
+    async def _run_target(self, key: str, target: AsyncTarget, q: asyncio.Queue):
+        async def _run():
+            await target.preprocess()
+            await target.post_tweets(self._iter_queue(q))
+            await target.postprocess()
+
+        start = time.time()
+        try:
+            await asyncio.wait_for(_run(), self.timeouts.get(key))
+            status, error = "ok", None
+        except asyncio.TimeoutError:
+            logger.error(f"Target {key} timed out after {self.timeouts.get(key)}s")
+            status, error = "timeout", None
+        except asyncio.CancelledError:
+            status, error = "cancelled", None
+        except Exception as e:
+            logger.error(f"Target {key} failed: {e!r}")
+            status, error = "failed", repr(e)
+
+        duration = time.time() - start
+        metrics.observe(f"stage.target.{key}", duration)
+        result = dict(status=status, duration=round(duration, 2))
+        if error is not None:
+            result["error"] = error
+
+        return result
+
+    async def _put(self, q: asyncio.Queue, item, task: asyncio.Task):
+        # targets that have failed or timed out stop receiving tweets
+        if task.done():
+            return
+        put = asyncio.ensure_future(q.put(item))
+        await asyncio.wait({put, task}, return_when=asyncio.FIRST_COMPLETED)
+        if not put.done():
+            put.cancel()
+
+    async def _scraped(self) -> AsyncIterator[models.Tweet]:
+        async for tweet in self._timed("scraper", self.scraper.aiter_scrape()):
+            self.n_scraped += 1
+            self.n_new += tweet.is_new
+            yield tweet
+
+    async def run(self):
+        queues = {key: asyncio.Queue(maxsize=self.queue_size) for key in self.targets}
+        tasks = {
+            key: asyncio.ensure_future(self._run_target(key, target, queues[key]))
+            for key, target in self.targets.items()
+        }
+
+        tweets = self._scraped()
+        if self.storer is not None:
+            tweets = self._timed("storer", self.storer.aiter_store(tweets))
+
+        try:
+            async for tweet in tweets:
+                for key, q in queues.items():
+                    await self._put(q, tweet, tasks[key])
+            for key, q in queues.items():
+                await self._put(q, _DONE, tasks[key])
+        except BaseException as e:
+            for task in tasks.values():
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            raise RuntimeError("Async pipeline failed") from e
+
+        self.target_results = dict(zip(tasks, await asyncio.gather(*tasks.values())))
+
+
+def run_async(
+    scraper: Scraper,
+    storer: Optional[Storer],
+    targets: Dict[str, Target],
+    queue_size: int = 8,
+    timeouts: Optional[Dict[str, Optional[float]]] = None,
+    **http_params,
+) -> AsyncPipeline:
+    """Run the DAG's stages on one event loop, returning the finished pipeline.
+
+    `http_params` configure the shared AsyncHTTP session, e.g. `max_inflight`
+    and `per_host`.
+    """
+
+    async def _run():
+        async with AsyncHTTP(**http_params) as http:
+            pipeline = AsyncPipeline(
+                as_async(scraper, http),
+                as_async(storer, http) if storer is not None else None,
+                {key: as_async(target, http) for key, target in targets.items()},
+                queue_size=queue_size,
+                timeouts=timeouts,
+            )
+            await pipeline.run()
+
+        return pipeline
+
+    return asyncio.run(_run())
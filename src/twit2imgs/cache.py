@@ -0,0 +1,204 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Optional
+
+from loguru import logger
+
+
+class ImageCache:
+    """An on-disk, content-addressed cache of raw image bytes with LRU eviction.
+
+    Images are stored as `{cache_dir}/{sha256(url)}` and tracked in an index file
+    recording the tweet id, size and last use of each entry.
+    """
+
+    INDEX_FILE = "index.json"
+
+    def __init__(self, cache_dir: str, max_bytes: int = 2 * 1024**3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index = self._load_index()
+
+    @staticmethod
+    def key(url: str) -> str:
+        return hashlib.sha256(url.encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key)
+
+    def _load_index(self) -> dict:
+        index_path = os.path.join(self.cache_dir, self.INDEX_FILE)
+        if not os.path.exists(index_path):
+            return {}
+
+        try:
+            index = json.load(open(index_path))
+        except ValueError:
+            logger.warning(f"Discarding corrupt image cache index at {index_path}")
+            return {}
+
+        # drop any entries whose blobs have gone missing
+        return {k: v for k, v in index.items() if os.path.exists(self._path(k))}
+
+    def _save_index(self):
+        index_path = os.path.join(self.cache_dir, self.INDEX_FILE)
+        tmp_path = index_path + ".tmp"
+        json.dump(self.index, open(tmp_path, "w"))
+        os.replace(tmp_path, index_path)
+
+    def get(self, url: str) -> Optional[bytes]:
+        key = self.key(url)
+
+        with self._lock:
+            if key not in self.index:
+                self.misses += 1
+                return None
+
+            try:
+                with open(self._path(key), "rb") as f:
+                    content = f.read()
+            except OSError:
+                del self.index[key]
+                self.misses += 1
+                return None
+
+            self.index[key]["last_used"] = time.time()
+            self.hits += 1
+
+            return content
+
+    def put(self, url: str, content: bytes, tweet_id: Optional[str] = None):
+        key = self.key(url)
+
+        with self._lock:
+            tmp_path = self._path(key) + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(content)
+            os.replace(tmp_path, self._path(key))
+
+            self.index[key] = dict(
+                url=url,
+                tweet_id=str(tweet_id) if tweet_id is not None else None,
+                size=len(content),
+                last_used=time.time(),
+            )
+
+            self._evict()
+            self._save_index()
+
+    def _evict(self):
+        total = sum(v["size"] for v in self.index.values())
+
+        for key in sorted(self.index, key=lambda k: self.index[k]["last_used"]):
+            if total <= self.max_bytes:
+                break
+
+            total -= self.index.pop(key)["size"]
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def tweet_ids(self) -> set:
+        with self._lock:
+            return {v["tweet_id"] for v in self.index.values() if v["tweet_id"]}
+
+    def flush(self):
+        with self._lock:
+            self._save_index()
+
+        logger.info(
+            f"Image cache: {self.hits} hits, {self.misses} misses, "
+            f"{len(self.index)} entries"
+        )
+
+
+class TTLCache:
+    """A small json file of values which expire `ttl` seconds after being set.
+
+    Used for slowly-changing API metadata, such as album ids and listings. If
+    the file can't be read or written, e.g. on a read-only filesystem, values are
+    only kept in memory for the run.
+    """
+
+    def __init__(self, path: str, ttl: float = 24 * 3600):
+        self.path = path
+        self.ttl = ttl
+        self.persistent = True
+        self._lock = threading.Lock()
+
+        try:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.entries = self._load()
+        except OSError as e:
+            self._disable(e)
+            self.entries = {}
+
+    def _disable(self, error: OSError):
+        logger.warning(
+            f"Cannot use the cache at {self.path}, keeping it in memory: {error!r}"
+        )
+        self.persistent = False
+
+    def _load(self) -> dict:
+        if not os.path.exists(self.path):
+            return {}
+
+        try:
+            return json.load(open(self.path))
+        except ValueError:
+            logger.warning(f"Discarding corrupt cache at {self.path}")
+            return {}
+
+    def _save(self):
+        if not self.persistent:
+            return
+
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(self.entries, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            self._disable(e)
+
+    def get(self, key: str):
+        """The value of `key`, or None if it is missing or has expired."""
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None or time.time() - entry["time"] > self.ttl:
+                return None
+
+            return entry["value"]
+
+    def put(self, key: str, value, refresh: bool = True):
+        """Set `key`, restarting its ttl unless `refresh` is False."""
+        with self._lock:
+            entry = self.entries.get(key)
+            now = time.time()
+            if not refresh and entry is not None:
+                now = entry["time"]
+            self.entries[key] = dict(value=value, time=now)
+            self._save()
+
+    def update(self, values: dict):
+        with self._lock:
+            now = time.time()
+            self.entries.update(
+                {key: dict(value=value, time=now) for key, value in values.items()}
+            )
+            self._save()
+
+    def invalidate(self, key: str):
+        with self._lock:
+            if self.entries.pop(key, None) is not None:
+                self._save()
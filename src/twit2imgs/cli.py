@@ -1,5 +1,5 @@
+import json
 import os
-import shutil
 import sys
 
 import click
@@ -8,6 +8,10 @@ from dotmap import DotMap
 from loguru import logger
 
 from twit2imgs import utils
+from twit2imgs.aio import run_async
+from twit2imgs.journal import RunJournal
+from twit2imgs.metrics import metrics
+from twit2imgs.pipeline import Pipeline, run_targets
 from twit2imgs.slackbot import SlackBot
 
 logger.remove()
@@ -20,6 +24,18 @@ def parse_cfg(cfg: dict) -> dict:
     return DotMap(cfg)
 
 
+def report_metrics(cfg: DotMap) -> dict:
+    """Log the run's metrics as json, optionally writing them to file too."""
+    logger.info(f"metrics: {json.dumps(metrics.report())}")
+
+    if cfg.metrics.get("json_path"):
+        metrics.write_json(cfg.metrics.json_path)
+    if cfg.metrics.get("prometheus_path"):
+        metrics.write_prometheus(cfg.metrics.prometheus_path)
+
+    return metrics.summary()
+
+
 @click.group()
 def cli():
     pass
@@ -27,11 +43,13 @@ def cli():
 
 @cli.command()
 @click.argument("conf_path")
-def DAG(conf_path):
-    # set up tmp dir
-    if not os.path.exists("tmp"):
-        os.makedirs("tmp/")
-
+@click.option(
+    "--resume",
+    is_flag=True,
+    default=False,
+    help="Skip the work journalled as done by a previous, failed run.",
+)
+def DAG(conf_path, resume=False):
     slack_token = os.environ.get("SLACKBOT_TOKEN")
     slack_channel = os.environ.get("SLACKBOT_CHANNEL")
     if slack_token is not None and slack_channel is not None:
@@ -40,6 +58,8 @@ def DAG(conf_path):
         slackbot = None
 
     msg = {}
+    failed_targets = {}
+    metrics.reset()
 
     # run the DAG, optionally logging errors to Slack
     try:
@@ -48,42 +68,136 @@ def DAG(conf_path):
         cfg = yaml.load(open(f"conf/{conf_path}.yaml"), Loader=yaml.SafeLoader)
         cfg = parse_cfg(cfg)
 
-        # scrape tweets
-        logger.info("scraping tweets")
         scraper = utils._indirect_cls(cfg.scraper.cls)(**cfg.scraper.params)
-        tweets = scraper.scrape()
-        logger.info(f"Got {len(tweets)} tweets")
-        msg["scraped_tweets"] = len(tweets)
-
-        # store tweet records and images to cloud
-        logger.info("storing tweets")
         storer = utils._indirect_cls(cfg.storer.cls)(**cfg.storer.params)
+        targets = {
+            target_key: utils._indirect_cls(target_params.cls)(**target_params.params)
+            for target_key, target_params in cfg.targets.items()
+        }
+        # an incremental scraper only yields new tweets, which would empty the
+        # albums of targets that replace their contents with the tweets posted
+        if getattr(scraper, "incremental", False):
+            replacing = [k for k, t in targets.items() if t.needs_all_tweets]
+            if replacing:
+                raise ValueError(
+                    f"Targets {replacing} need every tweet, so can't be used with "
+                    "an incremental scraper; set a watermark_path without "
+                    "incremental to flag new tweets instead"
+                )
+
+        timeouts = {
+            target_key: target_params.get("timeout")
+            for target_key, target_params in cfg.targets.items()
+        }
+
+        for target_key, target in targets.items():
+            target.name = target_key
+            target.failed_sources = getattr(scraper, "failed_sources", [])
+
+        # optionally journal each tweet's completed stages to local disk, so a
+        # failed run can be resumed
+        journal = None
+        if cfg.journal.get("enabled"):
+            journal = RunJournal(
+                cfg.journal.get("path", f"journal/{conf_path}.jsonl"), resume=resume
+            )
+            scraper.journal = journal
+            if storer is not None:
+                storer.journal = journal
+                if storer.journals_stored:
+                    journal.required.append("stored")
+            for target_key, target in targets.items():
+                target.journal = journal
+                journal.required.append(f"{target_key}.created")
+        elif resume:
+            raise ValueError("--resume needs the journal enabled in the config")
+
+        if cfg.pipeline.get("max_inflight_bytes") and not (
+            cfg.pipeline.get("streaming") and cfg.pipeline.get("engine") != "async"
+        ):
+            logger.warning(
+                "max_inflight_bytes is only enforced by the streaming engine"
+            )
+
+        if cfg.pipeline.get("engine") == "async":
+            # every network stage on one event loop
+            logger.info("running async pipeline")
+            pipeline = run_async(
+                scraper,
+                storer,
+                targets,
+                queue_size=cfg.pipeline.get("queue_size", 8),
+                timeouts=timeouts,
+                **cfg.pipeline.get("http", {}),
+            )
+            n_tweets, n_new = pipeline.n_scraped, pipeline.n_new
+            target_results = pipeline.target_results
+        elif cfg.pipeline.get("streaming", False):
+            # overlap scraping, storing and posting tweets
+            logger.info("running streaming pipeline")
+            pipeline = Pipeline(
+                scraper,
+                storer,
+                targets,
+                queue_size=cfg.pipeline.get("queue_size", 8),
+                timeouts=timeouts,
+                max_inflight_bytes=cfg.pipeline.get("max_inflight_bytes"),
+            )
+            pipeline.run()
+            n_tweets, n_new = pipeline.n_scraped, pipeline.n_new
+            target_results = pipeline.target_results
+        else:
+            # scrape tweets
+            logger.info("scraping tweets")
+            with metrics.timer("stage.scraper"):
+                tweets = scraper.scrape()
+            n_tweets, n_new = len(tweets), sum(t.is_new for t in tweets)
+
+            # store tweet records and images to cloud
+            logger.info("storing tweets")
+            if storer is not None:
+                with metrics.timer("stage.storer"):
+                    storer.store(tweets)
+
+            # for each target, concurrently: preprocess, post_tweets, postprocess
+            logger.info(f"updating targets: {list(targets)}")
+            target_results = run_targets(targets, tweets, timeouts)
+
+        logger.info(f"Got {n_tweets} tweets, {n_new} new")
+        msg["scraped_tweets"] = n_tweets
+        msg["new_tweets"] = n_new
+        if getattr(scraper, "failed_sources", None):
+            msg["failed_sources"] = scraper.failed_sources
         if storer is not None:
-            storer.store(tweets)
             msg["storer"] = cfg.storer.cls.split(".")[-1]
-
-        # for each target: preprocess, post_tweets, postprocess
-        msg["targets"] = []
-        for target_key, target_params in cfg.targets.items():
-            logger.info(f"updating target: {target_key}")
-            target = utils._indirect_cls(target_params.cls)(**target_params.params)
-            target.preprocess()
-            target.post_tweets(tweets)
-            target.postprocess()
-            msg["targets"].append(target_key)
-
-        # cleanup
-        shutil.rmtree("tmp/")
-        os.makedirs("tmp/")
+            msg.update({f"storer_{k}": v for k, v in storer.summary().items()})
+        msg["targets"] = target_results
+        failed_targets = {
+            key: result
+            for key, result in target_results.items()
+            if result["status"] != "ok"
+        }
+
+        # only advance the scrape watermark once everything downstream succeeded
+        if not failed_targets:
+            scraper.commit()
+            if journal is not None:
+                journal.clear()
+
+        msg["metrics"] = report_metrics(cfg)
 
         if slackbot is not None:
             slackbot.post(msg)
     except Exception as e:
         if slackbot is not None:
-            msg = {"ERROR": repr(e), "MESSAGE": str(e)}
+            msg = {"ERROR": repr(e), "MESSAGE": str(e), "metrics": metrics.summary()}
             slackbot.post(msg)
         raise e
 
+    # reported to Slack above, but the run still failed
+    if failed_targets:
+        raise RuntimeError(f"Targets failed: {failed_targets}")
+
     return 200
 
 
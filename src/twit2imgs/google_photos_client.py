@@ -1,14 +1,35 @@
+import io
+import itertools
 import json
 import logging
-import os.path
-from typing import List, Optional, Union
-
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    Any,
+    BinaryIO,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+
+import requests
 from dotmap import DotMap
 from google.auth.transport.requests import AuthorizedSession
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from PIL import Image
 
+from twit2imgs import utils
+from twit2imgs.cache import TTLCache
+from twit2imgs.image_utils import encode_image
+from twit2imgs.metrics import metrics
+
 # https://github.com/eshmu/gphotos-upload
 
 
@@ -33,12 +54,25 @@ def save_cred(cred, auth_file):
 
 
 class GooglePhotosClient:
+    # the most newMediaItems the API accepts in one mediaItems:batchCreate call
+    BATCH_CREATE_LIMIT = 50
+    # the most mediaItemIds the API accepts in one batchRemoveMediaItems call
+    BATCH_REMOVE_LIMIT = 50
+    UPLOADS_URL = "https://photoslibrary.googleapis.com/v1/uploads"
+
     def __init__(
         self,
         scopes: List[str],
         scoped_credentials_file: str,
         client_params: dict,
         client_file: Optional[str] = None,
+        max_workers: int = 8,
+        chunk_size: Optional[int] = None,
+        max_chunk_retries: int = 5,
+        max_retries: int = 5,
+        backoff_factor: float = 0.5,
+        cache_path: Optional[str] = None,
+        cache_ttl: float = 24 * 3600,
     ):
         self.scopes = scopes
 
@@ -48,7 +82,21 @@ class GooglePhotosClient:
         self.scoped_credentials_file = scoped_credentials_file
         self.client_file = client_file
 
-        self.session = self._get_authorized_session()
+        self.max_workers = max_workers
+        # photos larger than chunk_size are sent with the resumable protocol
+        self.chunk_size = chunk_size
+        self.max_chunk_retries = max_chunk_retries
+        # keep-alive connections for every worker, retrying 429s and 5xxs
+        self.session = utils.pooled_session(
+            max_workers,
+            session=self._get_authorized_session(),
+            retries=max_retries,
+            backoff_factor=backoff_factor,
+        )
+        metrics.instrument_session(self.session, "photos")
+
+        # album ids by title, and the last-known media items of each album
+        self.cache = TTLCache(cache_path, cache_ttl) if cache_path else None
 
     def _auth(self):
         flow = InstalledAppFlow.from_client_secrets_file(
@@ -113,11 +161,61 @@ class GooglePhotosClient:
                 return
 
     def _get_album_id(self, album_name):
+        key = f"album:{album_name.lower()}"
+        if self.cache is not None and self.cache.get(key) is not None:
+            return self.cache.get(key)
+
+        seen = {}
         for a in self._get_albums():
+            seen[f"album:{a['title'].lower()}"] = a["id"]
             if a["title"].lower() == album_name.lower():
-                album_id = a["id"]
-
-                return album_id
+                break
+
+        # cache every album paged through on the way
+        if self.cache is not None and seen:
+            self.cache.update(seen)
+
+        return seen.get(key)
+
+    def get_album_items(self, album_id) -> List[dict]:
+        """The id and description of each item in an album, cached if possible.
+
+        The cached listing is kept up to date with the changes made through this
+        client, so it only misses changes made elsewhere within the cache ttl.
+        """
+        key = f"items:{album_id}"
+        if self.cache is not None:
+            items = self.cache.get(key)
+            if items is not None:
+                logging.info(f"Using cached listing of {len(items)} album items")
+                return items
+
+        items = [
+            dict(id=item["id"], description=item.get("description", ""))
+            for item in self._get_mediaitems(album_id)
+        ]
+        if self.cache is not None:
+            self.cache.put(key, items)
+
+        return items
+
+    def _update_album_items(
+        self, album_id, added: Iterable[dict] = (), removed: Iterable[str] = ()
+    ):
+        """Apply changes to the cached listing of an album, if there is one."""
+        if self.cache is None:
+            return
+        key = f"items:{album_id}"
+        items = self.cache.get(key)
+        if items is None:
+            return
+
+        removed = set(removed)
+        items = [item for item in items if item["id"] not in removed] + [
+            dict(id=item["id"], description=item.get("description", ""))
+            for item in added
+        ]
+        self.cache.put(key, items, refresh=False)
 
     def _get_mediaitems(self, album_id):
         params = {
@@ -141,18 +239,96 @@ class GooglePhotosClient:
             else:
                 return
 
-    def clear_album(self, album_id):
-        media_items = self._get_mediaitems(album_id)
+    @staticmethod
+    def _chunks(ids: Iterable[str], size: int) -> Iterator[List[str]]:
+        ids = iter(ids)
+        while True:
+            chunk = list(itertools.islice(ids, size))
+            if not chunk:
+                return
+            yield chunk
+
+    def _remove_batch(self, album_id: str, media_item_ids: List[str]) -> int:
+        """Remove up to BATCH_REMOVE_LIMIT items from an album."""
+        body = json.dumps({"mediaItemIds": media_item_ids})
 
-        body = {"mediaItemIds": [item["id"] for item in media_items]}
+        with metrics.timer("photos.batch_remove"):
+            resp = self.session.post(
+                f"https://photoslibrary.googleapis.com/v1/albums/{album_id}:batchRemoveMediaItems",  # noqa
+                body,
+            )
 
-        resp = self.session.post(
-            f"https://photoslibrary.googleapis.com/v1/albums/{album_id}:batchRemoveMediaItems",  # noqa
-            body,
-        )
+        if resp.status_code == 200:
+            self._update_album_items(album_id, removed=media_item_ids)
+        else:
+            logging.error(
+                f"Could not remove {len(media_item_ids)} items from album. "
+                f"Server Response -- {resp.text}"
+            )
 
         return resp.status_code
 
+    def _remove_batches(
+        self, album_id: str, media_item_ids: Iterable[str]
+    ) -> List[dict]:
+        """Remove items in concurrent batches as `media_item_ids` yields them.
+
+        Returns the size and status code of each batch, in order.
+        """
+        results = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            for (ii, batch), future in utils.bounded_map(
+                pool,
+                lambda job: self._remove_batch(album_id, job[1]),
+                enumerate(self._chunks(media_item_ids, self.BATCH_REMOVE_LIMIT)),
+                2 * self.max_workers,
+            ):
+                results.append(
+                    dict(batch=ii, n_items=len(batch), status=future.result())
+                )
+
+        return sorted(results, key=lambda result: result["batch"])
+
+    def clear_album(self, album_id) -> List[dict]:
+        """Remove every item from an album, in batches removed as pages are listed.
+
+        Removing items while paging through the album can shift later pages, so
+        the album is listed again until it is empty, or a pass removes nothing.
+        Returns the results of every batch, as for `remove_mediaitems`.
+        """
+        results = []
+        while True:
+            passed = self._remove_batches(
+                album_id, (item["id"] for item in self._get_mediaitems(album_id))
+            )
+            results += passed
+            if not any(r["status"] == 200 for r in passed):
+                break
+
+        self._cleared(album_id, results, passed)
+
+        return results
+
+    def _cleared(self, album_id: str, results: List[dict], passed: List[dict]):
+        """Report a cleared album, given every batch and the last pass's."""
+        n_removed = sum(r["n_items"] for r in results if r["status"] == 200)
+        n_failed = sum(r["n_items"] for r in results if r["status"] != 200)
+        logging.info(
+            f"Cleared album in {len(results)} batches: "
+            f"{n_removed} items removed, {n_failed} failed"
+        )
+
+        # the last pass found nothing left to remove
+        if not passed and self.cache is not None:
+            self.cache.put(f"items:{album_id}", [])
+
+    def remove_mediaitems(self, album_id, media_item_ids: List[str]) -> List[dict]:
+        """Remove items from an album in concurrent batches of up to 50.
+
+        Returns the size and status code of each batch, in order.
+        """
+        return self._remove_batches(album_id, media_item_ids)
+
     def create_album(self, album_name):
         create_album_body = json.dumps({"album": {"title": album_name}})
 
@@ -164,86 +340,295 @@ class GooglePhotosClient:
 
         if "id" in resp:
             logging.info(f"Created new album -- '{album_name}'")
+            if self.cache is not None:
+                self.cache.put(f"album:{album_name.lower()}", resp["id"])
             return resp["id"]
         else:
             return 0
 
-    def upload_images(self, album_id: str, imgs: Union[Image.Image, List[Image.Image]]):
-        if isinstance(imgs, Image.Image):
-            imgs = [imgs]
+    def _upload_bytes(self, photo_bytes: bytes, fname: str) -> Optional[str]:
+        """Upload raw bytes, returning an upload token or None on failure."""
+        logging.info(f"Uploading photo -- '{fname}'")
+
+        with metrics.timer("photos.upload"):
+            resp = self.session.post(
+                self.UPLOADS_URL,
+                photo_bytes,
+                headers={
+                    "Content-type": "application/octet-stream",
+                    "X-Goog-Upload-Protocol": "raw",
+                    "X-Goog-Upload-File-Name": fname,
+                },
+            )
 
-        self.session.headers["Content-type"] = "application/octet-stream"
-        self.session.headers["X-Goog-Upload-Protocol"] = "raw"
+        if (resp.status_code == 200) and (resp.content):
+            return resp.content.decode()
 
-        for ii, im in enumerate(imgs):
-            fname = f"./upload_photo_{ii}.png"
+        logging.error(f"Could not upload '{fname}'. Server Response - {resp}")
+        return None
 
-            im.save(fname)
+    def _query_offset(self, upload_url: str) -> Tuple[str, int, bytes]:
+        """Ask for the status of a resumable upload and the bytes received."""
+        resp = self.session.post(
+            upload_url,
+            headers={"Content-Length": "0", "X-Goog-Upload-Command": "query"},
+        )
+        resp.raise_for_status()
 
-            try:
-                photo_file = open(fname, mode="rb")
-                photo_bytes = photo_file.read()
-            except OSError as err:
-                logging.error(f"Could not read file '{fname}' -- {err}")
-                continue
+        return (
+            resp.headers.get("X-Goog-Upload-Status", "active"),
+            int(resp.headers.get("X-Goog-Upload-Size-Received", 0)),
+            resp.content,
+        )
 
-            self.session.headers["X-Goog-Upload-File-Name"] = os.path.basename(fname)
+    def _upload_resumable(
+        self, fobj: BinaryIO, fname: str, chunk_size: int
+    ) -> Optional[str]:
+        """Upload a seekable file or buffer in chunks, returning an upload token.
 
-            logging.info(f"Uploading photo -- '{fname}'")
+        The upload session survives dropped connections, throttling and server
+        errors: after a failure the offset acknowledged by the server is queried
+        and the upload resumes from there, up to `max_chunk_retries` times in a
+        row.
+        """
+        logging.info(f"Uploading photo in chunks -- '{fname}'")
+        size = fobj.seek(0, os.SEEK_END)
 
-            upload_token = self.session.post(
-                "https://photoslibrary.googleapis.com/v1/uploads", photo_bytes
+        with metrics.timer("photos.upload"):
+            resp = self.session.post(
+                self.UPLOADS_URL,
+                headers={
+                    "Content-Length": "0",
+                    "X-Goog-Upload-Command": "start",
+                    "X-Goog-Upload-Content-Type": "application/octet-stream",
+                    "X-Goog-Upload-File-Name": fname,
+                    "X-Goog-Upload-Protocol": "resumable",
+                    "X-Goog-Upload-Raw-Size": str(size),
+                },
             )
-
-            if (upload_token.status_code == 200) and (upload_token.content):
-                create_body = json.dumps(
+            if resp.status_code != 200 or "X-Goog-Upload-URL" not in resp.headers:
+                logging.error(f"Could not start upload '{fname}'. Response - {resp}")
+                return None
+
+            upload_url = resp.headers["X-Goog-Upload-URL"]
+            # every chunk but the last must be a multiple of the granularity
+            granularity = int(resp.headers.get("X-Goog-Upload-Chunk-Granularity", 1))
+            chunk_size = max(granularity, chunk_size // granularity * granularity)
+
+            offset, failures = 0, 0
+            while True:
+                fobj.seek(offset)
+                chunk = fobj.read(chunk_size)
+                last = offset + len(chunk) >= size
+
+                try:
+                    resp = self.session.post(
+                        upload_url,
+                        chunk,
+                        headers={
+                            "X-Goog-Upload-Command": (
+                                "upload, finalize" if last else "upload"
+                            ),
+                            "X-Goog-Upload-Offset": str(offset),
+                        },
+                    )
+                    # a 429 outlasting the session's retries is retried as well
+                    if resp.status_code < 500 and resp.status_code != 429:
+                        resp.raise_for_status()
+                        if last:
+                            return resp.content.decode()
+                        offset += len(chunk)
+                        failures = 0
+                        metrics.incr("photos.chunks")
+                        continue
+                    error = f"status {resp.status_code}"
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    error = repr(e)
+                except requests.HTTPError as e:
+                    logging.error(f"Could not upload '{fname}'. {e}")
+                    return None
+
+                failures += 1
+                if failures > self.max_chunk_retries:
+                    logging.error(f"Could not upload '{fname}' after {error}")
+                    return None
+
+                logging.warning(f"Resuming upload '{fname}' after {error}")
+                metrics.incr("photos.chunk_retries")
+                time.sleep(min(2**failures, 30))
+
+                try:
+                    status, offset, content = self._query_offset(upload_url)
+                except requests.RequestException as e:
+                    logging.error(f"Could not resume upload '{fname}': {e!r}")
+                    return None
+                if status == "final":
+                    return content.decode()
+
+    def _upload_photo(self, photo: Union[bytes, BinaryIO], fname: str) -> Optional[str]:
+        """Upload bytes or a binary file, in chunks if larger than `chunk_size`."""
+        if isinstance(photo, bytes):
+            if self.chunk_size is None or len(photo) <= self.chunk_size:
+                return self._upload_bytes(photo, fname)
+            photo = io.BytesIO(photo)
+
+        if self.chunk_size is None:
+            return self._upload_bytes(photo.read(), fname)
+
+        return self._upload_resumable(photo, fname, self.chunk_size)
+
+    @staticmethod
+    def _create_body(album_id: str, items: List[dict]) -> str:
+        return json.dumps(
+            {
+                "albumId": album_id,
+                "newMediaItems": [
                     {
-                        "albumId": album_id,
-                        "newMediaItems": [
-                            {
-                                "description": "",
-                                "simpleMediaItem": {
-                                    "uploadToken": upload_token.content.decode()
-                                },
-                            }
-                        ],
-                    },
-                    indent=4,
-                )
+                        "description": item["description"],
+                        "simpleMediaItem": {"uploadToken": item["upload_token"]},
+                    }
+                    for item in items
+                ],
+            }
+        )
 
-                resp = self.session.post(
-                    "https://photoslibrary.googleapis.com/v1/mediaItems:batchCreate",
-                    create_body,
-                ).json()
-
-                if "newMediaItemResults" in resp:
-                    status = resp["newMediaItemResults"][0]["status"]
-                    if status.get("code") and (status.get("code") > 0):
-                        logging.error(
-                            "Could not add '{}' to library -- {}".format(
-                                os.path.basename(fname), status["message"]
-                            )
-                        )
-                    else:
-                        logging.info(
-                            f"Added '{os.path.basename(fname)}' to library and album"
-                        )
-                else:
-                    logging.error(
-                        f"Could not add '{os.path.basename(fname)}' to library. Server Response -- {resp}"  # noqaq
-                    )
+    @staticmethod
+    def _created_items(resp: dict, items: List[dict]) -> List[dict]:
+        """The media items a batchCreate response added, logging any failures."""
+        if "newMediaItemResults" not in resp:
+            logging.error(
+                f"Could not add {len(items)} photos to library. Server Response -- {resp}"  # noqa
+            )
+            return []
 
-            else:
+        fnames = {item["upload_token"]: item["fname"] for item in items}
+
+        created = []
+        for result in resp["newMediaItemResults"]:
+            fname = fnames.get(result.get("uploadToken"), "<unknown>")
+            status = result.get("status", {})
+            if status.get("code") and (status.get("code") > 0):
                 logging.error(
-                    f"Could not upload '{os.path.basename(fname)}'. Server Response - {upload_token}"  # noqa
+                    f"Could not add '{fname}' to library -- {status.get('message')}"
                 )
+            else:
+                logging.info(f"Added '{fname}' to library and album")
+                created.append(result["mediaItem"])
+
+        return created
 
-        try:
-            del self.session.headers["Content-type"]
-            del self.session.headers["X-Goog-Upload-Protocol"]
-            del self.session.headers["X-Goog-Upload-File-Name"]
-        except KeyError:
-            pass
+    def _batch_create(self, album_id: str, items: List[dict]) -> List[dict]:
+        """Commit up to BATCH_CREATE_LIMIT uploaded items, returning those added."""
+        with metrics.timer("photos.batch_create"):
+            resp = self.session.post(
+                "https://photoslibrary.googleapis.com/v1/mediaItems:batchCreate",
+                self._create_body(album_id, items),
+            ).json()
+
+        return self._created_items(resp, items)
+
+    @staticmethod
+    def _uploaded_items(upload_tokens: Iterable[Tuple[str, str]]) -> List[dict]:
+        """The items to commit for `(upload_token, description)` pairs given."""
+        return [
+            dict(
+                ii=-1,
+                fname=f"uploaded_photo_{ii}",
+                description=description,
+                upload_token=upload_token,
+            )
+            for ii, (upload_token, description) in enumerate(upload_tokens)
+        ]
+
+    @staticmethod
+    def _uploaded_item(ii: int, description: str, upload_token: str) -> dict:
+        return dict(
+            ii=ii,
+            fname=f"upload_photo_{ii}",
+            description=description,
+            upload_token=upload_token,
+        )
+
+    def _create_batches(self, items: List[dict]) -> Iterator[List[dict]]:
+        """Batches of uploaded items to commit, in the order the photos were given."""
+        items = sorted(items, key=lambda item: item["ii"])
+        for ii in range(0, len(items), self.BATCH_CREATE_LIMIT):
+            yield items[ii : ii + self.BATCH_CREATE_LIMIT]  # noqa
+
+    def _created(
+        self,
+        album_id: str,
+        batch: List[dict],
+        on_create: Optional[Callable[[dict], None]] = None,
+    ):
+        self._update_album_items(album_id, added=batch)
+        if on_create is not None:
+            for media_item in batch:
+                on_create(media_item)
+
+    def upload_photos(
+        self,
+        album_id: str,
+        photos: Iterable[Tuple[Union[bytes, BinaryIO], str]],
+        upload_tokens: Iterable[Tuple[str, str]] = (),
+        on_upload: Optional[Callable[[str, str], None]] = None,
+        on_create: Optional[Callable[[dict], None]] = None,
+    ) -> List[dict]:
+        """Upload encoded photos with their descriptions to an album.
+
+        Photos are bytes or seekable binary files; with a `chunk_size`, larger
+        photos are uploaded in resumable chunks. Uploads run concurrently as
+        `photos` yields them, and the resulting upload tokens are then committed
+        in batches of up to 50 media items, after any `(upload_token,
+        description)` pairs uploaded earlier. The optional callbacks are called
+        with each description and upload token, and each created media item, as
+        they happen. Returns the created media items.
+        """
+
+        def _upload(job):
+            ii, (photo, _) = job
+            return self._upload_photo(photo, f"upload_photo_{ii}")
+
+        items = self._uploaded_items(upload_tokens)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            for (ii, (_, description)), future in utils.bounded_map(
+                pool, _upload, enumerate(photos), 2 * self.max_workers
+            ):
+                upload_token = future.result()
+                if upload_token is not None:
+                    items.append(self._uploaded_item(ii, description, upload_token))
+                    if on_upload is not None:
+                        on_upload(description, upload_token)
+
+        created = []
+        for batch in self._create_batches(items):
+            batch = self._batch_create(album_id, batch)
+            self._created(album_id, batch, on_create)
+            created += batch
+
+        return created
+
+    def upload_images(
+        self,
+        album_id: str,
+        imgs: Union[Image.Image, Iterable[Image.Image]],
+        descriptions: Optional[Iterable[str]] = None,
+        encoding: Optional[dict] = None,
+    ) -> List[dict]:
+        if isinstance(imgs, Image.Image):
+            imgs = [imgs]
+
+        if descriptions is None:
+            descriptions = itertools.repeat("")
+
+        # encode straight to memory rather than round-tripping through disk
+        return self.upload_photos(
+            album_id,
+            (
+                (encode_image(im, **(encoding or {})), d)
+                for im, d in zip(imgs, descriptions)
+            ),
+        )
 
 
 if __name__ == "__main__":
@@ -1,54 +1,209 @@
+import functools
+import io
 import os
 import re
+from typing import Any, Dict, List, Optional, Tuple
 
 from PIL import Image, ImageDraw, ImageFont
 
+FONT_PATH = "/usr/share/fonts/truetype/freefont/FreeMonoBold.ttf"
 
-def beautiful_s2_to_16_9_labelled(im: Image, txt: str) -> Image:
+# output encodings: their Pillow format name, file extension and content type
+FORMATS = {
+    "png": dict(pil_format="PNG", ext="png", content_type="image/png"),
+    "jpeg": dict(pil_format="JPEG", ext="jpg", content_type="image/jpeg"),
+    "webp": dict(pil_format="WEBP", ext="webp", content_type="image/webp"),
+}
+
+DATE_RE = re.compile(r"\d\d\s\D\D\D\s\d\d\d\d")
+LATLON_RE = re.compile(r"\(.*\)")
+
+
+@functools.lru_cache(maxsize=None)
+def load_font(path: str, size: int) -> ImageFont.FreeTypeFont:
+    """Load a truetype font once per process and size."""
+    return ImageFont.truetype(path, size, encoding="unic")
+
+
+def split_caption(txt: str) -> Tuple[str, str]:
+    """Split a Sentinel-2 bot tweet into a place line and a latlon/date line."""
+    match_date = DATE_RE.search(txt)
+    match_latlon = LATLON_RE.search(txt)
+
+    if match_date is None or match_latlon is None:
+        return txt.strip(), ""
+
+    top_line = txt[: match_latlon.start()]
+    bottom_line = txt[match_latlon.start() : match_date.end()].replace(",", "")  # noqa
+
+    return top_line, bottom_line
+
+
+class Annotator:
+    """Draw a two-line caption in a rounded box at the bottom right of an image.
+
+    Sizes are given for an image REFERENCE_WIDTH pixels wide and scaled to the
+    width of each annotated image.
+    """
+
+    REFERENCE_WIDTH = 2400
+
+    def __init__(
+        self,
+        font_path: str = FONT_PATH,
+        font_size: int = 20,
+        line_spacing: int = 30,
+        padding: Tuple[int, int] = (25, 15),
+        margin: Tuple[int, int] = (100, 50),
+        radius: int = 20,
+        fill: Tuple[int, int, int, int] = (255, 255, 255, 176),
+        text_fill: Tuple[int, int, int, int] = (120, 120, 120, 196),
+    ):
+        self.font_path = font_path
+        self.font_size = font_size
+        self.line_spacing = line_spacing
+        self.padding = padding
+        self.margin = margin
+        self.radius = radius
+        self.fill = fill
+        self.text_fill = text_fill
+
+    def font(self, scale: float) -> ImageFont.FreeTypeFont:
+        return load_font(self.font_path, max(1, round(self.font_size * scale)))
+
+    def __call__(self, im: Image.Image, lines: List[str]) -> Image.Image:
+        if not lines:
+            return im
+
+        scale = im.width / self.REFERENCE_WIDTH
+        font = self.font(scale)
+        line_spacing = round(self.line_spacing * scale)
+        pad_x, pad_y = (round(p * scale) for p in self.padding)
+        margin_x, margin_y = (round(m * scale) for m in self.margin)
+
+        draw = ImageDraw.Draw(im, "RGBA")
+
+        # measure the text block rather than estimating from character counts
+        text_width = max(draw.textbbox((0, 0), line, font=font)[2] for line in lines)
+        text_height = line_spacing * (len(lines) - 1) + font.getbbox("Ag")[3]
+
+        right = im.width - margin_x
+        bottom = im.height - margin_y
+        left = right - text_width - 2 * pad_x
+        top = bottom - text_height - 2 * pad_y
+
+        draw.rounded_rectangle(
+            (left, top, right, bottom),
+            fill=self.fill,
+            outline=None,
+            width=3,
+            radius=round(self.radius * scale),
+        )
+
+        for ii, line in enumerate(lines):
+            anchor = (left + pad_x, top + pad_y + ii * line_spacing)
+            draw.text(anchor, line, self.text_fill, font=font)
+
+        return im
+
+
+annotate = Annotator()
+
+
+def decode_image(
+    image_bytes: bytes, size: Optional[Tuple[int, int]] = None
+) -> Image.Image:
+    """Decode image bytes, no larger than needed to cover `size` where possible.
+
+    JPEGs are decoded with DCT scaling (Image.draft) at the smallest of 1/1, 1/2,
+    1/4 or 1/8 scale that is still at least `size`; other formats are decoded
+    at full resolution.
+    """
+    im = Image.open(io.BytesIO(image_bytes))
+
+    if size is not None and im.format == "JPEG":
+        im.draft(im.mode, size)
+
+    im.load()
+
+    return im
+
+
+def image_format(image_bytes: bytes) -> str:
+    """The format of encoded image bytes, as a key of FORMATS."""
+    with Image.open(io.BytesIO(image_bytes)) as im:
+        return (im.format or "").lower()
+
+
+def encode_image(
+    im: Image.Image,
+    format: str = "png",
+    quality: Optional[int] = None,
+    compress_level: Optional[int] = None,
+    optimize: bool = False,
+) -> bytes:
+    """Encode an image as png, jpeg or webp bytes.
+
+    `quality` applies to jpeg and webp, `compress_level` (0-9) to png.
+    """
+    if format not in FORMATS:
+        raise ValueError(f"Unsupported format {format}, expected one of {FORMATS}")
+
+    params: Dict[str, Any] = dict(optimize=optimize)
+    if quality is not None:
+        params["quality"] = quality
+    if compress_level is not None:
+        params["compress_level"] = compress_level
+
+    if format == "jpeg" and im.mode not in ("RGB", "L"):
+        im = im.convert("RGB")
+
+    buf = io.BytesIO()
+    im.save(buf, format=FORMATS[format]["pil_format"], **params)
+
+    return buf.getvalue()
+
+
+def beautiful_s2_to_16_9_labelled(
+    im: Image.Image, txt: str, output_width: Optional[int] = None
+) -> Image.Image:
     AR = 9 / 16
     width, height = im.size
     bottom = round((height + AR * height) / 2)
     top = round((height - AR * height) / 2)
     left = 0
     right = width
-    pix_per_char = 12
 
     # crop the image to aspect ratio, AR
     im = im.crop((left, top, right, bottom))
 
-    # extract latlon and date strings using regex
-    match_date = re.search(r"\d\d\s\D\D\D\s\d\d\d\d", txt)
-    match_latlon = re.search(r"\(.*\)", txt)
+    # downsample to the output resolution before annotating
+    if output_width is not None and im.width > output_width:
+        output_height = round(im.height * output_width / im.width)
+        im = im.resize((output_width, output_height), Image.Resampling.LANCZOS)
 
-    top_line = txt[: match_latlon.start()]
-    bottom_line = txt[match_latlon.start() : match_date.end()].replace(",", "")  # noqa
+    # extract latlon and date strings and annotate the image with them
+    return annotate(im, [line for line in split_caption(txt) if line])
 
-    # draw a semi-opaque box to hold our annotations.
-    # set the width of the box based on the length of our text annotations.
-    left_align = (
-        im.width - int(max(len(top_line), len(bottom_line)) * pix_per_char) - 10
-    )
-
-    draw = ImageDraw.Draw(im, "RGBA")
-    draw.rounded_rectangle(
-        (left_align - 25, 1155, 2300, 1300),
-        fill=(255, 255, 255, 176),
-        outline=None,
-        width=3,
-        radius=20,
-    )
-
-    top_row_anchor = (left_align, 1170)
-    bottom_row_anchor = (left_align, 1200)
-
-    # finally, add our text annotations
-    font = ImageFont.truetype(
-        "/usr/share/fonts/truetype/freefont/FreeMonoBold.ttf", 20, encoding="unic"
-    )
-    draw.text(top_row_anchor, top_line, (120, 120, 120, 196), font=font)
-    draw.text(bottom_row_anchor, bottom_line, (120, 120, 120, 196), font=font)
 
-    return im
+def render_labelled(
+    image_bytes: bytes,
+    txt: str,
+    output_width: Optional[int] = None,
+    encoding: Optional[dict] = None,
+) -> bytes:
+    """Crop and annotate compressed image bytes, returning encoded bytes.
+
+    Takes and returns bytes so it can run in a worker process without pickling
+    decoded images. With an `output_width`, JPEGs are decoded at reduced scale.
+    `encoding` holds keyword arguments for `encode_image`, defaulting to png.
+    """
+    size = (output_width, round(output_width * 9 / 16)) if output_width else None
+
+    with decode_image(image_bytes, size) as im:
+        out = beautiful_s2_to_16_9_labelled(im, txt, output_width)
+
+    return encode_image(out, **(encoding or {}))
 
 
 def format_s2_url(url: str) -> str:
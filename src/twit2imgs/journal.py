@@ -0,0 +1,81 @@
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+from loguru import logger
+
+
+class RunJournal:
+    """An append-only, json-lines record of the work completed for each tweet.
+
+    Each line records one stage completed for one tweet, e.g. `stored` or
+    `GooglePhotos.uploaded`, with any details needed to skip it on a resumed run
+    such as an upload token. A run that completes deletes its journal, so a
+    journal left on disk belongs to a failed run.
+    """
+
+    def __init__(self, path: str, resume: bool = False):
+        self.path = path
+        self.resume = resume
+        # the stages which, once done, mean a tweet needs no more work
+        self.required: List[str] = []
+        self._lock = threading.Lock()
+
+        self.entries: Dict[str, Dict[str, dict]] = {}
+        if resume:
+            self._load()
+        elif os.path.exists(path):
+            os.remove(path)
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._file = open(path, "a")
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            logger.info(f"No run journal at {self.path}, starting afresh")
+            return
+
+        n_entries = 0
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # a line cut short by a crash
+                    continue
+                self.entries.setdefault(entry["stage"], {})[entry["tweet_id"]] = entry
+                n_entries += 1
+
+        logger.info(f"Resuming from {n_entries} journal entries at {self.path}")
+
+    def record(self, tweet_id: str, stage: str, **details):
+        entry = dict(tweet_id=str(tweet_id), stage=stage, time=time.time(), **details)
+
+        with self._lock:
+            self.entries.setdefault(stage, {})[entry["tweet_id"]] = entry
+            print(json.dumps(entry), file=self._file, flush=True)
+
+    def done(self, tweet_id: str, stage: str) -> Optional[dict]:
+        """The entry recording `stage` as done for a tweet, or None."""
+        return self.entries.get(stage, {}).get(str(tweet_id))
+
+    def stage(self, stage: str) -> Dict[str, dict]:
+        """Every entry for `stage`, keyed by tweet id."""
+        return dict(self.entries.get(stage, {}))
+
+    def complete(self, tweet_id: str) -> bool:
+        """Whether every required stage is done for a tweet."""
+        return bool(self.required) and all(
+            self.done(tweet_id, stage) for stage in self.required
+        )
+
+    def clear(self):
+        """Delete the journal once a run has completed."""
+        with self._lock:
+            self._file.close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self.entries = {}
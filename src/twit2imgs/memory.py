@@ -0,0 +1,69 @@
+import threading
+from typing import Dict
+
+from loguru import logger
+
+from twit2imgs.metrics import metrics
+
+
+class MemoryBudget:
+    """Admit tweets into the pipeline only while the bytes they hold fit a budget.
+
+    Stages charge the bytes they allocate for a tweet, i.e. its downloaded image
+    and its pixels while decoded, and release them once done with them. A new
+    tweet is admitted while there is room for one as large as the largest so
+    far, which is reserved until the tweet is charged. Only admission waits, so
+    the stages downstream of the scraper never block on the budget and always
+    drain.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.high_water = 0
+        # the most any one tweet has held, i.e. the room to admit another
+        self.per_item = 0
+        self._reserved: Dict[str, int] = {}
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def admit(self, key: str):
+        """Wait until the budget has room for another tweet, and reserve it."""
+        with self._cond:
+            self._cond.wait_for(
+                lambda: self._closed
+                # one tweet at a time until their size is known
+                or (self.used == 0 and not self._reserved)
+                or (self.per_item and self.used + self.per_item <= self.max_bytes)
+            )
+            self._reserved[key] = self.per_item
+            self.used += self.per_item
+
+    def charge(self, n_bytes: int, item_bytes: int = 0, key: str = ""):
+        """Charge `n_bytes`, in place of any room reserved for `key`.
+
+        `item_bytes` is the total now held by the tweet charged.
+        """
+        with self._cond:
+            self.used += n_bytes - self._reserved.pop(key, 0)
+            self.high_water = max(self.high_water, self.used)
+            self.per_item = max(self.per_item, item_bytes)
+            self._cond.notify_all()
+
+    def release(self, n_bytes: int):
+        with self._cond:
+            self.used -= n_bytes
+            self._cond.notify_all()
+
+    def close(self):
+        """Stop admission from blocking, e.g. once the pipeline has failed."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def report(self):
+        logger.info(
+            f"Memory high-water mark: {self.high_water / 1024**2:.1f} MiB "
+            f"of a {self.max_bytes / 1024**2:.1f} MiB budget"
+        )
+        metrics.incr("memory.high_water_bytes", self.high_water)
@@ -0,0 +1,146 @@
+import json
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List
+from urllib.parse import urlparse
+
+import requests
+
+
+def peak_rss_bytes() -> int:
+    """The peak resident set size of this process so far."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+class Metrics:
+    """Thread-safe run metrics: counters, and timings observed per call.
+
+    Timings are recorded in seconds under dotted names, e.g. `storer.upload`, and
+    summarised as count/total/mean/max. HTTP traffic is recorded by hooking
+    requests sessions with `instrument_session`.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters: Dict[str, float] = {}
+        self.timings: Dict[str, List[float]] = {}
+        self.start_time = time.time()
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.timings = {}
+            self.start_time = time.time()
+
+    def incr(self, name: str, value: float = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name: str, seconds: float):
+        with self._lock:
+            self.timings.setdefault(name, []).append(seconds)
+
+    @contextmanager
+    def timer(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def instrument_session(self, session: requests.Session, name: str):
+        """Count requests, bytes and latencies for every response on `session`."""
+
+        def _hook(response, *args, **kwargs):
+            host = urlparse(response.url).netloc
+            self.incr(f"http.{name}.requests")
+            self.incr(f"http.{name}.status.{response.status_code}")
+            self.observe(f"http.{name}.latency", response.elapsed.total_seconds())
+            self.observe(
+                f"http.{name}.{host}.latency", response.elapsed.total_seconds()
+            )
+
+            body = response.request.body
+            if isinstance(body, (bytes, str)):
+                self.incr(f"http.{name}.bytes_sent", len(body))
+            length = response.headers.get("Content-Length")
+            if length is not None and length.isdigit():
+                self.incr(f"http.{name}.bytes_received", int(length))
+
+            return response
+
+        session.hooks["response"].append(_hook)
+
+        return session
+
+    def report(self) -> dict:
+        with self._lock:
+            timings = {
+                name: dict(
+                    count=len(values),
+                    total=round(sum(values), 4),
+                    mean=round(sum(values) / len(values), 4),
+                    max=round(max(values), 4),
+                )
+                for name, values in self.timings.items()
+            }
+            counters = dict(self.counters)
+
+        return dict(
+            wall_time=round(time.time() - self.start_time, 2),
+            peak_rss_bytes=peak_rss_bytes(),
+            counters=counters,
+            timings=timings,
+        )
+
+    def summary(self) -> dict:
+        """A compact report for chat messages: totals only."""
+        report = self.report()
+
+        return dict(
+            wall_time=report["wall_time"],
+            peak_rss_mb=round(report["peak_rss_bytes"] / 1024**2, 1),
+            stages={
+                name: t["total"]
+                for name, t in report["timings"].items()
+                if name.startswith("stage.")
+            },
+            **{
+                name: value
+                for name, value in report["counters"].items()
+                if ".status." not in name
+            },
+        )
+
+    def write_json(self, path: str):
+        json.dump(self.report(), open(path, "w"), indent=2)
+
+    def write_prometheus(self, path: str, prefix: str = "twit2imgs"):
+        """Write the report in the Prometheus text exposition format."""
+
+        def _name(name):
+            return f"{prefix}_" + "".join(c if c.isalnum() else "_" for c in name)
+
+        report = self.report()
+        lines = [
+            f"{prefix}_wall_time_seconds {report['wall_time']}",
+            f"{prefix}_peak_rss_bytes {report['peak_rss_bytes']}",
+        ]
+        for name, value in sorted(report["counters"].items()):
+            lines.append(f"{_name(name)}_total {value}")
+        for name, t in sorted(report["timings"].items()):
+            lines.append(f"{_name(name)}_seconds_count {t['count']}")
+            lines.append(f"{_name(name)}_seconds_sum {t['total']}")
+            lines.append(f"{_name(name)}_seconds_max {t['max']}")
+
+        with open(path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+
+# the metrics for this run, shared by every module
+metrics = Metrics()
@@ -1,30 +1,159 @@
 import json
+import threading
 from io import BytesIO
+from typing import Callable, Iterable, Optional
 
 import requests
 import tweepy
-from PIL import Image
+from loguru import logger
+from PIL import Image, UnidentifiedImageError
+
+from twit2imgs.cache import ImageCache
+from twit2imgs.memory import MemoryBudget
+from twit2imgs.metrics import metrics
+
+
+def fetch_image(
+    url: str,
+    session: Optional[requests.Session] = None,
+    cache: Optional[ImageCache] = None,
+    tweet_id: Optional[str] = None,
+) -> bytes:
+    if cache is not None:
+        content = cache.get(url)
+        if content is not None:
+            return content
+
+    r = (session or requests).get(url, timeout=60)
+    r.raise_for_status()
+
+    if cache is not None:
+        cache.put(url, r.content, tweet_id=tweet_id)
+
+    return r.content
 
 
 class Tweet:
-    def __init__(self, ttweet, img_urls):
+    def __init__(
+        self,
+        ttweet,
+        img_urls,
+        image_bytes: Optional[bytes] = None,
+        cache: Optional[ImageCache] = None,
+        fetch: bool = True,
+    ):
         self.id: str = ttweet.id
         self.text: str = ttweet.text
-        self.image_url: str = img_urls[ttweet.attachments["media_keys"][0]]
+        self.image_url: str = self.get_image_url(ttweet, img_urls)
         self.ttweet: tweepy.tweet.Tweet = ttweet
 
-        r = requests.get(self.image_url, timeout=60)
-        r.raise_for_status()
+        # set by incremental scrapers: False if seen on a previous run
+        self.is_new: bool = True
 
-        self.image = Image.open(BytesIO(r.content))
+        # the scraper normally fetches the image bytes ahead of time, and skips
+        # fetching them for tweets a resumed run has already finished with
+        if image_bytes is None and fetch:
+            image_bytes = fetch_image(self.image_url, cache=cache, tweet_id=self.id)
 
-    def write_record(self, fpath):
-        record = dict(
+        self._image_bytes: Optional[bytes] = image_bytes
+        self._image: Optional[Image.Image] = None
+
+        # set by a memory-bounded pipeline: the stages still using the image
+        self.budget: Optional[MemoryBudget] = None
+        self._holders: set = set()
+        self._on_free: Optional[Callable[["Tweet"], None]] = None
+        self._charged = 0
+        self._image_charge = 0
+        self._lock = threading.Lock()
+
+    @property
+    def image_bytes(self) -> Optional[bytes]:
+        """The image in its original (compressed) encoding."""
+        return self._image_bytes
+
+    @property
+    def image(self) -> Image.Image:
+        """The decoded image, decoded on first access."""
+        if self._image is None:
+            if self._image_bytes is None:
+                raise ValueError(f"Tweet {self.id} has no image bytes to decode")
+            with metrics.timer("tweet.decode"):
+                im = Image.open(BytesIO(self._image_bytes))
+                if self.budget is not None:
+                    self._image_charge = im.width * im.height * len(im.getbands())
+                    self.budget.charge(
+                        self._image_charge, self._charged + self._image_charge
+                    )
+                im.load()
+            self._image = im
+
+        return self._image
+
+    def release_image(self):
+        """Drop the decoded pixels; they are re-decoded on next access."""
+        if self._image is not None:
+            if self._image_charge and self.budget is not None:
+                self.budget.release(self._image_charge)
+                self._image_charge = 0
+            self._image.close()
+            self._image = None
+
+    def hold(
+        self,
+        budget: MemoryBudget,
+        holders: Iterable[str],
+        on_free: Optional[Callable[["Tweet"], None]] = None,
+    ):
+        """Charge the image to `budget` until each of `holders` releases it.
+
+        `on_free` is called with the tweet once the last holder releases it.
+        """
+        with self._lock:
+            self.budget = budget
+            self._holders = set(holders)
+            self._on_free = on_free
+            self._charged = len(self._image_bytes or b"")
+            item_bytes = self._charged
+            if self._image_bytes is not None:
+                # the pixels once decoded, read from the header alone
+                try:
+                    with Image.open(BytesIO(self._image_bytes)) as im:
+                        item_bytes += im.width * im.height * len(im.getbands())
+                except UnidentifiedImageError:
+                    # left to fail in the stage decoding it, charging the bytes
+                    logger.warning(f"Unidentified image for tweet {self.id}")
+            budget.charge(self._charged, item_bytes, key=str(self.id))
+
+    def release(self, holder: str):
+        """Mark `holder` as done with the image, freeing it once all are."""
+        with self._lock:
+            if holder not in self._holders:
+                return
+            self._holders.discard(holder)
+            if self._holders:
+                return
+
+            self.release_image()
+            self._image_bytes = None
+            if self.budget is not None:
+                self.budget.release(self._charged)
+            self._charged = 0
+
+        if self._on_free is not None:
+            self._on_free(self)
+
+    @staticmethod
+    def get_image_url(ttweet, img_urls) -> str:
+        return img_urls[ttweet.attachments["media_keys"][0]]
+
+    def record(self) -> dict:
+        return dict(
             id=self.id,
             text=self.text,
             url=self.image_url,
         )
 
-        json.dump(record, open(fpath, "w"))
+    def write_record(self, fpath):
+        json.dump(self.record(), open(fpath, "w"))
 
         return 1
@@ -0,0 +1,288 @@
+import queue
+import threading
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set
+
+from loguru import logger
+
+from twit2imgs import models
+from twit2imgs.memory import MemoryBudget
+from twit2imgs.metrics import metrics
+from twit2imgs.scraper import Scraper
+from twit2imgs.storer import Storer
+from twit2imgs.target import Target
+
+# marks the end of a stream of tweets
+_DONE = object()
+
+
+class Cancelled(Exception):
+    """Raised in a stage when another stage of the pipeline has failed."""
+
+
+class TargetWorker(threading.Thread):
+    """Run one target's preprocess, post_tweets and postprocess in its own thread.
+
+    Failures are recorded rather than raised, so one target can't abort the
+    others. A target which overruns its timeout is cancelled: it is given no
+    more tweets, so it stops once the tweets it already has are posted. The
+    thread is a daemon so that it doesn't keep the process alive meanwhile.
+    """
+
+    def __init__(self, key: str, target: Target, tweets: Iterable[models.Tweet]):
+        super().__init__(name=f"target:{key}", daemon=True)
+        self.key = key
+        self.target = target
+        self.tweets = tweets
+        self.cancelled = threading.Event()
+        self.result: Dict[str, Any] = dict(status="running")
+        self.start_time: Optional[float] = None
+
+    def run(self):
+        self.start_time = time.time()
+        try:
+            self.target.preprocess()
+            self.target.post_tweets(self._iter_tweets())
+            self.target.postprocess()
+            status, error = "ok", None
+        except Cancelled:
+            status, error = "cancelled", None
+        except Exception as e:
+            logger.error(f"Target {self.key} failed: {e!r}")
+            status, error = "failed", repr(e)
+
+        # a timed-out worker has already been reported
+        if self.cancelled.is_set():
+            return
+
+        metrics.observe(f"stage.target.{self.key}", self.elapsed())
+        self.result = dict(status=status, duration=round(self.elapsed(), 2))
+        if error is not None:
+            self.result["error"] = error
+
+    def _iter_tweets(self) -> Iterator[models.Tweet]:
+        for tweet in self.tweets:
+            if self.cancelled.is_set():
+                raise Cancelled()
+            yield tweet
+        if self.cancelled.is_set():
+            raise Cancelled()
+
+    def elapsed(self) -> float:
+        return time.time() - self.start_time if self.start_time else 0.0
+
+    def running(self) -> bool:
+        return self.is_alive() and not self.cancelled.is_set()
+
+    def check_timeout(self, timeout: Optional[float]):
+        """Cancel the worker if it has overrun `timeout` seconds."""
+        if timeout is not None and self.running() and self.elapsed() > timeout:
+            logger.error(f"Target {self.key} timed out after {timeout}s")
+            self.cancelled.set()
+            self.result = dict(status="timeout", duration=round(self.elapsed(), 2))
+
+
+def wait_targets(
+    workers: List[TargetWorker],
+    timeouts: Dict[str, Optional[float]],
+    poll_interval: float = 0.1,
+) -> Dict[str, dict]:
+    """Wait for every worker to finish or time out, returning their results."""
+    while any(worker.running() for worker in workers):
+        for worker in workers:
+            worker.check_timeout(timeouts.get(worker.key))
+        time.sleep(poll_interval)
+
+    return {worker.key: worker.result for worker in workers}
+
+
+def run_targets(
+    targets: Dict[str, Target],
+    tweets: List[models.Tweet],
+    timeouts: Optional[Dict[str, Optional[float]]] = None,
+) -> Dict[str, dict]:
+    """Run every target concurrently over the same tweets.
+
+    Returns the status and duration of each target, keyed like `targets`.
+    """
+    workers = [TargetWorker(key, target, tweets) for key, target in targets.items()]
+
+    for worker in workers:
+        worker.start()
+
+    return wait_targets(workers, timeouts or {})
+
+
+class Pipeline:
+    """Run the scrape, store and target stages concurrently over a stream of tweets.
+
+    Each stage runs in its own thread. Stages are connected by queues holding at
+    most `queue_size` tweets, so a slow stage applies backpressure to the stages
+    upstream of it. Every target gets its own queue, fed by the storer. A failing
+    or timed-out target is dropped from the fan-out without affecting the others,
+    whereas a failure in the scraper or storer cancels the whole pipeline.
+
+    With `max_inflight_bytes`, tweets are only admitted while the images held by
+    the pipeline fit the budget, and each image is freed once the storer and
+    every target are done with it.
+    """
+
+    def __init__(
+        self,
+        scraper: Scraper,
+        storer: Optional[Storer],
+        targets: Dict[str, Target],
+        queue_size: int = 8,
+        poll_interval: float = 0.1,
+        timeouts: Optional[Dict[str, Optional[float]]] = None,
+        max_inflight_bytes: Optional[int] = None,
+    ):
+        self.scraper = scraper
+        self.storer = storer
+        self.targets = targets
+        self.queue_size = queue_size
+        self.poll_interval = poll_interval
+        self.timeouts = timeouts or {}
+
+        self.n_scraped = 0
+        self.n_new = 0
+        self.errors: Dict[str, BaseException] = {}
+        self.target_results: Dict[str, dict] = {}
+        self._failed = threading.Event()
+
+        self.budget = None
+        if max_inflight_bytes is not None:
+            self.budget = MemoryBudget(max_inflight_bytes)
+            scraper.budget = self.budget
+        # the stages holding each tweet's image, and the tweets still held
+        self._holders = (["storer"] if storer is not None else []) + list(targets)
+        self._admitted: Dict[str, models.Tweet] = {}
+        self._admitted_lock = threading.Lock()
+        self._dropped: Set[str] = set()
+
+    def _put(self, q: queue.Queue, item, consumer: Optional[TargetWorker] = None):
+        while True:
+            if self._failed.is_set():
+                raise Cancelled()
+            # targets that have failed or timed out stop receiving tweets
+            if consumer is not None and not consumer.running():
+                if isinstance(item, models.Tweet):
+                    item.release(consumer.key)
+                self._drop(q, consumer.key)
+                return
+            try:
+                q.put(item, timeout=self.poll_interval)
+                return
+            except queue.Full:
+                continue
+
+    def _drop(self, q: queue.Queue, key: str):
+        """Release the images held for a target which has stopped."""
+        if key in self._dropped:
+            return
+        self._dropped.add(key)
+
+        while True:
+            try:
+                q.get_nowait()
+            except queue.Empty:
+                break
+
+        with self._admitted_lock:
+            held = list(self._admitted.values())
+        for tweet in held:
+            tweet.release(key)
+
+    def _free(self, tweet: models.Tweet):
+        with self._admitted_lock:
+            self._admitted.pop(str(tweet.id), None)
+
+    def _iter_queue(
+        self, q: queue.Queue, cancelled: Optional[threading.Event] = None
+    ) -> Iterator[models.Tweet]:
+        while True:
+            if self._failed.is_set() or (cancelled is not None and cancelled.is_set()):
+                raise Cancelled()
+            try:
+                item = q.get(timeout=self.poll_interval)
+            except queue.Empty:
+                continue
+            if item is _DONE:
+                return
+            yield item
+
+    def _run_stage(self, name: str, fn, *args):
+        try:
+            with metrics.timer(f"stage.{name}"):
+                fn(*args)
+        except Cancelled:
+            logger.info(f"Stage {name} cancelled")
+        except BaseException as e:
+            logger.error(f"Stage {name} failed: {e!r}")
+            self.errors[name] = e
+            self._failed.set()
+            if self.budget is not None:
+                self.budget.close()
+
+    def _scrape(self, out: queue.Queue):
+        for tweet in self.scraper.iter_scrape():
+            self.n_scraped += 1
+            self.n_new += tweet.is_new
+            if self.budget is not None:
+                with self._admitted_lock:
+                    self._admitted[str(tweet.id)] = tweet
+                tweet.hold(self.budget, self._holders, on_free=self._free)
+            self._put(out, tweet)
+
+        self._put(out, _DONE)
+
+    def _store(self, inp: queue.Queue, outs: Dict[queue.Queue, TargetWorker]):
+        tweets: Iterable[models.Tweet] = self._iter_queue(inp)
+        if self.storer is not None:
+            tweets = self.storer.iter_store(tweets)
+
+        for tweet in tweets:
+            for out, worker in outs.items():
+                self._put(out, tweet, worker)
+
+        for out, worker in outs.items():
+            self._put(out, _DONE, worker)
+
+    def run(self):
+        scraped = queue.Queue(maxsize=self.queue_size)
+
+        outs = {}
+        for key, target in self.targets.items():
+            q = queue.Queue(maxsize=self.queue_size)
+            worker = TargetWorker(key, target, None)
+            worker.tweets = self._iter_queue(q, worker.cancelled)
+            outs[q] = worker
+
+        threads = [
+            threading.Thread(
+                target=self._run_stage, args=("scraper", self._scrape, scraped)
+            ),
+            threading.Thread(
+                target=self._run_stage, args=("storer", self._store, scraped, outs)
+            ),
+        ]
+
+        for worker in outs.values():
+            worker.start()
+        for thread in threads:
+            thread.start()
+
+        self.target_results = wait_targets(
+            list(outs.values()), self.timeouts, self.poll_interval
+        )
+        for thread in threads:
+            thread.join()
+
+        if self.budget is not None:
+            # unblock any download still waiting for admission
+            self.budget.close()
+            self.budget.report()
+
+        if self.errors:
+            name, error = next(iter(self.errors.items()))
+            raise RuntimeError(f"Pipeline stage {name} failed") from error
@@ -1,58 +1,365 @@
+import threading
+import time
 from abc import ABC, abstractmethod
-from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Iterator, List, Optional, Tuple, Union
 
 import tweepy
+from loguru import logger
 
 from twit2imgs import models, utils
+from twit2imgs.cache import ImageCache
 from twit2imgs.image_utils import null_url_parser
+from twit2imgs.journal import RunJournal
+from twit2imgs.memory import MemoryBudget
+from twit2imgs.metrics import metrics
 
 
 class Scraper(ABC):
+    # set by the DAG to skip work completed by a previous, failed run
+    journal: Optional[RunJournal] = None
+    # set by a memory-bounded pipeline to hold back downloads
+    budget: Optional[MemoryBudget] = None
+
     @abstractmethod
     def scrape(self) -> List[models.Tweet]:
         pass
 
+    def iter_scrape(self) -> Iterator[models.Tweet]:
+        """Yield tweets as they become ready; by default, once scrape returns."""
+        yield from self.scrape()
+
+    def commit(self):
+        """Persist any scrape state once the rest of the DAG has succeeded."""
+        pass
+
+
+class RateLimitScheduler:
+    """Schedule API calls per endpoint, backing off until rate-limit windows reset.
+
+    A 429 on one endpoint blocks further calls to that endpoint only, until the
+    `x-rate-limit-reset` time returned by the API.
+    """
+
+    def __init__(self, max_retries: int = 3, default_backoff: float = 60.0):
+        self.max_retries = max_retries
+        self.default_backoff = default_backoff
+        self._blocked_until: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def _wait(self, endpoint: str):
+        with self._lock:
+            delay = self._blocked_until.get(endpoint, 0) - time.time()
+
+        if delay > 0:
+            logger.info(f"Rate limited on {endpoint}, waiting {delay:.0f}s")
+            time.sleep(delay)
 
-class UserScraper(Scraper):
-    """Scrape a users tweets with images."""
+    def _backoff(self, endpoint: str, response):
+        reset = None
+        if response is not None:
+            reset = response.headers.get("x-rate-limit-reset")
+
+        until = float(reset) if reset else time.time() + self.default_backoff
+
+        with self._lock:
+            self._blocked_until[endpoint] = max(
+                self._blocked_until.get(endpoint, 0), until
+            )
+
+    def call(self, endpoint: str, fn, *args, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            self._wait(endpoint)
+            try:
+                return fn(*args, **kwargs)
+            except tweepy.TooManyRequests as e:
+                if attempt == self.max_retries:
+                    raise
+                self._backoff(endpoint, e.response)
+
+
+class TwitterScraper(Scraper):
+    """Scrape tweets with images from a set of sources, one worker per source.
+
+    Subclasses define the sources and the paginated request for a single source.
+    """
+
+    endpoint: str = ""
+    min_page_size: int = 5
+    max_page_size: int = 100
 
     def __init__(
         self,
         TWITTER_API_BEARER_TOKEN: str,
-        user_id: str,
+        sources: List[str],
         tweet_fields: List[str],
         max_results: int,
         url_parser: Optional[str] = None,
+        concurrency: int = 8,
+        source_workers: int = 4,
+        cache_dir: Optional[str] = None,
+        cache_max_bytes: int = 2 * 1024**3,
+        watermark_path: Optional[str] = None,
+        incremental: bool = False,
+        max_pages: Optional[int] = None,
+        max_retries: int = 3,
     ):
         self.client = tweepy.Client(bearer_token=TWITTER_API_BEARER_TOKEN)
-        self.user_id = user_id
+        metrics.instrument_session(self.client.session, "twitter")
+        self.sources = [str(s) for s in sources]
         self.tweet_fields = tweet_fields
         self.max_results = max_results
+        self.max_pages = max_pages
         self.url_parser = (
             utils._indirect_cls(url_parser) if url_parser else null_url_parser
         )
+        self.concurrency = concurrency
+        self.source_workers = source_workers
+        self.session = metrics.instrument_session(
+            utils.pooled_session(concurrency), "images"
+        )
+        self.cache = ImageCache(cache_dir, cache_max_bytes) if cache_dir else None
+        self.scheduler = RateLimitScheduler(max_retries=max_retries)
+        self.failed_sources: List[str] = []
 
-    def scrape(self) -> List[models.Tweet]:
-        response = self.client.get_users_tweets(
-            self.user_id,
-            max_results=self.max_results,
-            tweet_fields=self.tweet_fields,
-            media_fields=["url"],
-            expansions=["attachments.media_keys"],
+        # the newest tweet id seen per source, stored locally or as a gs:// blob
+        if incremental and watermark_path is None:
+            raise ValueError("incremental scraping requires a watermark_path")
+        self.watermark_path = watermark_path
+        self.incremental = incremental
+        self.watermarks = utils.load_state(watermark_path) if watermark_path else {}
+        self._new_watermarks = dict(self.watermarks)
+
+    @abstractmethod
+    def _request(self, source: str, **kwargs) -> tweepy.Response:
+        pass
+
+    def _page_size(self, remaining: int, since_id: Optional[str] = None) -> int:
+        # incremental runs page through everything newer than the watermark,
+        # however much of the window remains, so take the largest pages
+        if since_id is not None:
+            return self.max_page_size
+        return max(self.min_page_size, min(self.max_page_size, remaining))
+
+    def _scrape_source(self, source: str) -> Tuple[list, dict]:
+        since_id = self.watermarks.get(source) if self.incremental else None
+
+        ttweets: list = []
+        img_urls: Dict[str, str] = {}
+        pagination_token = None
+        n_pages = 0
+        while True:
+            with metrics.timer(f"scraper.api.{self.endpoint}"):
+                response = self.scheduler.call(
+                    self.endpoint,
+                    self._request,
+                    source,
+                    max_results=self._page_size(
+                        self.max_results - len(ttweets), since_id
+                    ),
+                    tweet_fields=self.tweet_fields,
+                    media_fields=["url"],
+                    expansions=["attachments.media_keys"],
+                    since_id=since_id,
+                    pagination_token=pagination_token,
+                )
+            n_pages += 1
+
+            page = response.data or []
+            ttweets += page
+            img_urls.update(
+                {
+                    el.media_key: self.url_parser(el.url)
+                    for el in response.includes.get("media", [])
+                    if el.url is not None
+                }
+            )
+
+            pagination_token = response.meta.get("next_token")
+            if pagination_token is None:
+                break
+            # pages are newest first, so one reaching the watermark is the last
+            if since_id is not None and any(int(t.id) <= int(since_id) for t in page):
+                break
+            if since_id is None and len(ttweets) >= self.max_results:
+                break
+            if self.max_pages is not None and n_pages >= self.max_pages:
+                break
+
+        if since_id is None:
+            ttweets = ttweets[: self.max_results]
+
+        return ttweets, img_urls
+
+    def _scrape_sources(self) -> Tuple[list, dict, dict]:
+        ttweets, img_urls, tweet_sources = [], {}, {}
+
+        with ThreadPoolExecutor(max_workers=self.source_workers) as pool:
+            futures = {pool.submit(self._scrape_source, s): s for s in self.sources}
+
+            for future in as_completed(futures):
+                source = futures[future]
+                try:
+                    source_tweets, source_urls = future.result()
+                except Exception as e:
+                    # one failing source shouldn't fail the whole DAG
+                    logger.error(f"Failed to scrape {source}: {e!r}")
+                    self.failed_sources.append(source)
+                    continue
+
+                img_urls.update(source_urls)
+                for t in source_tweets:
+                    if t.id not in tweet_sources:
+                        tweet_sources[t.id] = source
+                        ttweets.append(t)
+
+        if self.sources and len(self.failed_sources) == len(self.sources):
+            raise RuntimeError(f"Failed to scrape all of {self.sources}")
+
+        # only keep tweets we have an image for, newest first across sources, so
+        # a streaming run posts them in the order a batch run would
+        ttweets = sorted(
+            (
+                t
+                for t in ttweets
+                if t.attachments
+                and t.attachments.get("media_keys")
+                and t.attachments["media_keys"][0] in img_urls
+            ),
+            key=lambda t: int(t.id),
+            reverse=True,
         )
 
-        img_urls = {
-            el.media_key: self.url_parser(el.url) for el in response.includes["media"]
+        return ttweets, img_urls, tweet_sources
+
+    def _mark(self, tweet: models.Tweet, source: str):
+        """Flag whether a tweet is new to its source and advance the watermark."""
+        watermark = self.watermarks.get(source)
+        tweet.is_new = watermark is None or int(tweet.id) > int(watermark)
+
+        newest = self._new_watermarks.get(source)
+        if newest is None or int(tweet.id) > int(newest):
+            self._new_watermarks[source] = str(tweet.id)
+
+    def iter_scrape(self) -> Iterator[models.Tweet]:
+        ttweets, img_urls, tweet_sources = self._scrape_sources()
+
+        for tweet in self._iter_tweets(ttweets, img_urls):
+            self._mark(tweet, tweet_sources[tweet.id])
+            yield tweet
+
+    def scrape(self) -> List[models.Tweet]:
+        # newest first, as returned by the API
+        return sorted(self.iter_scrape(), key=lambda t: int(t.id), reverse=True)
+
+    def commit(self):
+        if self.watermark_path is not None:
+            utils.save_state(self._new_watermarks, self.watermark_path)
+            self.watermarks = dict(self._new_watermarks)
+
+    def _fetch(self, ttweet, img_urls) -> bytes:
+        with metrics.timer("scraper.fetch"):
+            image_bytes = models.fetch_image(
+                models.Tweet.get_image_url(ttweet, img_urls),
+                self.session,
+                self.cache,
+                ttweet.id,
+            )
+
+        if self.journal is not None:
+            self.journal.record(ttweet.id, "downloaded", n_bytes=len(image_bytes))
+
+        return image_bytes
+
+    def _iter_tweets(self, ttweets, img_urls) -> Iterator[models.Tweet]:
+        """Download images on a bounded pool, yielding Tweets in `ttweets` order."""
+        # tweets finished with by a previous run don't need their images
+        complete = {
+            t.id
+            for t in ttweets
+            if self.journal is not None and self.journal.complete(t.id)
         }
 
-        return [models.Tweet(t, img_urls) for t in response.data]
+        def _admitted():
+            # only start each download once the memory budget has room
+            for ttweet in ttweets:
+                if self.budget is not None and ttweet.id not in complete:
+                    self.budget.admit(str(ttweet.id))
+                yield ttweet
 
+        def _fetch(ttweet) -> Optional[bytes]:
+            if ttweet.id in complete:
+                return None
+            return self._fetch(ttweet, img_urls)
 
-class HashtagScraper(Scraper):
-    """Scrape a given hashtage for tweets with images."""
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            for ttweet, future in utils.bounded_map(
+                pool,
+                _fetch,
+                _admitted(),
+                max_inflight=2 * self.concurrency,
+                # downstream stages keep this order, which is the album's
+                ordered=True,
+            ):
+                if ttweet.id in complete:
+                    yield models.Tweet(ttweet, img_urls, fetch=False)
+                else:
+                    yield models.Tweet(ttweet, img_urls, image_bytes=future.result())
 
-    def __init__(self):
-        pass
+        if self.cache is not None:
+            self.cache.flush()
 
-    def scrape(self):
-        pass
+
+class UserScraper(TwitterScraper):
+    """Scrape one or more users tweets with images."""
+
+    endpoint = "users_tweets"
+    min_page_size = 5
+
+    def __init__(
+        self,
+        TWITTER_API_BEARER_TOKEN: str,
+        user_id: Union[str, List[str]],
+        tweet_fields: List[str],
+        max_results: int,
+        **kwargs,
+    ):
+        user_ids = user_id if isinstance(user_id, list) else [user_id]
+        super().__init__(
+            TWITTER_API_BEARER_TOKEN, user_ids, tweet_fields, max_results, **kwargs
+        )
+
+    def _request(self, source: str, **kwargs) -> tweepy.Response:
+        return self.client.get_users_tweets(source, **kwargs)
+
+
+class HashtagScraper(TwitterScraper):
+    """Scrape one or more hashtags (or search queries) for tweets with images."""
+
+    endpoint = "search_recent"
+    min_page_size = 10
+
+    def __init__(
+        self,
+        TWITTER_API_BEARER_TOKEN: str,
+        hashtags: Union[str, List[str]],
+        tweet_fields: List[str],
+        max_results: int,
+        **kwargs,
+    ):
+        hashtags = hashtags if isinstance(hashtags, list) else [hashtags]
+        super().__init__(
+            TWITTER_API_BEARER_TOKEN, hashtags, tweet_fields, max_results, **kwargs
+        )
+
+    @staticmethod
+    def _query(source: str) -> str:
+        # bare hashtags are expanded to an image-only search query
+        if " " not in source:
+            source = source if source.startswith("#") else f"#{source}"
+            return f"{source} has:images -is:retweet"
+        return source
+
+    def _request(self, source: str, **kwargs) -> tweepy.Response:
+        kwargs["next_token"] = kwargs.pop("pagination_token")
+        return self.client.search_recent_tweets(self._query(source), **kwargs)
@@ -1,34 +1,354 @@
+import io
+import json
+import os
 from abc import ABC, abstractmethod
-from typing import List
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timezone
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
+
+from google.api_core.exceptions import NotFound, PreconditionFailed
+from loguru import logger
 
 from twit2imgs import models, utils
+from twit2imgs.image_utils import FORMATS, encode_image, image_format
+from twit2imgs.journal import RunJournal
+from twit2imgs.metrics import metrics
 
 
 class Storer(ABC):
+    # set by the DAG to skip work completed by a previous, failed run
+    journal: Optional[RunJournal] = None
+    # whether `iter_store` journals each tweet as "stored"
+    journals_stored: bool = False
+
     @abstractmethod
     def store(self, tweets: List[models.Tweet]) -> bool:
         pass
 
+    def iter_store(self, tweets: Iterable[models.Tweet]) -> Iterator[models.Tweet]:
+        """Store tweets as they arrive, yielding each once it is stored."""
+        for tweet in tweets:
+            self.store([tweet])
+            tweet.release("storer")
+            yield tweet
+
+    def summary(self) -> dict:
+        """Counts to report for the last call to `store`."""
+        return {}
+
 
 class GCPStore(Storer):
-    def __init__(self, bucket, record_prefix, image_prefix):
+    journals_stored = True
+    # attempts to extend a manifest index that other runs keep replacing
+    INDEX_ATTEMPTS = 5
+
+    def __init__(
+        self,
+        bucket,
+        record_prefix,
+        image_prefix,
+        skip_known=False,
+        max_workers=8,
+        dedup=False,
+        encoding=None,
+        records="blob",
+    ):
         self.bucket = bucket
         self.record_prefix = record_prefix
         self.img_prefix = image_prefix
+        self.skip_known = skip_known
+        self.max_workers = max_workers
+        self.dedup = dedup
+        # "original" stores the downloaded bytes untouched
+        self.encoding = dict(encoding or dict(format="png"))
+        # "blob" stores a record per tweet, "manifest" one json-lines shard per run
+        if records not in ("blob", "manifest"):
+            raise ValueError(
+                f"Unsupported records {records}, expected blob or manifest"
+            )
+        self.records = records
+        self._manifest: List[dict] = []
+        self._index: Dict[str, str] = {}
+        # the generation of the index read, which the index written must replace
+        self._index_generation = 0
+        self._bucket = None
+        self.stats = {}
 
-    def store(self, tweets: List[models.Tweet]) -> bool:
-        for tweet in tweets:
-            # write to file
-            tweet.image.save(f"tmp/{tweet.id}.png")
-            tweet.write_record(f"tmp/{tweet.id}.record")
+    @property
+    def bucket_handle(self):
+        # one client and bucket handle shared by every upload worker
+        if self._bucket is None:
+            client = utils.storage_client(pool_size=self.max_workers)
+            metrics.instrument_session(client._http, "gcs")
+            self._bucket = client.bucket(self.bucket)
+
+        return self._bucket
+
+    def _existing_ids(self, prefix: str) -> Set[str]:
+        """List a prefix once, returning the ids of the blobs already under it."""
+        bucket = self.bucket_handle
+        blobs = bucket.client.list_blobs(
+            bucket, prefix=f"{prefix}/", fields="items(name),nextPageToken"
+        )
+
+        return {os.path.splitext(os.path.basename(b.name))[0] for b in blobs}
+
+    @property
+    def manifest_prefix(self) -> str:
+        return f"{self.record_prefix}/manifest"
+
+    def _known_records(self) -> Set[str]:
+        """The ids of the tweets whose records are already stored."""
+        if self.records == "manifest":
+            # one request, and needed anyway to extend the index
+            self._index, self._index_generation = self._read_index()
+            return set(self._index)
 
-            # upload blob
-            utils.upload_blob(
-                f"tmp/{tweet.id}.png", f"{self.bucket}/{self.img_prefix}/{tweet.id}.png"
+        return self._existing_ids(self.record_prefix) if self.dedup else set()
+
+    def _download(self, path: str) -> bytes:
+        with metrics.timer("storer.download"):
+            return self.bucket_handle.blob(path).download_as_bytes()
+
+    def _read_index(self) -> Tuple[Dict[str, str], int]:
+        """The manifest index and its generation, which is 0 if there is none."""
+        blob = self.bucket_handle.blob(f"{self.manifest_prefix}/index.json")
+        try:
+            with metrics.timer("storer.download"):
+                data = blob.download_as_bytes()
+        except NotFound:
+            return {}, 0
+
+        return json.loads(data), blob.generation
+
+    def read_index(self) -> Dict[str, str]:
+        """The manifest index: the shard holding the record of each tweet id."""
+        return self._read_index()[0]
+
+    def _read_shard(self, path: str) -> List[dict]:
+        return [json.loads(line) for line in self._download(path).splitlines()]
+
+    def read_partition(self, day: Union[str, date]) -> List[dict]:
+        """Every record written to the manifest on a day, e.g. `2022-06-01`."""
+        bucket = self.bucket_handle
+        shards = bucket.client.list_blobs(
+            bucket,
+            prefix=f"{self.manifest_prefix}/date={day}/",
+            fields="items(name),nextPageToken",
+        )
+
+        return [record for b in shards for record in self._read_shard(b.name)]
+
+    def read_records(self, ids: Iterable[str]) -> Dict[str, dict]:
+        """The manifest records of `ids`, downloading each shard needed once."""
+        index = self.read_index()
+        by_shard = defaultdict(set)
+        for tweet_id in map(str, ids):
+            if tweet_id in index:
+                by_shard[index[tweet_id]].add(tweet_id)
+
+        return {
+            str(record["id"]): record
+            for shard, shard_ids in by_shard.items()
+            for record in self._read_shard(shard)
+            if str(record["id"]) in shard_ids
+        }
+
+    def _write_manifest(self):
+        """Upload the records of this run as one shard, then extend the index."""
+        records, self._manifest = self._manifest, []
+        if not records:
+            return
+
+        now = datetime.now(timezone.utc)
+        shard = f"{self.manifest_prefix}/date={now:%Y-%m-%d}/{now:%H%M%S%f}.jsonl"
+        data = "".join(json.dumps(record) + "\n" for record in records).encode()
+        shard_index = {str(record["id"]): shard for record in records}
+
+        bucket = self.bucket_handle
+        with metrics.timer("storer.upload"):
+            utils.upload_buffer(
+                io.BytesIO(data),
+                f"{self.bucket}/{shard}",
+                bucket=bucket,
+                content_type="application/x-ndjson",
             )
-            utils.upload_blob(
-                f"tmp/{tweet.id}.record",
-                f"{self.bucket}/{self.record_prefix}/{tweet.id}.record",
+        metrics.incr("storer.bytes_uploaded", len(data))
+
+        # only replace the index read, so a concurrent run's shards aren't dropped
+        for _ in range(self.INDEX_ATTEMPTS):
+            self._index.update(shard_index)
+            index = json.dumps(self._index).encode()
+            blob = bucket.blob(f"{self.manifest_prefix}/index.json")
+            try:
+                with metrics.timer("storer.upload"):
+                    blob.upload_from_file(
+                        io.BytesIO(index),
+                        content_type="application/json",
+                        if_generation_match=self._index_generation,
+                    )
+            except PreconditionFailed:
+                logger.info("Manifest index changed since it was read, merging")
+                self._index, self._index_generation = self._read_index()
+                continue
+
+            self._index_generation = blob.generation
+            metrics.incr("storer.bytes_uploaded", len(index))
+            break
+        else:
+            raise RuntimeError(
+                f"Could not extend the manifest index after {self.INDEX_ATTEMPTS} "
+                f"attempts, the records are in gs://{self.bucket}/{shard}"
             )
 
+        logger.info(f"Wrote {len(records)} records to gs://{self.bucket}/{shard}")
+
+    def _blobs(
+        self, tweet: models.Tweet, store_image=True, store_record=True
+    ) -> Tuple[List[Tuple[str, bytes, Optional[str]]], int]:
+        """Encode what to upload for a tweet, shared by the sync and async engines.
+
+        Returns the (name, data, content type) of each blob, and the size of the
+        image stored. Records kept in a manifest are queued for `_write_manifest`
+        rather than uploaded.
+        """
+        blobs = []
+        n_bytes = 0
+        original_bytes = tweet.image_bytes
+
+        if store_image and original_bytes is not None:
+            # encode in memory
+            if self.encoding["format"] == "original":
+                image_bytes = original_bytes
+                fmt = image_format(image_bytes)
+            else:
+                with metrics.timer("storer.encode"):
+                    image_bytes = encode_image(tweet.image, **self.encoding)
+                tweet.release_image()
+                fmt = self.encoding["format"]
+
+            spec = FORMATS.get(fmt, dict(ext=fmt, content_type=None))
+            n_bytes = len(image_bytes)
+            blobs.append(
+                (
+                    f"{self.img_prefix}/{tweet.id}.{spec['ext']}",
+                    image_bytes,
+                    spec["content_type"],
+                )
+            )
+        elif store_image:
+            # a resumed run doesn't fetch the images of the tweets it finished
+            logger.warning(f"No image bytes for tweet {tweet.id}, not storing image")
+
+        if store_record and self.records == "manifest":
+            # uploaded with the rest of the run's records by _write_manifest
+            self._manifest.append(tweet.record())
+        elif store_record:
+            blobs.append(
+                (
+                    f"{self.record_prefix}/{tweet.id}.record",
+                    json.dumps(tweet.record()).encode(),
+                    "application/json",
+                )
+            )
+
+        return blobs, n_bytes
+
+    def _store_tweet(
+        self, tweet: models.Tweet, bucket, store_image=True, store_record=True
+    ):
+        blobs, n_bytes = self._blobs(tweet, store_image, store_record)
+
+        for name, data, content_type in blobs:
+            with metrics.timer("storer.upload"):
+                utils.upload_buffer(
+                    io.BytesIO(data),
+                    f"{self.bucket}/{name}",
+                    bucket=bucket,
+                    content_type=content_type,
+                )
+            metrics.incr("storer.bytes_uploaded", len(data))
+
+        return n_bytes
+
+    def _begin(self) -> Tuple[Set[str], Set[str]]:
+        """Reset the stats, returning the ids of the images and records stored."""
+        self.stats = dict(stored=0, skipped=0, image_bytes=0)
+        image_ids = self._existing_ids(self.img_prefix) if self.dedup else set()
+
+        return image_ids, self._known_records()
+
+    def _to_store(
+        self, tweet: models.Tweet, image_ids: Set[str], record_ids: Set[str]
+    ) -> Tuple[bool, bool]:
+        """Whether to store a tweet's image, and its record."""
+        store_record = str(tweet.id) not in record_ids
+        # tweets seen on a previous run were already stored, as were tweets
+        # stored by a previous, failed run, although a run killed outright
+        # never wrote its manifest and appending a record costs no request
+        if (self.skip_known and not tweet.is_new) or (
+            self.journal is not None and self.journal.done(tweet.id, "stored")
+        ):
+            return False, self.records == "manifest" and store_record
+        return str(tweet.id) not in image_ids, store_record
+
+    def _journal_stored(self, tweet: models.Tweet):
+        # tweets already in the bucket count as stored too
+        if self.journal is not None and not self.journal.done(tweet.id, "stored"):
+            self.journal.record(tweet.id, "stored")
+
+    def _count(self, n_bytes: int, stored: bool):
+        self.stats["image_bytes"] += n_bytes
+        self.stats["stored" if stored else "skipped"] += 1
+
+    def _log_stats(self):
+        logger.info(
+            f"Stored {self.stats['stored']} tweets to gs://{self.bucket}, "
+            f"skipped {self.stats['skipped']} already stored, "
+            f"{self.stats['image_bytes']} image bytes as {self.encoding}"
+        )
+
+    def iter_store(self, tweets: Iterable[models.Tweet]) -> Iterator[models.Tweet]:
+        image_ids, record_ids = self._begin()
+
+        def _job(tweet):
+            return (tweet, *self._to_store(tweet, image_ids, record_ids))
+
+        bucket = self.bucket_handle
+
+        def _store_job(job):
+            tweet, store_image, store_record = job
+            n_bytes = self._store_tweet(tweet, bucket, store_image, store_record)
+            self._journal_stored(tweet)
+            return n_bytes
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                for job, future in utils.bounded_map(
+                    pool,
+                    _store_job,
+                    map(_job, tweets),
+                    2 * self.max_workers,
+                    # release the image as soon as it is stored, not once yielded
+                    on_done=lambda job, future: job[0].release("storer"),
+                    # keep the scraper's order, which is the album's
+                    ordered=True,
+                ):
+                    self._count(future.result(), job[1] or job[2])
+                    yield job[0]
+        finally:
+            # even if a later stage fails, keep the records of the tweets stored
+            if self.records == "manifest":
+                self._write_manifest()
+
+        self._log_stats()
+
+    def store(self, tweets: List[models.Tweet]) -> bool:
+        for _ in self.iter_store(tweets):
+            pass
+
         return True
+
+    def summary(self) -> dict:
+        return self.stats
@@ -1,16 +1,52 @@
+import multiprocessing
+import os
+import re
+import time
 from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
 
+from loguru import logger
+
+from twit2imgs import models, utils
 from twit2imgs.google_photos_client import GooglePhotosClient
-from twit2imgs.image_utils import beautiful_s2_to_16_9_labelled
+from twit2imgs.image_utils import render_labelled
+from twit2imgs.journal import RunJournal
+from twit2imgs.metrics import metrics
+
+
+def _render_job(job: tuple) -> Tuple[bytes, float]:
+    # module level so it can be pickled to worker processes
+    _, image_bytes, txt, output_width, encoding = job
+
+    start = time.perf_counter()
+    photo_bytes = render_labelled(image_bytes, txt, output_width, encoding)
+
+    return photo_bytes, time.perf_counter() - start
 
 
 class Target(ABC):
+    # set by the DAG: the target's key in the config, a journal of the work
+    # completed by a previous, failed run, and the scraper's list of the sources
+    # it failed to scrape, complete once the tweets given have all been consumed
+    name: str = ""
+    journal: Optional[RunJournal] = None
+    failed_sources: Sequence[str] = ()
+    # whether post_tweets must be given every tweet the target should hold, not
+    # only new ones, e.g. because it replaces or syncs its contents with them
+    needs_all_tweets: bool = False
+
     @abstractmethod
     def preprocess(self):
         pass
 
     @abstractmethod
-    def post_tweets(self):
+    def post_tweets(self, tweets: Iterable[models.Tweet]):
+        """Post tweets, consuming `tweets` lazily so it can be a stream.
+
+        Call `tweet.release(self.name)` once done with each tweet's image, so a
+        memory-bounded pipeline can free it.
+        """
         pass
 
     @abstractmethod
@@ -19,21 +55,199 @@ class Target(ABC):
 
 
 class GooglePhotosTarget(Target):
-    def __init__(self, album_name, client_params):
+    # media items are tagged with their tweet id so later runs can diff the album
+    DESCRIPTION = "tweet {id}"
+    DESCRIPTION_RE = re.compile(r"^tweet (\d+)$")
+    # the album is cleared, or synced, to hold exactly the tweets posted
+    needs_all_tweets = True
+
+    def __init__(
+        self,
+        album_name,
+        client_params,
+        sync=False,
+        render_workers: Optional[int] = None,
+        output_width: Optional[int] = None,
+        encoding: Optional[dict] = None,
+    ):
         self.client = GooglePhotosClient(**client_params)
         self.album_id = self.client._get_album_id(album_name)
+        self.sync = sync
+        self.render_workers = render_workers
+        self.output_width = output_width
+        self.encoding = encoding or dict(format="png")
+        # the media items of each tweet id in the album, and those without one
+        self.album_items: Dict[str, List[str]] = {}
+        self.untagged_items: List[str] = []
+
+    def _stage(self, stage: str) -> str:
+        return f"{self.name}.{stage}"
+
+    def _pending_uploads(self) -> dict:
+        """Tweet ids uploaded by a previous run but never added to the album."""
+        if self.journal is None:
+            return {}
+
+        created = self.journal.stage(self._stage("created"))
+        return {
+            tweet_id: entry["upload_token"]
+            for tweet_id, entry in self.journal.stage(self._stage("uploaded")).items()
+            if tweet_id not in created and tweet_id not in self.album_items
+        }
+
+    def _record(self, stage: str, description: Optional[str], **details):
+        match = self.DESCRIPTION_RE.match(description or "")
+        if self.journal is not None and match:
+            self.journal.record(match.group(1), self._stage(stage), **details)
+
+    def _resuming(self) -> bool:
+        """Whether a previous run had begun uploading to the album."""
+        return self.journal is not None and bool(
+            self.journal.stage(self._stage("uploaded"))
+        )
+
+    def _should_post(self, tweet: models.Tweet, pending: dict) -> bool:
+        if self.sync and str(tweet.id) in self.album_items:
+            return False
+        # skip tweets a previous run added, or uploaded but didn't add
+        if self.journal is not None and (
+            self.journal.done(tweet.id, self._stage("created"))
+            or str(tweet.id) in pending
+        ):
+            return False
+        return True
+
+    def _stale_items(self, desired: set) -> list:
+        """Media items for tweets no longer in the stream, or duplicating another."""
+        if self.failed_sources:
+            # the stream lacks the tweets of the sources which failed
+            logger.warning(
+                f"Not removing stale items: failed to scrape {list(self.failed_sources)}"
+            )
+            return []
+
+        stale = []
+        for tweet_id, media_ids in self.album_items.items():
+            # keep one media item per tweet still in the stream
+            stale += media_ids[1:] if tweet_id in desired else media_ids
+
+        return stale + self.untagged_items
+
+    def _admit(self, tweet: models.Tweet, pending: dict, desired: set) -> bool:
+        """Note a tweet as desired, and whether to post it, releasing it if not."""
+        desired.add(str(tweet.id))
+        if self._should_post(tweet, pending):
+            return True
+        tweet.release(self.name)
+        return False
+
+    def _upload_kwargs(self, pending: dict) -> dict:
+        """The earlier uploads and journal callbacks to give `upload_photos`."""
+        return dict(
+            upload_tokens=[
+                (upload_token, self.DESCRIPTION.format(id=tweet_id))
+                for tweet_id, upload_token in pending.items()
+            ],
+            on_upload=lambda description, upload_token: self._record(
+                "uploaded", description, upload_token=upload_token
+            ),
+            on_create=lambda item: self._record(
+                "created", item.get("description"), media_item_id=item["id"]
+            ),
+        )
+
+    def _sync_removals(self, created: list, desired: set) -> list:
+        # only known once the whole tweet stream has been consumed
+        stale = self._stale_items(desired)
+        logger.info(f"Syncing album: added {len(created)} items, removing {len(stale)}")
+
+        return stale
+
+    def _rendered(self, tweet_id, photo_bytes: bytes, seconds: float) -> tuple:
+        """Record a finished render, returning the photo to upload."""
+        metrics.observe("target.render", seconds)
+        description = self.DESCRIPTION.format(id=tweet_id)
+        self._record("rendered", description, n_bytes=len(photo_bytes))
+
+        return photo_bytes, description
+
+    def _render_args(self, tweet: models.Tweet) -> tuple:
+        return (
+            tweet.id,
+            tweet.image_bytes,
+            tweet.text,
+            self.output_width,
+            self.encoding,
+        )
 
     def preprocess(self):
-        # clear the google bucket
-        self.client.clear_album(self.album_id)
+        if not self.sync:
+            # clear the google bucket, unless resuming a run which had begun
+            # uploading to it
+            if self._resuming():
+                logger.info("Resuming uploads, not clearing the album")
+                return
+            self.client.clear_album(self.album_id)
+            return
+
+        self._map_album(self.client.get_album_items(self.album_id))
+
+    def _map_album(self, items: Iterable[dict]):
+        # map the tweet ids already in the album to their media items
+        for item in items:
+            match = self.DESCRIPTION_RE.match(item.get("description", ""))
+            if match:
+                self.album_items.setdefault(match.group(1), []).append(item["id"])
+            else:
+                self.untagged_items.append(item["id"])
+
+    def post_tweets(self, tweets: Iterable[models.Tweet]):
+        desired: set = set()
+        pending = self._pending_uploads()
+
+        # post images to the google bucket as they are rendered
+        created = self.client.upload_photos(
+            self.album_id,
+            self._render(t for t in tweets if self._admit(t, pending, desired)),
+            **self._upload_kwargs(pending),
+        )
+
+        if self.sync:
+            stale = self._sync_removals(created, desired)
+            if stale:
+                self.client.remove_mediaitems(self.album_id, stale)
+
+    def _render(self, tweets: Iterable[models.Tweet]):
+        """Render tweets on a process pool, yielding encoded bytes in tweet order."""
+        # spawn rather than fork: the parent is running upload threads
+        ctx = multiprocessing.get_context("spawn")
+        n_workers = self.render_workers or os.cpu_count() or 1
+
+        # the tweets being rendered, released once their render finishes
+        rendering = {}
+
+        def _jobs():
+            for t in tweets:
+                rendering[t.id] = t
+                yield self._render_args(t)
 
-    def post_tweets(self, tweets):
-        # post images to the google bucket
-        formatted_images = []
-        for t in tweets:
-            formatted_images.append(beautiful_s2_to_16_9_labelled(t.image, t.text))
+        n_images, n_bytes = 0, 0
+        with ProcessPoolExecutor(n_workers, mp_context=ctx) as pool:
+            for job, future in utils.bounded_map(
+                pool,
+                _render_job,
+                _jobs(),
+                2 * n_workers,
+                on_done=lambda job, future: rendering.pop(job[0]).release(self.name),
+                # the album is ordered as the photos are given to upload_photos
+                ordered=True,
+            ):
+                photo_bytes, seconds = future.result()
+                n_images += 1
+                n_bytes += len(photo_bytes)
+                yield self._rendered(job[0], photo_bytes, seconds)
 
-        self.client.upload_images(self.album_id, formatted_images)
+        logger.info(f"Rendered {n_images} images as {self.encoding}: {n_bytes} bytes")
 
     def postprocess(self):
         pass
@@ -3,11 +3,19 @@ import importlib
 import io
 import json
 import os
+import queue
+import random
 import re
+import threading
+from concurrent.futures import Executor, Future
 from datetime import datetime, timedelta  # noqa
-from typing import Dict
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, Tuple, Union
 
+import requests
+from google.api_core.exceptions import NotFound
 from google.cloud import storage
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 def _indirect_cls(path):
@@ -60,6 +68,161 @@ def walk_dict(d, f):
     return d
 
 
+def bounded_map(
+    pool: Executor,
+    fn: Callable,
+    items: Iterable,
+    max_inflight: int,
+    on_done: Optional[Callable[[Any, Future], None]] = None,
+    ordered: bool = False,
+) -> Iterator[Tuple[Any, Future]]:
+    """Map `fn` over `items` on `pool`, yielding (item, future) as futures finish.
+    Items are consumed lazily and at most `max_inflight` futures are pending at a
+    time, so a slow consumer holds back both the pool and the input iterable.
+    Items are pulled on a feeder thread, so finished futures are yielded even
+    while `items` is waiting for its next input. If the consumer stops early,
+    the feeder stops at its next wait for a slot, but it is left blocked in
+    `items` until that yields, so whatever `items` waits on must be released
+    separately, e.g. by closing a `MemoryBudget`.
+    Args:
+        pool (Executor): the executor to submit work to
+        fn (Callable): the function to apply to each item
+        items (Iterable): the inputs, possibly a lazy iterator
+        max_inflight (int): the maximum number of submitted, unyielded futures
+        on_done (Callable): called with each item and its future as soon as it
+            finishes, before it is yielded
+        ordered (bool): yield in the order of `items`, holding back futures that
+            finish early, which still count towards `max_inflight`
+    Returns:
+        Iterator[Tuple[Any, Future]]: each item with its completed future
+    """
+    finished: queue.Queue = queue.Queue()
+    slots = threading.Semaphore(max_inflight)
+    stopped = threading.Event()
+    end = object()
+
+    def _finished(ii, item, future):
+        try:
+            if on_done is not None:
+                on_done(item, future)
+        finally:
+            finished.put((ii, item, future))
+
+    def _feed():
+        n_submitted, error = 0, None
+        try:
+            for item in items:
+                # wait for a slot, unless the consumer has gone
+                while not slots.acquire(timeout=0.1):
+                    if stopped.is_set():
+                        return
+                if stopped.is_set():
+                    return
+                pool.submit(fn, item).add_done_callback(
+                    functools.partial(_finished, n_submitted, item)
+                )
+                n_submitted += 1
+        except BaseException as e:
+            error = e
+        finished.put((n_submitted, end, (n_submitted, error)))
+
+    threading.Thread(target=_feed, name="bounded_map", daemon=True).start()
+
+    n_yielded, n_submitted, error = 0, None, None
+    # finished futures not yet yielded, by submission order
+    held: Dict[int, Tuple[Any, Future]] = {}
+    try:
+        while n_submitted is None or n_yielded < n_submitted:
+            ii, item, future = finished.get()
+            if item is end:
+                n_submitted, error = future
+                continue
+            held[ii] = item, future
+            next_ii = n_yielded if ordered else ii
+            while next_ii in held:
+                item, future = held.pop(next_ii)
+                slots.release()
+                n_yielded += 1
+                next_ii += 1
+                yield item, future
+    finally:
+        stopped.set()
+
+    if error is not None:
+        raise error
+
+
+class JitteredRetry(Retry):
+    """Exponential backoff with full jitter, so concurrent retries spread out.
+
+    As for `Retry`, only idempotent methods are retried on a 5xx, since a POST
+    such as batchCreate may have been applied before the server failed. A 429
+    was refused outright, so it is retried whatever the method.
+    """
+
+    def get_backoff_time(self) -> float:
+        return random.uniform(0, super().get_backoff_time())
+
+    def is_retry(
+        self, method: str, status_code: int, has_retry_after: bool = False
+    ) -> bool:
+        if status_code == 429:
+            return True
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+def pooled_session(
+    pool_size: int = 10,
+    session: Optional[requests.Session] = None,
+    retries: Optional[int] = None,
+    backoff_factor: float = 0.5,
+) -> requests.Session:
+    """Size a requests session's connection pool to serve `pool_size` threads.
+    Args:
+        pool_size (int): the number of connections to keep alive per host
+        session (requests.Session): an existing session to configure, else a new one
+        retries (int): if given, retry connection errors, 429s and, for idempotent
+            methods, 5xxs this many times, with jittered exponential backoff,
+            honouring Retry-After
+        backoff_factor (float): the base of the backoff, in seconds
+    Returns:
+        requests.Session: a session safe to share across a thread pool
+    """
+    session = session if session is not None else requests.Session()
+
+    max_retries: Union[int, Retry] = 0
+    if retries is not None:
+        max_retries = JitteredRetry(
+            total=retries,
+            # a request that failed mid-read may have been applied
+            read=0,
+            status_forcelist=(429, 500, 502, 503, 504),
+            backoff_factor=backoff_factor,
+            raise_on_status=False,
+        )
+
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=max_retries
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    return session
+
+
+def storage_client(pool_size: int = 10, **kwargs) -> storage.Client:
+    """Build a storage client whose connection pool can serve `pool_size` threads.
+    Args:
+        pool_size (int): the number of concurrent requests to support
+    Returns:
+        storage.Client: a client to share across a thread pool
+    """
+    client = storage.Client(**kwargs)
+    pooled_session(pool_size, session=client._http)
+
+    return client
+
+
 def download_blob(url: str) -> io.BytesIO:
     """Download a blob as bytes
     Args:
@@ -98,11 +261,16 @@ def download_blob_to_filename(url: str, local_path: str) -> int:
     return 1
 
 
-def upload_blob(source_directory: str, target_directory: str):
+def upload_blob(
+    source_directory: str,
+    target_directory: str,
+    bucket: Optional[storage.Bucket] = None,
+):
     """Function to save file to a bucket.
     Args:
         target_directory (str): Destination file path.
         source_directory (str): Source file path
+        bucket (storage.Bucket): an existing bucket handle to reuse
     Returns:
         None: Returns nothing.
     Examples:
@@ -111,12 +279,12 @@ def upload_blob(source_directory: str, target_directory: str):
         >>> save_file_to_bucket(target_directory)
     """
 
-    client = storage.Client()
-
     bucket_id = target_directory.split("/")[0]
     file_path = "/".join(target_directory.split("/")[1:])
 
-    bucket = client.get_bucket(bucket_id)
+    if bucket is None:
+        client = storage.Client()
+        bucket = client.get_bucket(bucket_id)
 
     # get blob
     blob = bucket.blob(file_path)
@@ -127,6 +295,34 @@ def upload_blob(source_directory: str, target_directory: str):
     return target_directory
 
 
+def upload_buffer(
+    buf: io.IOBase,
+    target_directory: str,
+    bucket: Optional[storage.Bucket] = None,
+    content_type: Optional[str] = None,
+):
+    """Function to stream an in-memory buffer to a bucket, without a local file.
+    Args:
+        buf (io.IOBase): a readable file-like object, e.g. io.BytesIO.
+        target_directory (str): Destination file path.
+        bucket (storage.Bucket): an existing bucket handle to reuse
+        content_type (str): the content type of the blob
+    Returns:
+        str: the destination file path.
+    """
+    bucket_id = target_directory.split("/")[0]
+    file_path = "/".join(target_directory.split("/")[1:])
+
+    if bucket is None:
+        client = storage.Client()
+        bucket = client.get_bucket(bucket_id)
+
+    blob = bucket.blob(file_path)
+    blob.upload_from_file(buf, rewind=True, content_type=content_type)
+
+    return target_directory
+
+
 def download_cloud_json(target_file: str, **kwargs) -> Dict:
     """
     Function to load the json data for the WorldFloods bucket using the filename
@@ -176,3 +372,60 @@ def cloud_file_exists(full_path: str, **kwargs) -> bool:
     blob = bucket.blob(remaining_path)
     # check if it exists
     return blob.exists()
+
+
+def upload_json(data: Dict, target_file: str, **kwargs) -> str:
+    """Function to write a dictionary as a json blob, without a local file.
+    Args:
+      data (dict): the json-serialisable data to write.
+      target_file (str): the full path from bucket to file.
+    Returns:
+      The path of the written blob.
+    """
+    client = storage.Client(**kwargs)
+
+    bucket_id = target_file.split("/")[0]
+    file_path = "/".join(target_file.split("/")[1:])
+
+    bucket = client.bucket(bucket_id)
+    blob = bucket.blob(file_path)
+    blob.upload_from_string(json.dumps(data), content_type="application/json")
+
+    return target_file
+
+
+def load_state(path: str) -> Dict:
+    """Load a small json state blob, from the cloud if `path` starts with gs://.
+    Args:
+      path (str): a local path, or gs://{bucket}/{path/to/file}.
+    Returns:
+      The state dictionary, or an empty dictionary if no state exists yet.
+    """
+    if path.startswith("gs://"):
+        try:
+            return download_cloud_json(path[len("gs://") :])  # noqa
+        except NotFound:
+            return {}
+
+    if not os.path.exists(path):
+        return {}
+
+    return json.load(open(path))
+
+
+def save_state(state: Dict, path: str) -> str:
+    """Save a small json state blob, to the cloud if `path` starts with gs://.
+    Args:
+      state (dict): the json-serialisable state.
+      path (str): a local path, or gs://{bucket}/{path/to/file}.
+    Returns:
+      The path the state was written to.
+    """
+    if path.startswith("gs://"):
+        return upload_json(state, path[len("gs://") :])  # noqa
+
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    json.dump(state, open(path, "w"))
+
+    return path
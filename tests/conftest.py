@@ -0,0 +1,95 @@
+import threading
+from contextlib import ExitStack
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from typing import Callable, List, Optional
+
+import pytest
+
+from benchmarks import bench_dag
+from benchmarks.fakes import FakeServiceAdapter, FakeTwitterClient, synthetic_jpeg
+from twit2imgs import models
+
+
+class Services:
+    """The fake services a DAG run in `workdir` talks to."""
+
+    def __init__(self, workdir: str, adapter: FakeServiceAdapter):
+        self.workdir = workdir
+        self.adapter = adapter
+        self.album_id = adapter.album(bench_dag.ALBUM)
+        self.n_tweets = 12
+
+    def twitter(self, **kwargs) -> FakeTwitterClient:
+        return FakeTwitterClient(self.n_tweets)
+
+    def config(self, streaming: bool = False, **pipeline) -> dict:
+        cfg = bench_dag.bench_config(self.n_tweets, streaming, self.workdir)
+        cfg["pipeline"].update(pipeline)
+        cfg["targets"]["GooglePhotos"]["params"]["render_workers"] = 1
+        return cfg
+
+    def run(self, cfg: dict, *args: str):
+        return bench_dag.run_dag(self.workdir, cfg, *args)
+
+    @property
+    def album(self) -> List[dict]:
+        return self.adapter.media_items[self.album_id]
+
+    def album_tweet_ids(self) -> List[str]:
+        return [item["description"].split()[-1] for item in self.album]
+
+
+@pytest.fixture(scope="session")
+def image_bytes() -> bytes:
+    return synthetic_jpeg(64)
+
+
+@pytest.fixture
+def make_tweet(image_bytes) -> Callable[..., models.Tweet]:
+    """Make a Tweet holding `data`, by default a small jpeg."""
+
+    def _make(tweet_id: str, data: Optional[bytes] = None) -> models.Tweet:
+        ttweet = SimpleNamespace(
+            id=tweet_id, text="", attachments=dict(media_keys=["media"])
+        )
+        return models.Tweet(
+            ttweet, dict(media="url"), image_bytes=image_bytes if data is None else data
+        )
+
+    return _make
+
+
+@pytest.fixture
+def services(tmp_path, image_bytes):
+    services = Services(str(tmp_path), FakeServiceAdapter(image_bytes))
+
+    with ExitStack() as stack:
+        bench_dag.patch_services(
+            stack, services.workdir, services.adapter, services.twitter
+        )
+        yield services
+
+
+@pytest.fixture
+def flaky_server():
+    """A server failing each path's first request with the status in its path."""
+    calls = {}
+
+    class Handler(BaseHTTPRequestHandler):
+        def _respond(self):
+            n_calls = calls[self.path] = calls.get(self.path, 0) + 1
+            status = int(self.path.strip("/")) if n_calls == 1 else 200
+            self.send_response(status)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        do_GET = do_POST = _respond
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}", calls
+    server.shutdown()
@@ -0,0 +1,156 @@
+import asyncio
+import os
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("aiohttp")
+
+from twit2imgs.aio import (  # noqa: E402
+    AsyncGooglePhotosClient,
+    AsyncHTTP,
+    AsyncPipeline,
+    abounded_map,
+)
+from twit2imgs.google_photos_client import GooglePhotosClient  # noqa: E402
+
+
+class RecordingHTTP:
+    """An AsyncHTTP stand-in recording the headers of each request."""
+
+    max_inflight = per_host = 4
+
+    def __init__(self):
+        self.headers = {}
+
+    async def request(self, method, url, name, **kwargs):
+        path = url.rsplit("/", 1)[-1]
+        self.headers[path] = kwargs["headers"]
+        return 200, {}, b"upload-token" if path == "uploads" else b"{}"
+
+
+@pytest.mark.parametrize(
+    "method, status, retried",
+    [("GET", 503, True), ("POST", 503, False), ("POST", 429, True)],
+)
+def test_async_http_retries(flaky_server, method, status, retried):
+    url, calls = flaky_server
+
+    async def _request():
+        async with AsyncHTTP(max_retries=2, backoff_factor=0) as http:
+            return await http.request(method, f"{url}/{status}", "test")
+
+    response_status, _, _ = asyncio.run(_request())
+
+    assert response_status == (200 if retried else status)
+    assert calls[f"/{status}"] == (2 if retried else 1)
+
+
+def test_photos_requests_send_json():
+    http = RecordingHTTP()
+    client = SimpleNamespace(
+        session=None,
+        cache=None,
+        BATCH_REMOVE_LIMIT=50,
+        BATCH_CREATE_LIMIT=50,
+        _update_album_items=lambda *args, **kwargs: None,
+        _create_body=GooglePhotosClient._create_body,
+        _created_items=GooglePhotosClient._created_items,
+    )
+    photos = AsyncGooglePhotosClient(client, http)
+
+    async def _requests():
+        await photos.remove_mediaitems("album", ["a", "b"])
+        await photos._batch_create("album", [])
+        await photos._upload_bytes(b"image", "photo")
+
+    asyncio.run(_requests())
+
+    json_type = {"Content-type": "application/json"}
+    assert json_type.items() <= http.headers["album:batchRemoveMediaItems"].items()
+    assert json_type.items() <= http.headers["mediaItems:batchCreate"].items()
+    assert http.headers["uploads"]["Content-type"] == "application/octet-stream"
+
+
+def test_abounded_map_ordered_yields_in_input_order():
+    async def _work(x):
+        await asyncio.sleep(0.01 * (5 - x % 5))
+        return x
+
+    async def _map():
+        return [
+            task.result()
+            async for _, task in abounded_map(_work, range(15), 4, ordered=True)
+        ]
+
+    assert asyncio.run(_map()) == list(range(15))
+
+
+class ListScraper:
+    def __init__(self, tweets):
+        self.tweets = tweets
+
+    async def aiter_scrape(self):
+        for tweet in self.tweets:
+            yield tweet
+
+
+class StubTarget:
+    """An async target collecting tweets, optionally failing or hanging."""
+
+    def __init__(self, fail=False, hang=False):
+        self.fail, self.hang = fail, hang
+        self.posted = []
+
+    async def preprocess(self):
+        pass
+
+    async def post_tweets(self, tweets):
+        async for tweet in tweets:
+            if self.fail:
+                raise ValueError("target broke")
+            if self.hang:
+                await asyncio.sleep(10)
+            self.posted.append(tweet.id)
+
+    async def postprocess(self):
+        pass
+
+
+def test_async_pipeline_isolates_failing_targets(make_tweet):
+    tweets = [make_tweet(str(ii)) for ii in range(5)]
+    targets = dict(
+        ok=StubTarget(), bad=StubTarget(fail=True), slow=StubTarget(hang=True)
+    )
+    pipeline = AsyncPipeline(
+        ListScraper(tweets), None, targets, queue_size=1, timeouts=dict(slow=0.1)
+    )
+
+    asyncio.run(pipeline.run())
+
+    assert targets["ok"].posted == [t.id for t in tweets]
+    assert pipeline.n_scraped == 5
+    assert pipeline.target_results["ok"]["status"] == "ok"
+    assert pipeline.target_results["bad"]["status"] == "failed"
+    assert "target broke" in pipeline.target_results["bad"]["error"]
+    assert pipeline.target_results["slow"]["status"] == "timeout"
+
+
+def test_async_dag_posts_every_tweet(services):
+    cfg = services.config(engine="async")
+    cfg["targets"]["GooglePhotos"]["params"]["sync"] = True
+    assert services.run(cfg) == 200
+
+    tweet_ids = services.album_tweet_ids()
+    assert len(tweet_ids) == services.n_tweets
+    assert tweet_ids == sorted(tweet_ids, key=int, reverse=True)
+    assert len(os.listdir(os.path.join(services.workdir, "gcs/bench/images"))) == (
+        services.n_tweets
+    )
+
+    # two newer tweets push the two oldest out of the album
+    services.n_tweets += 2
+    assert services.run(cfg) == 200
+
+    assert len(services.album) == services.n_tweets - 2
+    assert len(services.adapter.uploads) == services.n_tweets
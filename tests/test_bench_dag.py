@@ -0,0 +1,12 @@
+from benchmarks import bench_dag
+
+
+def test_benchmark_runs_the_dag_offline(image_bytes):
+    budget = 10**6
+
+    report = bench_dag.run(6, image_bytes, 0.0, True, max_inflight_bytes=budget)
+    summary = bench_dag.summarise(report)
+
+    assert summary["album_items"] == 6
+    assert "stage.storer" in summary["stages"]
+    assert 0 < report["counters"]["memory.high_water_bytes"] <= budget
@@ -0,0 +1,21 @@
+from twit2imgs.cache import ImageCache
+
+
+def test_image_cache_persists_across_instances(tmp_path):
+    cache = ImageCache(str(tmp_path))
+    assert cache.get("https://example.com/a.jpg") is None
+
+    cache.put("https://example.com/a.jpg", b"image", tweet_id="1")
+
+    reopened = ImageCache(str(tmp_path))
+    assert reopened.get("https://example.com/a.jpg") == b"image"
+    assert reopened.tweet_ids() == {"1"}
+
+
+def test_image_cache_evicts_least_recently_used(tmp_path):
+    cache = ImageCache(str(tmp_path), max_bytes=10)
+    cache.put("a", b"123456")
+    cache.put("b", b"123456")
+
+    assert cache.get("a") is None
+    assert cache.get("b") == b"123456"
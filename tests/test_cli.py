@@ -0,0 +1,126 @@
+import os
+import time
+
+import pytest
+import requests
+
+from twit2imgs import cli, scraper, storer
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_dag_posts_every_tweet(services, streaming):
+    assert services.run(services.config(streaming)) == 200
+
+    assert len(services.album) == services.n_tweets
+    assert len(os.listdir(os.path.join(services.workdir, "gcs/bench/images"))) == (
+        services.n_tweets
+    )
+
+
+def test_streaming_dag_posts_newest_first(services, monkeypatch):
+    fetch = scraper.TwitterScraper._fetch
+
+    def slow_newest(self, ttweet, img_urls):
+        # the newest images finish downloading last
+        time.sleep(0.01 * (int(ttweet.id) % 100))
+        return fetch(self, ttweet, img_urls)
+
+    monkeypatch.setattr(scraper.TwitterScraper, "_fetch", slow_newest)
+
+    assert services.run(services.config(streaming=True)) == 200
+
+    tweet_ids = services.album_tweet_ids()
+    assert tweet_ids == sorted(tweet_ids, key=int, reverse=True)
+    assert len(tweet_ids) == services.n_tweets
+
+
+def test_streaming_dag_fails_with_its_storer(services, monkeypatch):
+    def failing_store(self, tweet, *args, **kwargs):
+        raise RuntimeError("storage is down")
+
+    monkeypatch.setattr(storer.GCPStore, "_store_tweet", failing_store)
+
+    with pytest.raises(RuntimeError, match="storer failed"):
+        services.run(services.config(streaming=True))
+
+
+def test_incremental_scraper_rejected_with_replacing_target(services):
+    services.run(services.config())
+    cfg = services.config()
+    cfg["scraper"]["params"].update(
+        incremental=True, watermark_path=f"{services.workdir}/watermarks.json"
+    )
+
+    with pytest.raises(ValueError, match="incremental"):
+        services.run(cfg)
+
+    # the album is left as the last full run posted it
+    assert len(services.album) == services.n_tweets
+
+
+def test_failed_target_is_reported_then_raised(services, monkeypatch):
+    posted = []
+
+    class FakeSlackBot:
+        def __init__(self, **kwargs):
+            pass
+
+        def post(self, message):
+            posted.append(message)
+
+    monkeypatch.setenv("SLACKBOT_TOKEN", "token")
+    monkeypatch.setenv("SLACKBOT_CHANNEL", "channel")
+    monkeypatch.setattr(cli, "SlackBot", FakeSlackBot)
+
+    send = services.adapter.send
+
+    def failing_send(request, **kwargs):
+        if "batchCreate" in request.url:
+            raise requests.ConnectionError("boom")
+        return send(request, **kwargs)
+
+    monkeypatch.setattr(services.adapter, "send", failing_send)
+
+    with pytest.raises(RuntimeError, match="Targets failed"):
+        services.run(services.config())
+
+    # one message, with the failed target's status
+    assert len(posted) == 1
+    assert posted[0]["targets"]["GooglePhotos"]["status"] == "failed"
+
+
+def test_journal_is_opt_in(services):
+    assert services.run(services.config()) == 200
+    assert not os.path.exists(os.path.join(services.workdir, "journal"))
+
+    with pytest.raises(ValueError, match="--resume"):
+        services.run(services.config(), "--resume")
+
+
+def test_resume_skips_journalled_uploads(services, monkeypatch):
+    cfg = services.config()
+    cfg["journal"] = dict(enabled=True, path=f"{services.workdir}/journal.jsonl")
+
+    send = services.adapter.send
+
+    def failing_send(request, **kwargs):
+        if "batchCreate" in request.url:
+            raise requests.ConnectionError("boom")
+        return send(request, **kwargs)
+
+    with monkeypatch.context() as m:
+        m.setattr(services.adapter, "send", failing_send)
+        with pytest.raises(RuntimeError, match="Targets failed"):
+            services.run(cfg)
+
+    n_uploads = len(services.adapter.uploads) + len(services.adapter.sessions)
+    assert n_uploads == services.n_tweets
+    assert os.path.exists(cfg["journal"]["path"])
+
+    assert services.run(cfg, "--resume") == 200
+
+    # the resumed run creates the uploaded images without uploading them again
+    assert len(services.adapter.uploads) + len(services.adapter.sessions) == n_uploads
+    assert len(services.album) == services.n_tweets
+    # and deletes the journal once it succeeds
+    assert not os.path.exists(cfg["journal"]["path"])
@@ -0,0 +1,165 @@
+import os
+import time
+from urllib.parse import urlparse
+
+import pytest
+
+from benchmarks import bench_dag
+from benchmarks.fakes import FakeServiceAdapter
+from twit2imgs import google_photos_client
+from twit2imgs.cache import TTLCache
+from twit2imgs.google_photos_client import GooglePhotosClient
+
+CHUNK = FakeServiceAdapter.CHUNK_GRANULARITY
+
+
+@pytest.fixture
+def client(services, monkeypatch) -> GooglePhotosClient:
+    # skip the backoff between chunk retries
+    monkeypatch.setattr(google_photos_client.time, "sleep", lambda seconds: None)
+    return GooglePhotosClient(
+        [], os.path.join(services.workdir, "creds.json"), {}, chunk_size=CHUNK
+    )
+
+
+def test_resumable_upload_survives_dropped_chunks(services, client):
+    services.adapter.chunk_failure_rate = 0.3
+    photo = os.urandom(5 * CHUNK)
+
+    token = client._upload_photo(photo, "photo")
+
+    assert services.adapter.uploads[token] == len(photo)
+
+
+def test_resumable_upload_backs_off_on_429(services, client, monkeypatch):
+    resumable = services.adapter._resumable
+    throttled = []
+
+    def throttling(request, session_id):
+        if request.headers["X-Goog-Upload-Command"] == "upload" and not throttled:
+            throttled.append(request.headers["X-Goog-Upload-Offset"])
+            return services.adapter._response(request, 429, {}, "json")
+        return resumable(request, session_id)
+
+    monkeypatch.setattr(services.adapter, "_resumable", throttling)
+    photo = os.urandom(3 * CHUNK)
+
+    token = client._upload_photo(photo, "photo")
+
+    assert throttled
+    assert services.adapter.uploads[token] == len(photo)
+
+
+def test_upload_photos_creates_in_batches(services, client):
+    photos = [(b"photo %d" % ii, f"tweet {ii}") for ii in range(120)]
+
+    created = client.upload_photos(services.album_id, photos)
+
+    # the fake rejects batches of more than 50 items
+    assert len(created) == 120
+    assert [item["description"] for item in services.album] == [
+        description for _, description in photos
+    ]
+
+
+def test_upload_photos_commits_earlier_uploads_first(services, client):
+    created = client.upload_photos(
+        services.album_id,
+        [(b"photo", "tweet 2")],
+        upload_tokens=[("token-earlier", "tweet 1")],
+    )
+
+    assert [item["description"] for item in created] == ["tweet 1", "tweet 2"]
+
+
+def test_ttl_cache_expires_and_persists(tmp_path):
+    path = str(tmp_path / "cache.json")
+    cache = TTLCache(path, ttl=0.2)
+    cache.put("album:a", "album-0")
+
+    assert TTLCache(path, ttl=0.2).get("album:a") == "album-0"
+    time.sleep(0.25)
+    assert cache.get("album:a") is None
+
+
+def test_ttl_cache_continues_uncached_when_unwritable(tmp_path):
+    # a file where the cache's directory should be
+    (tmp_path / "cache").write_text("")
+    cache = TTLCache(str(tmp_path / "cache" / "photos.json"))
+    cache.put("album:a", "album-0")
+
+    assert not cache.persistent
+    assert cache.get("album:a") == "album-0"
+
+    # and a directory which goes after the cache is loaded
+    cache = TTLCache(str(tmp_path / "gone" / "photos.json"))
+    (tmp_path / "gone").rmdir()
+    (tmp_path / "gone").write_text("")
+    cache.put("album:a", "album-0")
+
+    assert not cache.persistent
+    assert cache.get("album:a") == "album-0"
+
+
+def test_album_ids_and_listings_are_cached(services, monkeypatch):
+    send = services.adapter.send
+    paths = []
+
+    def recording_send(request, **kwargs):
+        paths.append(urlparse(request.url).path)
+        return send(request, **kwargs)
+
+    monkeypatch.setattr(services.adapter, "send", recording_send)
+
+    def make_client():
+        return GooglePhotosClient(
+            [],
+            os.path.join(services.workdir, "creds.json"),
+            {},
+            cache_path=os.path.join(services.workdir, "photos_cache.json"),
+        )
+
+    album_id = make_client()._get_album_id(bench_dag.ALBUM)
+    assert album_id == services.album_id
+    assert make_client().get_album_items(album_id) == []
+
+    client = make_client()
+    assert client._get_album_id(bench_dag.ALBUM) == album_id
+    client.upload_photos(album_id, [(b"photo", "tweet 1")])
+
+    # the listing is updated with the items added, rather than fetched again
+    assert [item["description"] for item in client.get_album_items(album_id)] == [
+        "tweet 1"
+    ]
+    assert paths.count("/v1/albums") == 1
+    assert paths.count("/v1/mediaItems:search") == 1
+
+
+def test_clear_album_removes_in_batches_of_50(services, client):
+    client.upload_photos(
+        services.album_id, [(b"photo", f"tweet {ii}") for ii in range(120)]
+    )
+
+    results = client.clear_album(services.album_id)
+
+    # the fake rejects batches of more than 50 items
+    assert services.album == []
+    assert all(result["status"] == 200 for result in results)
+    assert sum(result["n_items"] for result in results) == 120
+    assert max(result["n_items"] for result in results) == 50
+
+
+def test_remove_mediaitems_reports_each_batch(services, client):
+    created = client.upload_photos(
+        services.album_id, [(b"photo", f"tweet {ii}") for ii in range(60)]
+    )
+
+    results = client.remove_mediaitems(
+        services.album_id, [item["id"] for item in created[:55]]
+    )
+
+    assert [(r["batch"], r["n_items"], r["status"]) for r in results] == [
+        (0, 50, 200),
+        (1, 5, 200),
+    ]
+    assert len(services.album) == 5
@@ -0,0 +1,78 @@
+import io
+
+import pytest
+from PIL import Image
+
+from benchmarks.fakes import synthetic_jpeg
+from twit2imgs import image_utils
+
+
+def test_fonts_are_loaded_once_per_size():
+    font = image_utils.load_font(image_utils.FONT_PATH, 20)
+
+    assert image_utils.load_font(image_utils.FONT_PATH, 20) is font
+    assert image_utils.load_font(image_utils.FONT_PATH, 40) is not font
+
+
+def test_split_caption():
+    top, bottom = image_utils.split_caption(
+        "Lake Natron, Tanzania (-2.4167, 36.0000) 14 Feb 2022 https://t.co/1"
+    )
+
+    assert top == "Lake Natron, Tanzania "
+    assert bottom == "(-2.4167 36.0000) 14 Feb 2022"
+    assert image_utils.split_caption(" no date here ") == ("no date here", "")
+
+
+def test_annotation_is_drawn_at_the_bottom_right():
+    im = Image.new("RGB", (1200, 675), (0, 0, 0))
+
+    out = image_utils.annotate(im, ["Lake Natron", "(-2.4167 36.0000) 14 Feb 2022"])
+
+    assert out.size == (1200, 675)
+    assert out.getpixel((1200 - 60, 675 - 30)) != (0, 0, 0)
+    assert out.getpixel((10, 10)) == (0, 0, 0)
+
+
+def test_jpegs_are_decoded_at_reduced_scale():
+    jpeg = synthetic_jpeg(1024)
+    png = io.BytesIO()
+    Image.new("RGB", (1024, 1024)).save(png, format="PNG")
+
+    # the smallest DCT scale still covering the size asked for
+    assert image_utils.decode_image(jpeg, (200, 100)).size == (256, 256)
+    assert image_utils.decode_image(jpeg).size == (1024, 1024)
+    assert image_utils.decode_image(png.getvalue(), (200, 100)).size == (1024, 1024)
+
+
+def test_render_downsamples_to_the_output_width():
+    out = image_utils.render_labelled(
+        synthetic_jpeg(1024), "Lake Natron (-2.4, 36.0) 14 Feb 2022", 320
+    )
+
+    with Image.open(io.BytesIO(out)) as im:
+        assert im.size == (320, 180)
+
+
+@pytest.mark.parametrize("format", ["png", "jpeg", "webp"])
+def test_encode_image_formats(format):
+    im = Image.new("RGBA", (64, 32), (10, 20, 30, 255))
+
+    encoded = image_utils.encode_image(im, format, quality=80)
+
+    assert image_utils.image_format(encoded) == format
+    with Image.open(io.BytesIO(encoded)) as decoded:
+        assert decoded.size == (64, 32)
+
+
+def test_encode_image_quality_shrinks_jpegs():
+    with image_utils.decode_image(synthetic_jpeg(256)) as im:
+        low = image_utils.encode_image(im, "jpeg", quality=20)
+        high = image_utils.encode_image(im, "jpeg", quality=95)
+
+    assert len(low) < len(high)
+
+
+def test_encode_image_rejects_unknown_formats():
+    with pytest.raises(ValueError, match="Unsupported format"):
+        image_utils.encode_image(Image.new("RGB", (1, 1)), "gif")
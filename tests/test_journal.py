@@ -0,0 +1,41 @@
+import os
+
+from twit2imgs.journal import RunJournal
+
+
+def test_resumed_journal_loads_completed_stages(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    journal = RunJournal(path)
+    journal.required += ["stored", "GooglePhotos.created"]
+    journal.record("1", "stored")
+    journal.record("1", "GooglePhotos.created", media_item_id="media-0")
+    journal.record("2", "stored")
+    # a line cut short by a crash
+    with open(path, "a") as f:
+        f.write('{"tweet_id": "2", "sta')
+
+    resumed = RunJournal(path, resume=True)
+    resumed.required += ["stored", "GooglePhotos.created"]
+
+    assert resumed.complete("1")
+    assert not resumed.complete("2")
+    assert resumed.done("1", "GooglePhotos.created")["media_item_id"] == "media-0"
+    assert set(resumed.stage("stored")) == {"1", "2"}
+
+
+def test_fresh_journal_discards_the_last(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    RunJournal(path).record("1", "stored")
+
+    journal = RunJournal(path)
+
+    assert journal.done("1", "stored") is None
+    journal.clear()
+    assert not os.path.exists(path)
+
+
+def test_nothing_is_complete_without_required_stages(tmp_path):
+    journal = RunJournal(str(tmp_path / "journal.jsonl"))
+    journal.record("1", "stored")
+
+    assert not journal.complete("1")
@@ -0,0 +1,151 @@
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from twit2imgs import utils
+from twit2imgs.memory import MemoryBudget
+from twit2imgs.pipeline import Pipeline
+from twit2imgs.scraper import Scraper
+from twit2imgs.target import Target
+
+
+class ListScraper(Scraper):
+    def __init__(self, tweets):
+        self.tweets = tweets
+
+    def scrape(self):
+        return self.tweets
+
+
+class DecodingTarget(Target):
+    def __init__(self):
+        self.sizes = []
+
+    def preprocess(self):
+        pass
+
+    def post_tweets(self, tweets):
+        for tweet in tweets:
+            self.sizes.append(tweet.image.size)
+            tweet.release(self.name)
+
+    def postprocess(self):
+        pass
+
+
+def test_budget_admits_once_there_is_room():
+    budget = MemoryBudget(100)
+    budget.admit("0")
+    budget.charge(60, 60, key="0")
+
+    admitted = threading.Event()
+    thread = threading.Thread(
+        target=lambda: (budget.admit("1"), admitted.set()), daemon=True
+    )
+    thread.start()
+    # a second tweet as large as the first doesn't fit
+    assert not admitted.wait(0.2)
+
+    budget.release(60)
+    assert admitted.wait(1)
+    assert budget.used == 60
+    assert budget.high_water == 60
+
+
+def test_hold_charges_unidentified_images_as_bytes(make_tweet):
+    budget = MemoryBudget(100)
+    tweet = make_tweet("0", b"not an image")
+
+    tweet.hold(budget, ["target"])
+    assert budget.used == len(b"not an image")
+
+    tweet.release("target")
+    assert budget.used == 0
+
+
+def test_pipeline_frees_released_tweets(make_tweet):
+    tweets = [make_tweet(str(ii)) for ii in range(10)]
+    target = DecodingTarget()
+    target.name = "target"
+    pipeline = Pipeline(
+        ListScraper(tweets), None, dict(target=target), max_inflight_bytes=10**8
+    )
+
+    pipeline.run()
+
+    assert len(target.sizes) == len(tweets)
+    assert pipeline._admitted == {}
+    assert pipeline.budget is not None and pipeline.budget.used == 0
+    assert all(tweet.image_bytes is None for tweet in tweets)
+
+
+def test_bounded_map_yields_in_flight_work_while_input_waits():
+    inputs: queue.Queue = queue.Queue()
+
+    def _items():
+        while True:
+            item = inputs.get()
+            if item is None:
+                return
+            yield item
+
+    inputs.put(1)
+    with ThreadPoolExecutor(2) as pool:
+        results = utils.bounded_map(pool, lambda x: x * 2, _items(), 2)
+        # yielded before the input iterator has its next item
+        item, future = next(results)
+        assert future.result() == 2
+
+        inputs.put(None)
+        assert list(results) == []
+
+
+def test_bounded_map_raises_input_errors_after_draining():
+    def _items():
+        yield 1
+        raise ValueError("bad input")
+
+    with ThreadPoolExecutor(2) as pool:
+        results = utils.bounded_map(pool, lambda x: x, _items(), 2)
+        assert next(results)[0] == 1
+        with pytest.raises(ValueError, match="bad input"):
+            next(results)
+
+
+def test_bounded_map_caps_work_in_flight():
+    running, peak = 0, 0
+    lock = threading.Lock()
+
+    def _work(x):
+        nonlocal running, peak
+        with lock:
+            running += 1
+            peak = max(peak, running)
+        time.sleep(0.01)
+        with lock:
+            running -= 1
+        return x
+
+    with ThreadPoolExecutor(8) as pool:
+        done = [item for item, _ in utils.bounded_map(pool, _work, range(20), 3)]
+
+    assert sorted(done) == list(range(20))
+    assert peak <= 3
+
+
+def test_bounded_map_ordered_yields_in_input_order():
+    def _work(x):
+        # later items finish first
+        time.sleep(0.01 * (5 - x % 5))
+        return x
+
+    with ThreadPoolExecutor(4) as pool:
+        done = [
+            future.result()
+            for _, future in utils.bounded_map(pool, _work, range(15), 4, ordered=True)
+        ]
+
+    assert done == list(range(15))
@@ -0,0 +1,53 @@
+import json
+
+import requests
+
+from benchmarks.fakes import IMAGE_HOST, FakeServiceAdapter
+from twit2imgs.metrics import Metrics
+
+
+def test_report_summarises_counters_and_timings():
+    metrics = Metrics()
+    metrics.incr("storer.bytes_uploaded", 10)
+    metrics.incr("storer.bytes_uploaded", 5)
+    metrics.observe("stage.storer", 1.0)
+    metrics.observe("stage.storer", 3.0)
+
+    report = metrics.report()
+
+    assert report["counters"] == {"storer.bytes_uploaded": 15}
+    assert report["timings"]["stage.storer"] == dict(
+        count=2, total=4.0, mean=2.0, max=3.0
+    )
+    assert metrics.summary()["stages"] == {"stage.storer": 4.0}
+
+
+def test_instrumented_sessions_record_requests(image_bytes):
+    metrics = Metrics()
+    session = FakeServiceAdapter(image_bytes).mount(requests.Session())
+    metrics.instrument_session(session, "images")
+
+    session.get(f"https://{IMAGE_HOST}/media/1.jpg")
+
+    counters = metrics.report()["counters"]
+    assert counters["http.images.requests"] == 1
+    assert counters["http.images.status.200"] == 1
+    assert counters["http.images.bytes_received"] == len(image_bytes)
+    # status counts are left out of the summary
+    assert "http.images.status.200" not in metrics.summary()
+
+
+def test_reports_are_written_as_json_and_prometheus(tmp_path):
+    metrics = Metrics()
+    metrics.incr("photos.chunks", 3)
+    metrics.observe("photos.upload", 0.5)
+
+    metrics.write_json(str(tmp_path / "metrics.json"))
+    metrics.write_prometheus(str(tmp_path / "metrics.prom"))
+
+    with open(tmp_path / "metrics.json") as f:
+        assert json.load(f)["counters"] == {"photos.chunks": 3}
+    with open(tmp_path / "metrics.prom") as f:
+        lines = f.read().splitlines()
+    assert "twit2imgs_photos_chunks_total 3" in lines
+    assert "twit2imgs_photos_upload_seconds_count 1" in lines
@@ -0,0 +1,46 @@
+import pytest
+
+from twit2imgs.memory import MemoryBudget
+
+
+def test_image_is_decoded_on_first_access(make_tweet):
+    tweet = make_tweet("0")
+    assert tweet._image is None
+
+    assert tweet.image.size == (64, 64)
+    # decoded once, then reused
+    assert tweet.image is tweet._image
+
+
+def test_released_image_is_decoded_again(make_tweet):
+    tweet = make_tweet("0")
+    first = tweet.image
+
+    tweet.release_image()
+    assert tweet._image is None
+    assert tweet.image is not first
+    assert tweet.image_bytes is not None
+
+
+def test_decoded_pixels_are_charged_until_released(make_tweet):
+    budget = MemoryBudget(10**6)
+    tweet = make_tweet("0")
+    tweet.hold(budget, ["target"])
+    n_bytes = len(tweet.image_bytes or b"")
+    assert budget.used == n_bytes
+
+    tweet.image
+    assert budget.used == n_bytes + 64 * 64 * 3
+
+    tweet.release("target")
+    assert budget.used == 0
+    assert tweet.image_bytes is None
+
+
+def test_freed_image_cannot_be_decoded(make_tweet):
+    tweet = make_tweet("0")
+    tweet.hold(MemoryBudget(10**6), ["target"])
+    tweet.release("target")
+
+    with pytest.raises(ValueError, match="no image bytes"):
+        tweet.image
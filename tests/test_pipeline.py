@@ -0,0 +1,53 @@
+import time
+from types import SimpleNamespace
+
+from twit2imgs.pipeline import run_targets
+from twit2imgs.target import Target
+
+
+def make_tweets(n):
+    return [SimpleNamespace(id=str(ii), is_new=True) for ii in range(n)]
+
+
+class RecordingTarget(Target):
+    def __init__(self, delay=0.0, fail=False):
+        self.delay = delay
+        self.fail = fail
+        self.posted = []
+
+    def preprocess(self):
+        pass
+
+    def post_tweets(self, tweets):
+        for tweet in tweets:
+            if self.fail:
+                raise RuntimeError("boom")
+            time.sleep(self.delay)
+            self.posted.append(tweet.id)
+
+    def postprocess(self):
+        pass
+
+
+def test_run_targets_isolates_failures():
+    ok, failing = RecordingTarget(), RecordingTarget(fail=True)
+
+    results = run_targets(dict(ok=ok, failing=failing), make_tweets(5))
+
+    assert results["ok"]["status"] == "ok"
+    assert ok.posted == ["0", "1", "2", "3", "4"]
+    assert results["failing"]["status"] == "failed"
+    assert "boom" in results["failing"]["error"]
+
+
+def test_run_targets_stops_timed_out_target():
+    slow = RecordingTarget(delay=0.05)
+
+    results = run_targets(dict(slow=slow), make_tweets(100), dict(slow=0.2))
+
+    assert results["slow"]["status"] == "timeout"
+    # the cancelled target is given no more tweets, so it stops posting
+    time.sleep(0.2)
+    n_posted = len(slow.posted)
+    time.sleep(0.2)
+    assert len(slow.posted) == n_posted < 100
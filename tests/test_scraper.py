@@ -0,0 +1,172 @@
+import threading
+import time
+
+import requests
+import tweepy
+
+from benchmarks.fakes import IMAGE_HOST, FakeTwitterClient
+from twit2imgs.scraper import RateLimitScheduler, UserScraper
+
+
+def make_scraper(services, **kwargs) -> UserScraper:
+    kwargs.setdefault("max_results", services.n_tweets)
+    return UserScraper("fake", tweet_fields=["attachments"], **kwargs)
+
+
+def test_scrape_fetches_every_image_newest_first(services):
+    tweets = make_scraper(services, user_id="1", concurrency=4).scrape()
+
+    tweet_ids = [int(tweet.id) for tweet in tweets]
+    assert len(tweets) == services.n_tweets
+    assert tweet_ids == sorted(tweet_ids, reverse=True)
+    assert all(tweet.image_bytes == services.adapter.image_bytes for tweet in tweets)
+
+
+def test_images_download_concurrently(services, monkeypatch):
+    send = services.adapter.send
+    lock = threading.Lock()
+    in_flight, peak = 0, 0
+
+    def slow_send(request, **kwargs):
+        nonlocal in_flight, peak
+        if IMAGE_HOST not in request.url:
+            return send(request, **kwargs)
+        with lock:
+            in_flight += 1
+            peak = max(peak, in_flight)
+        time.sleep(0.02)
+        with lock:
+            in_flight -= 1
+        return send(request, **kwargs)
+
+    monkeypatch.setattr(services.adapter, "send", slow_send)
+
+    tweets = make_scraper(services, user_id="1", concurrency=4).scrape()
+
+    assert len(tweets) == services.n_tweets
+    assert 1 < peak <= 4
+
+
+def test_cached_images_are_not_downloaded_again(services, monkeypatch, tmp_path):
+    send = services.adapter.send
+    downloads = []
+
+    def counting_send(request, **kwargs):
+        if IMAGE_HOST in request.url:
+            downloads.append(request.url)
+        return send(request, **kwargs)
+
+    monkeypatch.setattr(services.adapter, "send", counting_send)
+    cache_dir = str(tmp_path / "cache")
+
+    first = make_scraper(services, user_id="1", cache_dir=cache_dir).scrape()
+    second = make_scraper(services, user_id="1", cache_dir=cache_dir).scrape()
+
+    assert len(downloads) == services.n_tweets
+    assert [t.image_bytes for t in second] == [t.image_bytes for t in first]
+
+
+def test_watermark_flags_new_tweets(services, tmp_path):
+    watermark_path = str(tmp_path / "watermarks.json")
+    scraper = make_scraper(services, user_id="1", watermark_path=watermark_path)
+    assert all(tweet.is_new for tweet in scraper.scrape())
+    scraper.commit()
+
+    services.n_tweets += 3
+    tweets = make_scraper(services, user_id="1", watermark_path=watermark_path).scrape()
+
+    n_new = sum(tweet.is_new for tweet in tweets)
+    assert len(tweets) == services.n_tweets
+    assert n_new == 3
+    assert all(tweet.is_new for tweet in tweets[:n_new])
+
+
+def test_incremental_scrape_requests_only_new_tweets(services, tmp_path):
+    def _scraper(incremental):
+        return make_scraper(
+            services,
+            user_id="1",
+            watermark_path=str(tmp_path / "watermarks.json"),
+            incremental=incremental,
+        )
+
+    scraper = _scraper(False)
+    scraper.scrape()
+    # an uncommitted run leaves the watermark where it was
+    assert len(_scraper(True).scrape()) == services.n_tweets
+    scraper.commit()
+
+    services.n_tweets += 3
+    tweets = _scraper(True).scrape()
+
+    assert len(tweets) == 3
+    assert all(tweet.is_new for tweet in tweets)
+
+
+def test_incremental_scrape_takes_full_pages(services, tmp_path, monkeypatch):
+    watermark_path = str(tmp_path / "watermarks.json")
+    scraper = make_scraper(services, user_id="1", watermark_path=watermark_path)
+    scraper.scrape()
+    scraper.commit()
+
+    get_users_tweets = FakeTwitterClient.get_users_tweets
+    page_sizes = []
+
+    def counting_get(self, id, max_results=10, **kwargs):
+        page_sizes.append(max_results)
+        return get_users_tweets(self, id, max_results=max_results, **kwargs)
+
+    monkeypatch.setattr(FakeTwitterClient, "get_users_tweets", counting_get)
+    services.n_tweets += 200
+    tweets = make_scraper(
+        services,
+        user_id="1",
+        max_results=12,
+        watermark_path=watermark_path,
+        incremental=True,
+    ).scrape()
+
+    # every new tweet, however small the window, in as few requests as possible
+    assert len(tweets) == 200
+    assert page_sizes == [100, 100]
+
+
+def test_scrape_pages_through_results(services):
+    services.n_tweets = 250
+
+    assert len(make_scraper(services, user_id="1").scrape()) == 250
+    assert len(make_scraper(services, user_id="1", max_pages=1).scrape()) == 100
+
+
+def test_scrape_fans_out_over_users(services):
+    scraper = make_scraper(services, user_id=["1", "2", "bad"])
+
+    tweets = scraper.scrape()
+
+    # a failing source is skipped without failing the others
+    assert len(tweets) == 2 * services.n_tweets
+    assert scraper.failed_sources == ["bad"]
+
+
+def test_rate_limited_calls_wait_for_the_reset():
+    response = requests.Response()
+    response.status_code = 429
+    response._content = b"{}"
+    response.headers["x-rate-limit-reset"] = str(time.time() + 0.2)
+
+    calls = []
+
+    def _call():
+        calls.append(time.time())
+        if len(calls) == 1:
+            raise tweepy.TooManyRequests(response)
+        return "ok"
+
+    scheduler = RateLimitScheduler(max_retries=1)
+
+    assert scheduler.call("users_tweets", _call) == "ok"
+    assert calls[1] - calls[0] >= 0.15
+    # other endpoints aren't held back
+    start = time.time()
+    assert scheduler.call("search_recent", lambda: "ok") == "ok"
+    assert time.time() - start < 0.1
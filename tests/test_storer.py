@@ -0,0 +1,117 @@
+import os
+from datetime import datetime, timezone
+from typing import List
+
+import pytest
+
+from twit2imgs import utils
+from twit2imgs.storer import GCPStore
+
+
+def manifest_store() -> GCPStore:
+    return GCPStore("bench", "records", "images", records="manifest")
+
+
+def test_unknown_records_mode_rejected():
+    with pytest.raises(ValueError, match="records"):
+        GCPStore("bench", "records", "images", records="manfest")
+
+
+def test_manifest_records_read_back(services):
+    cfg = services.config()
+    cfg["storer"]["params"]["records"] = "manifest"
+    assert services.run(cfg) == 200
+
+    store = manifest_store()
+    day = datetime.now(timezone.utc).date()
+    assert len(store.read_partition(day)) == services.n_tweets
+
+    ids = services.album_tweet_ids()[:3]
+    assert set(store.read_records(ids)) == set(ids)
+
+
+def test_manifest_index_merges_concurrent_runs(services):
+    stores = [manifest_store() for _ in range(2)]
+    # both runs read the index before either writes it
+    for store in stores:
+        assert store._known_records() == set()
+
+    for i, store in enumerate(stores):
+        store._manifest = [dict(id=str(i), text="", url="")]
+        store._write_manifest()
+
+    assert set(manifest_store().read_index()) == {"0", "1"}
+    assert set(manifest_store().read_records(["0", "1"])) == {"0", "1"}
+
+
+def stored_names(services, prefix: str) -> List[str]:
+    root = os.path.join(services.workdir, "gcs", "bench", prefix)
+    return sorted(os.listdir(root)) if os.path.isdir(root) else []
+
+
+def test_store_uploads_in_parallel_with_one_client(services, make_tweet, monkeypatch):
+    storage_client = utils.storage_client
+    clients = []
+
+    def counting_client(*args, **kwargs):
+        clients.append(kwargs)
+        return storage_client(*args, **kwargs)
+
+    monkeypatch.setattr(utils, "storage_client", counting_client)
+    store = GCPStore("bench", "records", "images", max_workers=4)
+
+    store.store([make_tweet(str(ii)) for ii in range(10)])
+
+    assert len(clients) == 1
+    assert stored_names(services, "images") == sorted(f"{ii}.png" for ii in range(10))
+    assert len(stored_names(services, "records")) == 10
+    assert store.summary()["stored"] == 10
+
+
+def test_store_writes_no_local_files(services, make_tweet, monkeypatch, tmp_path):
+    cwd = tmp_path / "cwd"
+    cwd.mkdir()
+    monkeypatch.chdir(cwd)
+
+    GCPStore("bench", "records", "images").store([make_tweet("0")])
+
+    assert stored_names(services, "images") == ["0.png"]
+    assert list(cwd.iterdir()) == []
+
+
+def test_dedup_skips_tweets_already_stored(services, make_tweet):
+    GCPStore("bench", "records", "images").store([make_tweet("0")])
+    image_path = os.path.join(services.workdir, "gcs", "bench", "images", "0.png")
+    stored_at = os.stat(image_path).st_mtime_ns
+
+    store = GCPStore("bench", "records", "images", dedup=True)
+    store.store([make_tweet("0"), make_tweet("1")])
+
+    assert store.summary()["stored"] == 1
+    assert store.summary()["skipped"] == 1
+    assert os.stat(image_path).st_mtime_ns == stored_at
+    assert stored_names(services, "images") == ["0.png", "1.png"]
+
+
+def test_skip_known_skips_tweets_seen_before(services, make_tweet):
+    seen, new = make_tweet("0"), make_tweet("1")
+    seen.is_new = False
+
+    store = GCPStore("bench", "records", "images", skip_known=True)
+    store.store([seen, new])
+
+    assert store.summary()["skipped"] == 1
+    assert stored_names(services, "images") == ["1.png"]
+
+
+def test_original_encoding_stores_the_downloaded_bytes(services, make_tweet):
+    tweet = make_tweet("0")
+    original = tweet.image_bytes
+
+    GCPStore("bench", "records", "images", encoding=dict(format="original")).store(
+        [tweet]
+    )
+
+    path = os.path.join(services.workdir, "gcs", "bench", "images", "0.jpg")
+    with open(path, "rb") as f:
+        assert f.read() == original
@@ -0,0 +1,74 @@
+import pytest
+
+from benchmarks.fakes import FakeTwitterClient
+
+
+def test_sync_removes_duplicate_and_stale_items(services):
+    cfg = services.config()
+    cfg["targets"]["GooglePhotos"]["params"]["sync"] = True
+    assert services.run(cfg) == 200
+
+    first = services.album[0]
+    services.album.extend(
+        [
+            # a second copy of a tweet, e.g. from an interrupted run
+            dict(id="duplicate", description=first["description"]),
+            dict(id="stale", description="tweet 1"),
+            dict(id="untagged", description=""),
+        ]
+    )
+
+    assert services.run(cfg) == 200
+
+    media_ids = [item["id"] for item in services.album]
+    assert first["id"] in media_ids
+    assert not {"duplicate", "stale", "untagged"} & set(media_ids)
+    assert sorted(services.album_tweet_ids()) == sorted(set(services.album_tweet_ids()))
+    assert len(services.album) == services.n_tweets
+
+
+def test_album_is_ordered_newest_first(services):
+    cfg = services.config()
+    cfg["targets"]["GooglePhotos"]["params"]["render_workers"] = 3
+    assert services.run(cfg) == 200
+
+    tweet_ids = services.album_tweet_ids()
+    assert tweet_ids == sorted(tweet_ids, key=int, reverse=True)
+
+
+def test_sync_only_uploads_missing_tweets(services):
+    cfg = services.config()
+    cfg["targets"]["GooglePhotos"]["params"]["sync"] = True
+    assert services.run(cfg) == 200
+    first_ids = services.album_tweet_ids()
+
+    # two newer tweets push the two oldest out of the latest 12
+    services.n_tweets += 2
+    assert services.run(cfg) == 200
+
+    tweet_ids = services.album_tweet_ids()
+    assert len(services.adapter.uploads) == len(first_ids) + 2
+    assert len(tweet_ids) == len(first_ids)
+    assert set(first_ids) - set(tweet_ids) == set(first_ids[-2:])
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_sync_keeps_the_items_of_failed_sources(services, monkeypatch, streaming):
+    cfg = services.config(streaming)
+    cfg["targets"]["GooglePhotos"]["params"]["sync"] = True
+    cfg["scraper"]["params"]["user_id"] = ["1", "2"]
+    assert services.run(cfg) == 200
+    assert len(services.album) == 2 * services.n_tweets
+
+    get_users_tweets = FakeTwitterClient.get_users_tweets
+
+    def failing_source(self, id, **kwargs):
+        if id == "2":
+            raise RuntimeError("rate limited")
+        return get_users_tweets(self, id, **kwargs)
+
+    monkeypatch.setattr(FakeTwitterClient, "get_users_tweets", failing_source)
+    assert services.run(cfg) == 200
+
+    # the failed source's tweets weren't scraped, but are still in the album
+    assert len(services.album) == 2 * services.n_tweets
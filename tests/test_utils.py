@@ -0,0 +1,37 @@
+import io
+
+import pytest
+
+from benchmarks.fakes import FakeStorageClient
+from twit2imgs import utils
+
+
+@pytest.mark.parametrize(
+    "method, status, retried",
+    [
+        ("GET", 503, True),
+        ("GET", 429, True),
+        # a POST may have been applied before the server failed
+        ("POST", 503, False),
+        ("POST", 500, False),
+        # but a 429 was refused outright
+        ("POST", 429, True),
+    ],
+)
+def test_pooled_session_retries(flaky_server, method, status, retried):
+    url, calls = flaky_server
+    session = utils.pooled_session(2, retries=2, backoff_factor=0)
+
+    response = session.request(method, f"{url}/{status}")
+
+    assert response.status_code == (200 if retried else status)
+    assert calls[f"/{status}"] == (2 if retried else 1)
+
+
+def test_upload_buffer_streams_from_memory(tmp_path):
+    bucket = FakeStorageClient(str(tmp_path)).bucket("bucket")
+
+    path = utils.upload_buffer(io.BytesIO(b"data"), "bucket/dir/blob", bucket=bucket)
+
+    assert path == "bucket/dir/blob"
+    assert bucket.blob("dir/blob").download_as_bytes() == b"data"